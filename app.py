@@ -1,18 +1,35 @@
 import os
+# Imported first so the startup timer covers the imports below (see startup.py)
+from startup import startup_timer, load_secrets, LazyClient, LazyModule, warmup
+import atexit
 import json
 import logging
-import requests
-import hashlib
+import resource
+from contextlib import nullcontext
 from datetime import datetime
-import firebase_admin
-from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1 import query as firestore_query
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, g
 from flask_cors import CORS
 from dotenv import load_dotenv
-import stripe
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from openai_client import OpenAIClient, CircuitBreaker, UpstreamUnavailable, UpstreamError
+from conversation_store import ConversationStore
+from context_builder import ContextBuilder, MessageTooLong
+from response_cache import ResponseCache
+from session_state import BoundedStore, SessionStateStore
+from state_backend import create_state_backend
+from usage_meter import UsageMeter, usage_window, window_resets_at
+from tier_cache import TierCache
+from job_queue import JobQueue
+from email_outbox import EmailOutbox, SendGridTransport
+from email_templates import EmailTemplates
+from campaign_runner import CampaignRunner
+from stripe_webhooks import FirestoreEventStore, InMemoryEventStore, SignatureError, StripeWebhookProcessor
+from subscription_mirror import SubscriptionMirror, mirror_record, tier_for
+from confession_feed import ConfessionFeed, InvalidCursor, DEFAULT_SORT, feed_item
+from trending_ranking import TrendingRanking
+from search_index import SearchIndex, FileSnapshotStore, StorageSnapshotStore
+from related_prayers import RelatedPrayers
+from upvote_counter import MAX_BATCH_WRITES, UpvoteCounter, UnknownConfession
+from firestore_loader import DocumentLoader, FirestoreCallStats, current_loader, forget_document, get_document, loader_scope
 
 # Load environment variables from .env file (for local development)
 load_dotenv()
@@ -20,73 +37,38 @@ load_dotenv()
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-
-# Load secrets from Google Cloud Secret Manager (for production)
-def load_secret(secret_name):
-    """Load a secret from Google Cloud Secret Manager or fall back to environment variable."""
-    # First try environment variable (local development with .env)
-    env_value = os.getenv(secret_name.upper().replace('-', '_'))
-    if env_value:
-        return env_value
-    
-    # Try Google Cloud Secret Manager (production)
-    try:
-        from google.cloud import secretmanager
-        client = secretmanager.SecretManagerServiceClient()
-        project_id = os.getenv('GOOGLE_CLOUD_PROJECT', 'confessiones-c6ca5')
-        secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-        response = client.access_secret_version(request={"name": secret_path})
-        secret_value = response.payload.data.decode('UTF-8')
-        logger.info(f"Loaded secret '{secret_name}' from Secret Manager")
-        return secret_value
-    except Exception as e:
-        logger.warning(f"Could not load secret '{secret_name}' from Secret Manager: {e}")
-        return None
-
-# Load secrets (try Secret Manager first, fall back to environment variables)
-if not os.getenv('OPENAI_API_KEY'):
-    openai_key = load_secret('openai-api-key')
-    if openai_key:
-        os.environ['OPENAI_API_KEY'] = openai_key
-
-if not os.getenv('STRIPE_SECRET_KEY'):
-    stripe_key = load_secret('stripe-secret-key')
-    if stripe_key:
-        os.environ['STRIPE_SECRET_KEY'] = stripe_key
-
-if not os.getenv('STRIPE_PUBLISHABLE_KEY'):
-    stripe_pub_key = load_secret('stripe-publishable-key')
-    if stripe_pub_key:
-        os.environ['STRIPE_PUBLISHABLE_KEY'] = stripe_pub_key
-
-if not os.getenv('STRIPE_PRICE_ID_UNLIMITED'):
-    stripe_price = load_secret('stripe-price-id-unlimited')
-    if stripe_price:
-        os.environ['STRIPE_PRICE_ID_UNLIMITED'] = stripe_price
-
-if not os.getenv('FIREBASE_API_KEY'):
-    firebase_key = load_secret('firebase-api-key')
-    if firebase_key:
-        os.environ['FIREBASE_API_KEY'] = firebase_key
-
-if not os.getenv('STRIPE_PRICE_ID_ANNUAL'):
-    stripe_annual = load_secret('stripe-price-id-annual')
-    if stripe_annual:
-        os.environ['STRIPE_PRICE_ID_ANNUAL'] = stripe_annual
-
-if not os.getenv('SENDGRID_API_KEY'):
-    sendgrid_key = load_secret('sendgrid-api-key')
-    if sendgrid_key:
-        os.environ['SENDGRID_API_KEY'] = sendgrid_key
+startup_timer.mark('imports')
+
+# Load secrets (environment variables win; the rest come from Secret Manager, fetched concurrently)
+load_secrets({
+    'OPENAI_API_KEY': 'openai-api-key',
+    'STRIPE_SECRET_KEY': 'stripe-secret-key',
+    'STRIPE_PUBLISHABLE_KEY': 'stripe-publishable-key',
+    'STRIPE_PRICE_ID_UNLIMITED': 'stripe-price-id-unlimited',
+    'FIREBASE_API_KEY': 'firebase-api-key',
+    'STRIPE_PRICE_ID_ANNUAL': 'stripe-price-id-annual',
+    'STRIPE_WEBHOOK_SECRET': 'stripe-webhook-secret',
+    'SENDGRID_API_KEY': 'sendgrid-api-key',
+    'INTERNAL_STATS_TOKEN': 'internal-stats-token'
+}, project_id=os.getenv('GOOGLE_CLOUD_PROJECT', 'confessiones-c6ca5'))
+startup_timer.mark('secrets')
 
 app = Flask(__name__)
 CORS(app)
 
 # Initialize SendGrid
 sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
-if sendgrid_api_key:
-    sendgrid_client = SendGridAPIClient(sendgrid_api_key)
-    logger.info("SendGrid API configured")
+# Local stand-in for testing (see sendgrid_standin.py)
+sendgrid_api_host = os.getenv('SENDGRID_API_HOST')
+
+def create_sendgrid_client():
+    from sendgrid import SendGridAPIClient
+    return SendGridAPIClient(sendgrid_api_key or 'SG.standin', host=sendgrid_api_host or 'https://api.sendgrid.com')
+
+if sendgrid_api_key or sendgrid_api_host:
+    # Built on the first email the outbox sends
+    sendgrid_client = LazyClient('SendGrid', create_sendgrid_client)
+    logger.info(f"SendGrid API configured{' (stand-in at ' + sendgrid_api_host + ')' if sendgrid_api_host else ''}")
 else:
     sendgrid_client = None
     logger.warning("SendGrid API key not found - emails will not be sent")
@@ -95,277 +77,78 @@ else:
 # EMAIL TEMPLATES & FUNCTIONS
 # ============================================================================
 
-# Base email template with consistent branding
-EMAIL_BASE_TEMPLATE = '''
-<div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-    <div style="background: linear-gradient(135deg, #1e40af 0%, #3b82f6 100%); color: white; padding: 30px; text-align: center;">
-        <h1 style="margin: 0; font-size: 28px;">✝️ My Confessions</h1>
-        <p style="margin: 10px 0 0; opacity: 0.9;">Biblical Guidance for Your Spiritual Journey</p>
-    </div>
-    
-    <div style="padding: 30px; background: white;">
-        {content}
-    </div>
-    
-    <div style="background: #f9fafb; padding: 20px; text-align: center; color: #6b7280; font-size: 12px;">
-        <p style="margin: 0;">
-            Need help? Contact us at <a href="mailto:support@myconfessions.org" style="color: #2563eb;">support@myconfessions.org</a>
-        </p>
-        <p style="margin: 10px 0 0;">
-            © 2025 My Confessions. All rights reserved.
-        </p>
-    </div>
-</div>
-'''
-
-def send_email(to_email, subject, html_content):
-    """Generic email sender using SendGrid"""
+# Email bodies live in templates/emails/ (base.html has the shared branding)
+email_templates = EmailTemplates(app.jinja_env)
+
+def record_dead_letter_emails(messages, reason):
+    """Keep emails the outbox gave up on in Firestore so they can be inspected and replayed"""
+    if not db:
+        return
+    # Firestore allows 500 writes per batch; a failed 1000-recipient send needs two
+    for offset in range(0, len(messages), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for message in messages[offset:offset + MAX_BATCH_WRITES]:
+            batch.set(db.collection('email_dead_letters').document(message['key']), {
+                'to': message['to'],
+                'template': message['template'],
+                'subject': message['subject'],
+                'html': message['html'],
+                'substitutions': message['substitutions'],
+                'attempts': message['attempts'],
+                'reason': reason,
+                'failed_at': datetime.now()
+            })
+        batch.commit()
+
+# Emails are queued and sent in batches by a background sender (see email_outbox.py)
+email_outbox = EmailOutbox(
+    SendGridTransport(sendgrid_client) if sendgrid_client else None,
+    from_email='support@myconfessions.org',
+    max_requests_per_second=float(os.getenv('SENDGRID_MAX_RPS', '5')),
+    flush_interval=float(os.getenv('EMAIL_FLUSH_SECONDS', '1')),
+    spill_dir=os.getenv('JOB_SPILL_DIR', '/tmp/confessiones-jobs'),
+    dead_letter=record_dead_letter_emails
+)
+atexit.register(email_outbox.shutdown)
+
+def send_email(to_email, subject, html_content, template='generic', dedup_key=None):
+    """Queue an email for delivery through the outbox; False if SendGrid is off or it's a duplicate"""
     if not sendgrid_client:
         logger.warning(f"Cannot send email to {to_email} - SendGrid not configured")
         return False
     
-    try:
-        message = Mail(
-            from_email='support@myconfessions.org',
-            to_emails=to_email,
-            subject=subject,
-            html_content=html_content
-        )
-        response = sendgrid_client.send(message)
-        logger.info(f"Email sent to {to_email}, subject: {subject}, status: {response.status_code}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {e}")
-        return False
+    queued = email_outbox.enqueue(to_email, subject, html_content, template=template, dedup_key=dedup_key)
+    if queued:
+        logger.info(f"Email queued for {to_email}, subject: {subject}")
+    else:
+        logger.info(f"Skipping duplicate email to {to_email}, subject: {subject}")
+    return queued
 
 def send_welcome_email(email, name):
     """Send welcome email to new user"""
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Welcome, {name or 'Child of God'}! 🙏</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Thank you for joining My Confessions. We're honored to walk alongside you on your spiritual journey.
-        </p>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                "If we confess our sins, He is faithful and just to forgive us our sins 
-                and to cleanse us from all unrighteousness."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 5px 0 0; text-align: right;">
-                — 1 John 1:9
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">What You Can Do:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li>Have 24/7 Scripture-based spiritual conversations</li>
-            <li>Create beautiful prayers from your reflections</li>
-            <li>Save your spiritual journey (with Premium)</li>
-            <li>Share prayers anonymously to help others (with Premium)</li>
-        </ul>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Start Your Spiritual Journey
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            May God's peace be with you,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, 'Welcome to My Confessions - Your Spiritual Journey Begins', html)
+    html = email_templates.render('welcome.html', name=name)
+    return send_email(email, 'Welcome to My Confessions - Your Spiritual Journey Begins', html, template='welcome')
 
 def send_password_reset_email(email, reset_token):
     """Send password reset email"""
     reset_url = f"https://myconfessions.org/reset-password?token={reset_token}"
-    
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Password Reset Request 🔑</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            We received a request to reset your password for your My Confessions account.
-        </p>
-        
-        <div style="background: #fef3c7; border-left: 4px solid #f59e0b; padding: 15px; margin: 20px 0;">
-            <p style="color: #92400e; margin: 0; font-weight: bold;">
-                ⚠️ If you did not request this, please ignore this email.
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="{reset_url}" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Reset Your Password
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; text-align: center;">
-            This link will expire in 1 hour for your security.
-        </p>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Praying for your peace,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, 'Reset Your Password - My Confessions', html)
+    html = email_templates.render('password_reset.html', reset_url=reset_url)
+    return send_email(email, 'Reset Your Password - My Confessions', html, template='password_reset')
 
 def send_subscription_activated_email(email, name, plan_type, amount):
     """Send email when subscription is activated"""
-    plan_display = "Annual ($39.99/year)" if plan_type == 'annual' else "Monthly ($4.99/month)"
-    
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Welcome to Premium! 💎</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Beloved Child of God'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Your Premium membership has been activated! Thank you for supporting our ministry.
-        </p>
-        
-        <div style="background: #dcfce7; border: 2px solid #16a34a; border-radius: 8px; padding: 20px; margin: 20px 0; text-align: center;">
-            <h3 style="color: #166534; margin: 0 0 10px;">✅ Subscription Active</h3>
-            <p style="color: #166534; margin: 0; font-size: 18px; font-weight: bold;">
-                {plan_display}
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">Your Premium Benefits:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li><strong>Unlimited Biblical guidance</strong> - 24/7 access to spiritual conversations</li>
-            <li><strong>Community prayers</strong> - Read and share prayers with fellow believers</li>
-            <li><strong>Journey saved</strong> - All your conversations are preserved</li>
-            <li><strong>Priority support</strong> - We're here to help you</li>
-        </ul>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                "For where two or three gather in my name, there am I with them."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 5px 0 0; text-align: right;">
-                — Matthew 18:20
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Continue Your Journey
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Thank you for your partnership in spreading God's word through technology.<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, '✅ Your Premium Membership is Active!', html)
+    html = email_templates.render('subscription_activated.html', name=name, plan_type=plan_type, amount=amount)
+    return send_email(email, '✅ Your Premium Membership is Active!', html, template='subscription_activated')
 
 def send_subscription_cancelled_email(email, name):
     """Send email when subscription is cancelled"""
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Your Subscription Has Been Cancelled</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Beloved Friend'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            We're sorry to see you go. Your Premium membership has been cancelled and will remain active until the end of your current billing period.
-        </p>
-        
-        <div style="background: #fef3c7; border-left: 4px solid #f59e0b; padding: 15px; margin: 20px 0;">
-            <p style="color: #92400e; margin: 0;">
-                <strong>What happens now:</strong><br>
-                • You can still use Premium features until your subscription ends<br>
-                • After that, you'll have access to our Free tier (20 conversations/month)<br>
-                • Your data will be preserved
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">We'd Love to Have You Back</h3>
-        <p style="color: #374151; line-height: 1.6;">
-            You can reactivate your subscription anytime. We're always here to support your spiritual growth.
-        </p>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                "The Lord is close to the brokenhearted and saves those who are crushed in spirit."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 5px 0 0; text-align: right;">
-                — Psalm 34:18
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Reactivate Membership
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            May God's blessings be with you always,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, 'Your Subscription Has Been Cancelled', html)
+    html = email_templates.render('subscription_cancelled.html', name=name)
+    return send_email(email, 'Your Subscription Has Been Cancelled', html, template='subscription_cancelled')
 
 def send_payment_failed_email(email, name):
     """Send email when subscription payment fails"""
-    content = f'''
-        <h2 style="color: #dc2626; margin-top: 0;">Payment Issue - Action Required ⚠️</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Valued Member'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            We were unable to process your recent payment for My Confessions Premium membership.
-        </p>
-        
-        <div style="background: #fee2e2; border: 2px solid #dc2626; border-radius: 8px; padding: 20px; margin: 20px 0;">
-            <h3 style="color: #dc2626; margin: 0 0 10px;">⚠️ Payment Failed</h3>
-            <p style="color: #991b1b; margin: 0;">
-                Your subscription will be cancelled if we cannot process payment within 7 days.
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">Please Update Your Payment Method:</h3>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org/app" 
-               style="background: #dc2626; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Update Payment Method
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px;">
-            If you have questions, please contact us at support@myconfessions.org
-        </p>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            In His service,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, '⚠️ Payment Failed - Update Your Payment Method', html)
+    html = email_templates.render('payment_failed.html', name=name)
+    return send_email(email, '⚠️ Payment Failed - Update Your Payment Method', html, template='payment_failed')
 
 def send_spiritual_followup_email(email, name, days_since_last, session_id=None):
     """Send follow-up email to encourage continued spiritual growth"""
@@ -375,60 +158,14 @@ def send_spiritual_followup_email(email, name, days_since_last, session_id=None)
         logger.info(f"Skipping follow-up email for {email} - user opted out of marketing emails")
         return False
     
-    # Different messages based on inactivity period
-    if days_since_last <= 7:
-        scripture = '"Come to me, all you who are weary and burdened, and I will give you rest." — Matthew 11:28'
-        message = "We noticed it's been a few days since your last conversation. How is your heart today?"
-    elif days_since_last <= 30:
-        scripture = '"The Lord is my shepherd, I lack nothing." — Psalm 23:1'
-        message = "It's been a while since we last connected. We're here whenever you need spiritual guidance."
-    else:
-        scripture = '"For I know the plans I have for you," declares the Lord, "plans to prosper you and not to harm you, plans to give you hope and a future." — Jeremiah 29:11'
-        message = "We miss you! Your spiritual journey is important to us. Come back anytime you need guidance."
-    
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">How Is Your Heart Today? 💙</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Beloved Friend'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            {message}
-        </p>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                {scripture}
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">Remember:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li>24/7 Biblical guidance is always available</li>
-            <li>Your conversations are private and secure</li>
-            <li>No struggle is too small to bring before God</li>
-        </ul>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Continue Your Journey
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Walking with you in faith,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    # Add unsubscribe link for marketing emails
-    if session_id:
-        content = add_unsubscribe_footer(content, session_id, 'marketing')
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, 'We Miss You - Your Spiritual Journey Awaits', html)
+    # The message and scripture depend on the inactivity period (see the template)
+    html = email_templates.render(
+        'spiritual_followup.html',
+        name=name,
+        days_since_last=days_since_last,
+        unsubscribe_link=get_unsubscribe_link(session_id, 'marketing') if session_id else None
+    )
+    return send_email(email, 'We Miss You - Your Spiritual Journey Awaits', html, template='spiritual_followup')
 
 def send_prayer_shared_notification(email, name, prayer_title, session_id=None):
     """Send notification when user's prayer receives engagement"""
@@ -437,77 +174,25 @@ def send_prayer_shared_notification(email, name, prayer_title, session_id=None):
         logger.info(f"Skipping prayer notification for {email} - user opted out of notifications")
         return False
     
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Your Prayer is Helping Others! 🙏</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Faithful Servant'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Your prayer "<strong>{prayer_title}</strong>" has been shared anonymously and is touching hearts in our community.
-        </p>
-        
-        <div style="background: #dcfce7; border-left: 4px solid #16a34a; padding: 15px; margin: 20px 0;">
-            <p style="color: #166534; margin: 0;">
-                <strong>✨ Your faith is inspiring others!</strong><br>
-                By sharing your prayer, you're helping fellow believers find strength and hope in God's word.
-            </p>
-        </div>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                "Let your light shine before others, that they may see your good deeds and glorify your Father in heaven."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 5px 0 0; text-align: right;">
-                — Matthew 5:16
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org/app" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                View Community Prayers
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            May your faith continue to bless others,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    # Add unsubscribe link for notifications
-    if session_id:
-        content = add_unsubscribe_footer(content, session_id, 'notifications')
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, '🙏 Your Prayer is Inspiring Others!', html)
+    html = email_templates.render(
+        'prayer_shared.html',
+        name=name,
+        prayer_title=prayer_title,
+        unsubscribe_link=get_unsubscribe_link(session_id, 'notifications') if session_id else None
+    )
+    return send_email(email, '🙏 Your Prayer is Inspiring Others!', html, template='prayer_shared')
 
 def get_unsubscribe_link(session_id, email_type='all'):
     """Generate unsubscribe link for emails"""
     return f"https://myconfessions.org/api/user/unsubscribe?session_id={session_id}&type={email_type}"
 
-def add_unsubscribe_footer(content, session_id, email_type='all'):
-    """Add unsubscribe link to email content"""
-    unsubscribe_link = get_unsubscribe_link(session_id, email_type)
-    return content + f'''
-        <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb; text-align: center;">
-            <p style="color: #9ca3af; font-size: 11px; margin: 0;">
-                Don't want to receive these emails? 
-                <a href="{unsubscribe_link}" style="color: #6b7280; text-decoration: underline;">Unsubscribe</a>
-            </p>
-        </div>
-    '''
-
 def check_email_preferences(session_id, email_type):
     """Check if user wants to receive this type of email"""
     if not db or not session_id:
         return True  # Default to sending if we can't check
     
     try:
-        user_ref = db.collection('users').document(session_id)
-        user_doc = user_ref.get()
+        user_doc = get_user_document(session_id)
         
         if user_doc.exists:
             user_data = user_doc.to_dict()
@@ -525,69 +210,12 @@ def send_free_tier_upgrade_reminder(email, name, session_id=None):
         logger.info(f"Skipping free tier reminder for {email} - user opted out of marketing emails")
         return False
     
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Continue Your Spiritual Growth 🌱</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Seeker of Truth'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            We've noticed you've been actively seeking Biblical guidance. That's wonderful! Your dedication to spiritual growth is inspiring.
-        </p>
-        
-        <div style="background: #fef3c7; border-left: 4px solid #f59e0b; padding: 15px; margin: 20px 0;">
-            <p style="color: #92400e; margin: 0;">
-                <strong>You've reached your free tier limit (20 conversations/month)</strong><br>
-                Continue your journey with unlimited access
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">Premium Benefits:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li>💬 <strong>Unlimited conversations</strong> - No monthly limits</li>
-            <li>📖 <strong>Community prayers</strong> - Read thousands of testimonies</li>
-            <li>💾 <strong>Journey saved</strong> - Never lose your spiritual progress</li>
-            <li>⚡ <strong>Priority support</strong> - Get help when you need it</li>
-        </ul>
-        
-        <div style="background: #dcfce7; border-radius: 8px; padding: 20px; margin: 20px 0; text-align: center;">
-            <p style="color: #166534; margin: 0 0 10px; font-size: 18px;">
-                <strong>Only $4.99/month</strong>
-            </p>
-            <p style="color: #166534; margin: 0; font-size: 14px;">
-                Or save 33% with annual plan ($39.99/year)
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org/app" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Upgrade to Premium
-            </a>
-        </div>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 15px; margin: 20px 0;">
-            <p style="color: #1e40af; font-style: italic; margin: 0;">
-                "Ask and it will be given to you; seek and you will find; knock and the door will be opened to you."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 5px 0 0; text-align: right;">
-                — Matthew 7:7
-            </p>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Your partner in spiritual growth,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    # Add unsubscribe link for marketing emails
-    if session_id:
-        content = add_unsubscribe_footer(content, session_id, 'marketing')
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, '🌱 Continue Your Spiritual Journey with Premium', html)
+    html = email_templates.render(
+        'free_tier_upgrade.html',
+        name=name,
+        unsubscribe_link=get_unsubscribe_link(session_id, 'marketing') if session_id else None
+    )
+    return send_email(email, '🌱 Continue Your Spiritual Journey with Premium', html, template='free_tier_upgrade')
 
 def send_weekly_spiritual_insight(email, name, session_id=None):
     """Send weekly spiritual insight/encouragement email"""
@@ -596,225 +224,487 @@ def send_weekly_spiritual_insight(email, name, session_id=None):
         logger.info(f"Skipping weekly insight for {email} - user opted out of insights")
         return False
     
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Weekly Spiritual Insight 📖</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Child of God'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            This week, we invite you to reflect on God's grace in your daily life.
-        </p>
-        
-        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 20px; margin: 25px 0;">
-            <h3 style="color: #1e40af; margin: 0 0 15px;">This Week's Reflection:</h3>
-            <p style="color: #1e40af; font-style: italic; margin: 0; font-size: 16px;">
-                "Be still, and know that I am God; I will be exalted among the nations, I will be exalted in the earth."
-            </p>
-            <p style="color: #1e40af; font-size: 12px; margin: 10px 0 0; text-align: right;">
-                — Psalm 46:10
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">Reflection Questions:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li>When do you find it hardest to "be still" in your daily life?</li>
-            <li>How can you create more space for God's presence this week?</li>
-            <li>What worries can you surrender to Him today?</li>
-        </ul>
-        
-        <div style="background: #fef3c7; border-left: 4px solid #f59e0b; padding: 15px; margin: 20px 0;">
-            <p style="color: #92400e; margin: 0;">
-                <strong>💡 This Week's Practice:</strong><br>
-                Take 5 minutes each morning to sit in silence with God. Let Him speak to your heart.
-            </p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Talk with Your Spiritual Guide
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Walking alongside you in faith,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    # Add unsubscribe link for insights
-    if session_id:
-        content = add_unsubscribe_footer(content, session_id, 'insights')
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, '📖 Weekly Spiritual Insight from My Confessions', html)
+    html = email_templates.render(
+        'weekly_insight.html',
+        name=name,
+        unsubscribe_link=get_unsubscribe_link(session_id, 'insights') if session_id else None
+    )
+    return send_email(email, '📖 Weekly Spiritual Insight from My Confessions', html, template='weekly_insight')
 
 def send_subscription_renewal_reminder(email, name, renewal_date, amount):
     """Send reminder before subscription renewal"""
-    content = f'''
-        <h2 style="color: #1e40af; margin-top: 0;">Your Subscription Renews Soon</h2>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            Dear {name or 'Valued Member'},
-        </p>
-        
-        <p style="color: #374151; line-height: 1.6;">
-            This is a friendly reminder that your My Confessions Premium membership will automatically renew on <strong>{renewal_date}</strong>.
-        </p>
-        
-        <div style="background: #eff6ff; border: 2px solid #3b82f6; border-radius: 8px; padding: 20px; margin: 20px 0; text-align: center;">
-            <h3 style="color: #1e40af; margin: 0 0 10px;">Upcoming Renewal</h3>
-            <p style="color: #1e40af; margin: 0; font-size: 24px; font-weight: bold;">
-                ${amount}
-            </p>
-            <p style="color: #6b7280; margin: 10px 0 0; font-size: 14px;">
-                {renewal_date}
-            </p>
-        </div>
-        
-        <h3 style="color: #1e40af; margin-top: 25px;">You'll Continue Enjoying:</h3>
-        <ul style="color: #374151; line-height: 1.8;">
-            <li>Unlimited Biblical guidance 24/7</li>
-            <li>Access to all community prayers</li>
-            <li>Your complete spiritual journey saved</li>
-            <li>Priority support from our ministry</li>
-        </ul>
-        
-        <p style="color: #374151; line-height: 1.6; margin-top: 25px;">
-            No action needed - your subscription will renew automatically. If you need to make changes, 
-            you can manage your subscription anytime.
-        </p>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="https://myconfessions.org/app" 
-               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
-                Manage Subscription
-            </a>
-        </div>
-        
-        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
-            Thank you for your continued partnership,<br>
-            <strong>My Confessions Ministry</strong>
-        </p>
-    '''
-    
-    html = EMAIL_BASE_TEMPLATE.format(content=content)
-    return send_email(email, f'Subscription Renewal Reminder - {renewal_date}', html)
+    html = email_templates.render('renewal_reminder.html', name=name, renewal_date=renewal_date, amount=amount)
+    return send_email(email, f'Subscription Renewal Reminder - {renewal_date}', html, template='renewal_reminder')
 
-# Initialize Firebase Admin SDK
-try:
+# Firebase Admin SDK: the credentials file is located now, the SDK is imported and the
+# client built on first use. The `if db` wiring below only sees that credentials exist;
+# if the build then fails, db turns falsy and the request-time `if not db` checks fall back
+def find_firebase_credentials():
     # Try multiple possible locations for credentials file
-    import os
     possible_paths = [
         "firebase-credentials.json",
         "/app/firebase-credentials.json",
         os.path.join(os.path.dirname(__file__), "firebase-credentials.json")
     ]
-    
-    cred_file = None
     for path in possible_paths:
         if os.path.exists(path):
-            cred_file = path
             logger.info(f"Found Firebase credentials at: {path}")
-            break
+            return path
+    logger.error("Firebase credentials file not found in any expected location")
+    logger.warning(f"Checked paths: {possible_paths}")
+    return None
+
+def create_firestore_client():
+    # Under gevent workers (gunicorn.conf.py) sockets are monkey-patched; switch gRPC,
+    # which Firestore uses, to cooperative polling so it doesn't block the whole worker
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('socket'):
+            from grpc.experimental import gevent as grpc_gevent
+            grpc_gevent.init_gevent()
+            logger.info("gRPC configured for gevent")
+    except ImportError:
+        pass
     
-    if cred_file:
-        cred = credentials.Certificate(cred_file)
-        firebase_admin.initialize_app(cred)
-        db = firestore.client()
+    try:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+        firebase_admin.initialize_app(credentials.Certificate(firebase_credentials_file))
+        client = firestore.client()
         logger.info("Firebase Firestore initialized successfully.")
-    else:
-        logger.error("Firebase credentials file not found in any expected location")
-        logger.warning(f"Checked paths: {possible_paths}")
-        db = None
-except Exception as e:
-    logger.error(f"Could not initialize Firebase Admin SDK: {e}")
-    logger.warning("Falling back to in-memory storage. THIS IS NOT SUITABLE FOR PRODUCTION.")
-    db = None
+        return client
+    except Exception as e:
+        logger.error(f"Could not initialize Firebase Admin SDK: {e}")
+        logger.warning("Falling back to in-memory storage. THIS IS NOT SUITABLE FOR PRODUCTION.")
+        return None
+
+firebase_credentials_file = find_firebase_credentials()
+db = LazyClient('Firestore', create_firestore_client) if firebase_credentials_file else None
+
+# Each request (and background job) reads a document at most once and batches independent
+# reads into one get_all (see firestore_loader.py)
+firestore_stats = FirestoreCallStats()
+
+@app.before_request
+def open_firestore_loader():
+    if db:
+        g.firestore_loader = DocumentLoader(db)
+
+@app.teardown_request
+def close_firestore_loader(exc=None):
+    loader = g.pop('firestore_loader', None)
+    if loader:
+        firestore_stats.record(request.endpoint or 'unknown', loader)
 
 # In-memory storage is now a fallback for local development without credentials.
 confessions = [] # This will only be used if Firestore fails to initialize.
-conversations = {}
 
-# Value-first user tracking system
-user_sessions = {}  # Track user subscription status (in-memory cache)
-conversation_depth = {}  # Track conversation engagement
-password_reset_tokens = {}  # Track password reset tokens {token: {email, expires}}
-from datetime import datetime, timedelta
+# Value-first user tracking system - bounded so anonymous visitors age out instead of leaking
+session_state = SessionStateStore(
+    max_bytes=int(os.getenv('SESSION_STATE_MAX_MB', '16')) * 1024 * 1024,
+    ttl_seconds=int(os.getenv('SESSION_TTL_SECONDS', str(7 * 24 * 3600)))
+)
+
+# Where tiers, counters and chat histories live. 'memory' is per worker process;
+# 'firestore' (or 'sqlite' locally) is shared by every worker and instance.
+state_backend = create_state_backend(os.getenv('STATE_BACKEND', 'memory'), session_state, db)
+logger.info(f"Using '{state_backend.name}' state backend")
+
+# Tier lookups are read-through: a miss loads one subscription document, nothing is loaded at startup
+tier_cache = TierCache(
+    state_backend.load_tier,
+    ttl_seconds=float(os.getenv('TIER_CACHE_TTL_SECONDS', '300')),
+    negative_ttl_seconds=float(os.getenv('TIER_CACHE_NEGATIVE_TTL_SECONDS', '30'))
+)
+
+# Free-tier usage per calendar month; increments are batched into the state backend
+usage_meter = UsageMeter(
+    state_backend,
+    flush_interval=float(os.getenv('USAGE_FLUSH_SECONDS', '10')),
+    refresh_seconds=float(os.getenv('USAGE_REFRESH_SECONDS', '60'))
+)
+atexit.register(usage_meter.flush)
+
+# Side effects that shouldn't hold up a response (emails, follow-up writes) run in the background
+job_queue = JobQueue(
+    max_pending=int(os.getenv('JOB_QUEUE_MAX_PENDING', '1000')),
+    workers=int(os.getenv('JOB_QUEUE_WORKERS', '2')),
+    max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', '5')),
+    spill_dir=os.getenv('JOB_SPILL_DIR', '/tmp/confessiones-jobs'),
+    job_context=lambda name: loader_scope(db, firestore_stats, f"job:{name}") if db else nullcontext()
+)
+atexit.register(job_queue.shutdown)
+
+# Chat histories are owned by the server; clients only send the new message and a conversation id
+conversation_store = ConversationStore(
+    state_backend,
+    max_bytes=int(os.getenv('CONVERSATION_STORE_MAX_MB', '64')) * 1024 * 1024,
+    ttl_seconds=int(os.getenv('CONVERSATION_TTL_SECONDS', str(24 * 3600)))
+)
+password_reset_tokens = BoundedStore(max_entries=10000, ttl_seconds=3600)  # {token: {email, expires}}
+from datetime import datetime, timedelta, timezone
 import calendar
 import json
 import secrets
 import time
 
+def get_user_document(session_id):
+    """users/{session_id}, read at most once per request or background job"""
+    return get_document(db.collection('users').document(session_id))
+
+def prefetch_session_documents(session_id, conversation_id=None):
+    """Load the tier, usage and conversation documents a request will need in one get_all"""
+    loader = current_loader()
+    if not loader:
+        return
+    loader.prefetch(state_backend.document_refs(
+        tier_session_id=None if tier_cache.cached(session_id) else session_id,
+        usage_key=None if usage_meter.cached(session_id) else (session_id, usage_window()),
+        conversation_id=conversation_id if conversation_id and conversation_store.reads_backend(conversation_id) else None
+    ))
+
 def get_user_tier(session_id):
     """Get user subscription tier: 'free' or 'unlimited'"""
-    return user_sessions.get(session_id, {}).get('tier', 'free')
+    return tier_cache.get(session_id)
 
 def get_conversation_depth(session_id):
-    """Get current conversation depth (number of messages)"""
-    return conversation_depth.get(session_id, 0)
+    """Get conversation depth (number of messages) in the current calendar month"""
+    return usage_meter.get(session_id)
 
 def increment_conversation_depth(session_id):
-    """Increment conversation depth counter"""
-    conversation_depth[session_id] = conversation_depth.get(session_id, 0) + 1
+    """Count a message against this month's quota and return the new depth"""
+    return usage_meter.record(session_id)
 
-def should_suggest_upgrade(session_id):
+def should_suggest_upgrade(session_id, tier=None, depth=None):
     """Suggest upgrade after 20 meaningful messages (value demonstration)"""
-    depth = get_conversation_depth(session_id)
-    tier = get_user_tier(session_id)
+    if depth is None:
+        depth = get_conversation_depth(session_id)
+    if tier is None:
+        tier = get_user_tier(session_id)
     
     # Suggest upgrade after 20 messages for free users
     return tier == 'free' and depth >= 20
 
 def set_user_tier(session_id, tier, customer_id=None, subscription_id=None):
     """Set user subscription tier (for testing and webhook handling)"""
-    if session_id not in user_sessions:
-        user_sessions[session_id] = {}
-    user_sessions[session_id]['tier'] = tier
-    user_sessions[session_id]['updated_at'] = datetime.now()
+    # This process serves the new tier right away; the durable write happens in the background
+    tier_cache.set(session_id, tier)
+    job_queue.enqueue('store_subscription', session_id=session_id, tier=tier,
+                      customer_id=customer_id, subscription_id=subscription_id)
+
+@job_queue.handler
+def store_subscription(session_id, tier, customer_id=None, subscription_id=None):
+    """Background job: persist a tier change (the backend also stores it in Firestore)"""
+    state_backend.set_tier(session_id, tier, customer_id, subscription_id)
+
+def find_user_account(session_id):
+    """Reference to the user's account document, if they registered one"""
+    users_ref = db.collection('users')
+    if get_user_document(session_id).exists:
+        return users_ref.document(session_id)
+    
+    # Check if this session_id corresponds to a registered user by email
+    # This handles cases where user registered but session_id doesn't match
+    users_query = users_ref.where('session_id', '==', session_id).limit(1).get()
+    if users_query:
+        return users_ref.document(users_query[0].id)
+    return None
+
+def subscription_account_updates(tier, customer_id=None, subscription_id=None):
+    updates = {'tier': tier, 'updated_at': datetime.now()}
     if customer_id:
-        user_sessions[session_id]['customer_id'] = customer_id
+        updates['customer_id'] = customer_id
     if subscription_id:
-        user_sessions[session_id]['subscription_id'] = subscription_id
+        updates['subscription_id'] = subscription_id
+    return updates
+
+@job_queue.handler
+def sync_user_account_tier(session_id, tier, customer_id=None, subscription_id=None):
+    """Background job: copy a subscription onto the user's account document, if they have one"""
+    # Kept for jobs spilled before activations were written as one batch (activate_subscription)
+    if not db:
+        return
+    user_ref = find_user_account(session_id)
+    if user_ref:
+        user_ref.update(subscription_account_updates(tier, customer_id, subscription_id))
+        forget_document(user_ref)
+        logger.info(f"Updated user account {user_ref.id} with subscription info")
+
+# Checkout sessions this process has activated: a reload of the success page skips Stripe
+processed_checkouts = BoundedStore(max_entries=10000, ttl_seconds=24 * 3600)
+
+def activate_subscription(session_id, tier, customer_id=None, subscription_id=None, checkout_session_id=None):
+    """Serve the new tier here right away and persist the activation as one batch in the background"""
+    tier_cache.set(session_id, tier)
+    job_queue.enqueue('store_subscription_activation', session_id=session_id, tier=tier,
+                      customer_id=customer_id, subscription_id=subscription_id,
+                      checkout_session_id=checkout_session_id)
+
+@job_queue.handler
+def store_subscription_activation(session_id, tier, customer_id=None, subscription_id=None, checkout_session_id=None,
+                                  stripe_event_created=None, subscription_fields=None):
+    """Background job: write the subscription, the user's account and the processed checkout in one batch
+
+    All three land together or not at all (the job is retried), and every write is
+    idempotent, so a checkout activated twice leaves the same state. Webhook events
+    also record their `created` time, so older events can't undo newer ones, and the
+    subscription's mirrored Stripe fields (see subscription_mirror.py).
+    """
+    if not db:
+        state_backend.set_tier(session_id, tier, customer_id, subscription_id)
+        return
     
-    # Also store in Firestore for persistence
-    try:
-        if db:
-            subscription_data = {
-                'tier': tier,
-                'session_id': session_id,
-                'updated_at': datetime.now(),
-                'created_at': user_sessions[session_id].get('created_at', datetime.now())
-            }
-            if customer_id:
-                subscription_data['customer_id'] = customer_id
-            if subscription_id:
-                subscription_data['subscription_id'] = subscription_id
-                
-            subscription_ref = db.collection('subscriptions').document(session_id)
-            subscription_ref.set(subscription_data)
-            logger.info(f"Stored subscription {tier} for session {session_id} in Firestore")
-    except Exception as e:
-        logger.error(f"Failed to store subscription in Firestore: {e}")
+    batch = db.batch()
+    state_backend.set_tier(session_id, tier, customer_id, subscription_id, batch=batch)
+    if stripe_event_created or subscription_fields:
+        mirrored = dict(subscription_fields or {})
+        if stripe_event_created:
+            mirrored['stripe_event_created'] = stripe_event_created
+        batch.set(db.collection('subscriptions').document(session_id), mirrored, merge=True)
+    user_ref = find_user_account(session_id)
+    if user_ref:
+        batch.update(user_ref, subscription_account_updates(tier, customer_id, subscription_id))
+    if checkout_session_id:
+        batch.set(db.collection('stripe_checkouts').document(checkout_session_id), {
+            'session_id': session_id,
+            'tier': tier,
+            'customer_id': customer_id,
+            'subscription_id': subscription_id,
+            'processed_at': datetime.now()
+        })
+    batch.commit()
+    if user_ref:
+        forget_document(user_ref)
+    logger.info(f"Activated {tier} for session {session_id}"
+                f"{' and user account ' + user_ref.id if user_ref else ''}")
+
+def processed_checkout(stripe_session_id):
+    """Activation already recorded for a Stripe checkout session, by this process or any other"""
+    activation = processed_checkouts.get(stripe_session_id)
+    if activation is None and db:
+        try:
+            snapshot = get_document(db.collection('stripe_checkouts').document(stripe_session_id))
+            if snapshot.exists:
+                data = snapshot.to_dict()
+                activation = {key: data.get(key) for key in ('session_id', 'tier', 'customer_id', 'subscription_id')}
+                # This instance may not have seen the upgrade yet
+                tier_cache.set(activation['session_id'], activation['tier'])
+                processed_checkouts[stripe_session_id] = activation
+        except Exception as e:
+            logger.error(f"Failed to read processed checkout {stripe_session_id}: {e}")
+    return activation
+
+# Sessions whose account got last_active_at stamped in the last day (per worker)
+recently_active = BoundedStore(max_entries=100000, ttl_seconds=24 * 3600)
+
+@job_queue.handler
+def record_user_activity(session_id):
+    """Background job: stamp last_active_at on a registered user's account (read by spiritual_followup)"""
+    if not db:
+        return
+    user_ref = find_user_account(session_id)
+    if user_ref:
+        user_ref.update({'last_active_at': datetime.now()})
+
+@job_queue.handler
+def send_free_tier_limit_reminder(session_id):
+    """Background job: email a registered free user who just reached the monthly limit"""
+    if not db:
+        return
+    
+    # check_email_preferences reads the same document - it comes from this job's loader
+    user_doc = get_user_document(session_id)
+    if not user_doc.exists:
+        return
+    user_data = user_doc.to_dict()
+    user_email = user_data.get('email')
+    if user_email:
+        # Not retried on a False result - that also means the user opted out
+        send_free_tier_upgrade_reminder(user_email, user_data.get('name', ''), session_id)
+        logger.info(f"Free tier upgrade reminder sent to {user_email}")
+
+# Campaigns read users a page at a time and send each page as one batched email (see campaign_runner.py)
+campaign_runner = CampaignRunner(
+    db,
+    email_templates,
+    email_outbox,
+    unsubscribe_link=get_unsubscribe_link,
+    page_size=int(os.getenv('CAMPAIGN_PAGE_SIZE', '500'))
+)
+campaign_runner.register('weekly_insight', 'weekly_insight.html',
+                         '📖 Weekly Spiritual Insight from My Confessions', preference='insights')
+
+def spiritual_followup_context(user):
+    """days_since_last for one follow-up recipient, from their last activity (or registration)"""
+    last_active = user.get('last_active_at') or user.get('created_at')
+    if not last_active:
+        return {}  # the campaign context's days_since_last applies
+    if isinstance(last_active, str):
+        last_active = datetime.fromisoformat(last_active)
+    if last_active.tzinfo is None:
+        last_active = last_active.replace(tzinfo=timezone.utc)
+    return {'days_since_last': max(0, (datetime.now(timezone.utc) - last_active).days)}
+
+campaign_runner.register('spiritual_followup', 'spiritual_followup.html',
+                         'We Miss You - Your Spiritual Journey Awaits', preference='marketing',
+                         recipient_context=spiritual_followup_context, fields=['last_active_at', 'created_at'])
+# prayer_shared is about one user's prayer - it is sent on its own (send_prayer_shared_notification), not as a campaign
+CAMPAIGN_MAX_OUTBOX_BACKLOG = int(os.getenv('CAMPAIGN_MAX_OUTBOX_BACKLOG', '5000'))
+
+def start_email_campaign(campaign_type, campaign_id, user_ids=None, context=None):
+    """Start (or resume) a campaign; campaign_id makes it run once, e.g. 'weekly_insight-2025-W43'"""
+    if not db:
+        logger.warning(f"Cannot run campaign {campaign_id} - Firestore not configured")
+        return False
+    created = campaign_runner.start(campaign_type, campaign_id, user_ids=user_ids, context=context)
+    # Resuming an existing campaign is safe - pages are claimed in its checkpoint before they're sent
+    job_queue.enqueue('run_email_campaign', campaign_id=campaign_id)
+    return created
+
+@job_queue.handler
+def run_email_campaign(campaign_id):
+    """Background job: queue one page of a campaign, then schedule the next"""
+    if email_outbox.backlog() >= CAMPAIGN_MAX_OUTBOX_BACKLOG:
+        # Let the outbox catch up before loading more recipients
+        job_queue.enqueue('run_email_campaign', delay=5, campaign_id=campaign_id)
+        return
+    if campaign_runner.run_page(campaign_id):
+        job_queue.enqueue('run_email_campaign', campaign_id=campaign_id)
+
+# Initialize Stripe (the SDK is imported on the first Stripe call)
+stripe_secret_key = os.getenv('STRIPE_SECRET_KEY')
+stripe_publishable_key = os.getenv('STRIPE_PUBLISHABLE_KEY')
 
-def load_user_subscriptions():
-    """Load user subscriptions from Firestore on startup"""
-    try:
-        if db:
-            subscriptions = db.collection('subscriptions').stream()
-            for sub in subscriptions:
-                data = sub.to_dict()
-                session_id = data.get('session_id', sub.id)
-                user_sessions[session_id] = {
-                    'tier': data.get('tier', 'free'),
-                    'updated_at': data.get('updated_at', datetime.now()),
-                    'created_at': data.get('created_at', datetime.now())
-                }
-            logger.info(f"Loaded {len(user_sessions)} subscriptions from Firestore")
-    except Exception as e:
-        logger.error(f"Failed to load subscriptions from Firestore: {e}")
+def configure_stripe(module):
+    module.api_key = stripe_secret_key
+
+stripe = LazyModule('stripe', setup=configure_stripe)
+if stripe_secret_key:
+    logger.info("Stripe API key found and configured")
+else:
+    logger.warning("No Stripe API key found")
+
+# ============================================================================
+# STRIPE WEBHOOKS
+# ============================================================================
+
+# Events are acknowledged once stored and processed by a job, in order per customer (see stripe_webhooks.py)
+stripe_webhook_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
+STRIPE_EVENT_SETTLE_SECONDS = float(os.getenv('STRIPE_EVENT_SETTLE_SECONDS', '2'))
+stripe_webhooks = StripeWebhookProcessor(
+    FirestoreEventStore(db) if db else InMemoryEventStore(),
+    stripe_webhook_secret,
+    # A short delay lets events Stripe sends together (checkout, subscription, invoice) be ordered as a group
+    schedule=lambda customer: job_queue.enqueue('process_stripe_events', delay=STRIPE_EVENT_SETTLE_SECONDS,
+                                                customer=customer)
+)
+
+@job_queue.handler
+def process_stripe_events(customer):
+    """Background job: run a Stripe customer's pending webhook events in order"""
+    stripe_webhooks.process_customer(customer)
+
+def session_for_customer(customer_id):
+    """Session id that a Stripe customer's subscription is stored under, or None"""
+    if not db or not customer_id:
+        return None
+    docs = db.collection('subscriptions').where('customer_id', '==', customer_id).limit(1).get()
+    return docs[0].id if docs else None
+
+def apply_subscription_event(event, session_id, tier, customer_id, subscription_id, checkout_session_id=None,
+                             subscription_fields=None):
+    """Store a tier change carried by a webhook event; False if a newer event was already applied"""
+    if db:
+        snapshot = get_document(db.collection('subscriptions').document(session_id))
+        applied_created = (snapshot.to_dict() or {}).get('stripe_event_created') if snapshot.exists else None
+        if applied_created and applied_created > event['created']:
+            logger.info(f"Skipping stale Stripe event {event['id']} ({event['type']}) for session {session_id}")
+            return False
+    tier_cache.set(session_id, tier)
+    store_subscription_activation(session_id, tier, customer_id, subscription_id,
+                                  checkout_session_id=checkout_session_id, stripe_event_created=event['created'],
+                                  subscription_fields=subscription_fields)
+    return True
+
+def notify_account_holder(session_id, send):
+    """Call send(email, name) for the user's account, if they registered one"""
+    if not db:
+        return
+    user_ref = find_user_account(session_id)
+    if user_ref:
+        user_data = get_document(user_ref).to_dict() or {}
+        if user_data.get('email'):
+            send(user_data['email'], user_data.get('name', ''))
+
+@stripe_webhooks.on('checkout.session.completed')
+def handle_checkout_completed(event):
+    checkout = event['data']['object']
+    if checkout.get('payment_status') != 'paid':
+        return
+    metadata = checkout.get('metadata') or {}
+    session_id = metadata.get('user_session_id', 'anonymous')
+    tier = metadata.get('tier', 'unlimited')
+    if apply_subscription_event(event, session_id, tier, checkout.get('customer'), checkout.get('subscription'),
+                                checkout_session_id=checkout['id']):
+        processed_checkouts[checkout['id']] = {'session_id': session_id, 'tier': tier,
+                                               'customer_id': checkout.get('customer'),
+                                               'subscription_id': checkout.get('subscription')}
+        logger.info(f"User {session_id} upgraded to {tier} via Stripe webhook {event['id']}")
+
+@stripe_webhooks.on('customer.subscription.created', 'customer.subscription.updated', 'customer.subscription.deleted')
+def handle_subscription_changed(event):
+    subscription = event['data']['object']
+    session_id = (subscription.get('metadata') or {}).get('user_session_id') or session_for_customer(subscription.get('customer'))
+    if not session_id:
+        logger.warning(f"Stripe event {event['id']}: no session for customer {subscription.get('customer')}")
+        return
+    cancelled = event['type'] == 'customer.subscription.deleted'
+    tier = 'free' if cancelled else tier_for(subscription)
+    if apply_subscription_event(event, session_id, tier, subscription.get('customer'), subscription.get('id'),
+                                subscription_fields=mirror_record(subscription)):
+        logger.info(f"Subscription {subscription.get('id')} is {subscription.get('status')}: session {session_id} is now {tier}")
+        if cancelled:
+            notify_account_holder(session_id, send_subscription_cancelled_email)
+
+@stripe_webhooks.on('invoice.payment_failed')
+def handle_payment_failed(event):
+    invoice = event['data']['object']
+    session_id = session_for_customer(invoice.get('customer'))
+    if session_id:
+        notify_account_holder(session_id, send_payment_failed_email)
+        logger.info(f"Payment failed for invoice {invoice.get('id')} (session {session_id})")
+
+# Plan, status and renewal date are mirrored on subscriptions/{session_id}; pages and reminders read the mirror
+subscription_mirror = SubscriptionMirror(
+    db, stripe, portal_cache_seconds=int(os.getenv('BILLING_PORTAL_CACHE_SECONDS', '60'))
+) if db else None
+RENEWAL_REMINDER_DAYS = int(os.getenv('RENEWAL_REMINDER_DAYS', '7'))
+RENEWAL_REMINDER_PLANS = set(os.getenv('RENEWAL_REMINDER_PLANS', 'annual').split(','))
+
+@job_queue.handler
+def reconcile_subscriptions():
+    """Background job: correct mirrored subscriptions that drifted from Stripe (missed or failed events)"""
+    def apply(session_id, tier, subscription, record, applied_at):
+        logger.warning(f"Subscription {subscription['id']} drifted from Stripe: session {session_id} is now "
+                       f"{tier} ({record['status']})")
+        tier_cache.set(session_id, tier)
+        store_subscription_activation(session_id, tier, subscription.get('customer'), subscription['id'],
+                                      stripe_event_created=applied_at, subscription_fields=record)
+    subscription_mirror.reconcile(apply)
+
+@job_queue.handler
+def send_renewal_reminders():
+    """Background job: remind subscribers whose plan renews soon, once per billing period"""
+    for session_id, subscription in subscription_mirror.due_renewals(RENEWAL_REMINDER_DAYS, RENEWAL_REMINDER_PLANS):
+        renewal_date = subscription['current_period_end'].strftime('%B %d, %Y')
+        amount = f"${subscription['amount'] / 100:.2f}" if subscription.get('amount') is not None else ''
+        notify_account_holder(session_id, lambda email, name: send_subscription_renewal_reminder(
+            email, name, renewal_date, amount))
+        subscription_mirror.mark_reminded(session_id, subscription['current_period_end'])
+
+# Handlers are registered - start the workers and pick up jobs spilled by a previous process
+job_queue.start()
+startup_timer.mark('services')
 
 def get_subscription_from_stripe_session(stripe_session_id):
     """Get subscription details from Stripe session"""
@@ -839,18 +729,18 @@ else:
     logger.warning("No valid OpenAI API key found")
     openai_api_key = None
 
-# Initialize Stripe
-stripe_secret_key = os.getenv('STRIPE_SECRET_KEY')
-stripe_publishable_key = os.getenv('STRIPE_PUBLISHABLE_KEY')
-
-if stripe_secret_key:
-    try:
-        stripe.api_key = stripe_secret_key
-        logger.info("Stripe API key found and configured")
-    except Exception as e:
-        logger.error(f"Stripe initialization error: {e}")
-else:
-    logger.warning("No Stripe API key found")
+# Shared upstream client: one keep-alive pool and circuit breaker per process
+openai_client = OpenAIClient(
+    openai_api_key,
+    base_url=os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1'),
+    pool_size=int(os.getenv('OPENAI_POOL_SIZE', '20')),
+    max_concurrency=int(os.getenv('OPENAI_MAX_CONCURRENCY', '20')),
+    max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '2')),
+    breaker=CircuitBreaker(
+        failure_threshold=int(os.getenv('OPENAI_BREAKER_THRESHOLD', '5')),
+        reset_timeout=float(os.getenv('OPENAI_BREAKER_RESET_SECONDS', '30'))
+    )
+) if openai_api_key else None
 
 # Christian Spiritual Counselor Prompts
 CONFESSION_INITIAL_PROMPT = """You are a wise and compassionate Biblical counselor and spiritual guide.
@@ -906,6 +796,16 @@ Title: [simple title]
 Prayer: [natural, authentic confession]
 """
 
+CONVERSATION_ROLLING_SUMMARY_PROMPT = """You keep running notes for a Biblical counselor during a long, private conversation.
+
+Update the summary with the new turns. Keep:
+- What the person is struggling with and how they feel
+- Scripture that was already shared (so it is not repeated)
+- Any guidance or commitments made
+
+Write in third person, under 80 words. Output only the summary.
+"""
+
 @app.route('/')
 def index_redirect():
     """Serve the landing page"""
@@ -949,76 +849,28 @@ def subscription_success():
     stripe_session_id = request.args.get('session_id')
     user_session = request.args.get('user_session', 'anonymous')
     
-    # Get subscription details from Stripe
-    subscription_data = get_subscription_from_stripe_session(stripe_session_id)
+    # Reloads of an activated checkout are answered without Stripe or a second activation
+    activation = processed_checkout(stripe_session_id) if stripe_session_id else None
+    if activation is None:
+        # Get subscription details from Stripe
+        activation = get_subscription_from_stripe_session(stripe_session_id)
+        if activation:
+            # Upgrade user based on actual Stripe data
+            activate_subscription(activation['session_id'], activation['tier'], activation.get('customer_id'),
+                                  activation.get('subscription_id'), checkout_session_id=stripe_session_id)
+            processed_checkouts[stripe_session_id] = activation
+            logger.info(f"User {activation['session_id']} upgraded to {activation['tier']} "
+                        f"via Stripe session {stripe_session_id}")
     
-    if subscription_data:
-        # Upgrade user based on actual Stripe data
-        session_id = subscription_data['session_id']
-        tier = subscription_data['tier']
-        customer_id = subscription_data.get('customer_id')
-        subscription_id = subscription_data.get('subscription_id')
-        
-        set_user_tier(session_id, tier, customer_id, subscription_id)
-        
-        # Also update the user's account in the users collection if it exists
-        if db:
-            try:
-                user_ref = db.collection('users').document(session_id)
-                user_doc = user_ref.get()
-                
-                if user_doc.exists:
-                    # Update existing user account with subscription info
-                    user_ref.update({
-                        'tier': tier,
-                        'customer_id': customer_id,
-                        'subscription_id': subscription_id,
-                        'updated_at': datetime.now()
-                    })
-                    logger.info(f"Updated user account {session_id} with subscription info")
-                else:
-                    # Check if this session_id corresponds to a registered user by email
-                    # This handles cases where user registered but session_id doesn't match
-                    users_ref = db.collection('users')
-                    users_query = users_ref.where('session_id', '==', session_id).limit(1).get()
-                    
-                    if users_query:
-                        user_ref = users_ref.document(users_query[0].id)
-                        user_ref.update({
-                            'tier': tier,
-                            'customer_id': customer_id,
-                            'subscription_id': subscription_id,
-                            'updated_at': datetime.now()
-                        })
-                        logger.info(f"Updated user account {users_query[0].id} with subscription info")
-            except Exception as e:
-                logger.error(f"Failed to update user account: {e}")
-        
-        logger.info(f"User {session_id} upgraded to {tier} via Stripe session {stripe_session_id}")
-        
+    if activation:
         return render_template('subscription-success.html', 
-                             tier=tier, 
-                             session_id=session_id,
-                             subscription_id=subscription_id,
-                             customer_id=customer_id)
+                             tier=activation['tier'], 
+                             session_id=activation['session_id'],
+                             subscription_id=activation.get('subscription_id'),
+                             customer_id=activation.get('customer_id'))
     else:
         # Fallback: upgrade the user session from URL parameter
-        set_user_tier(user_session, 'unlimited')
-        
-        # Also update user account if it exists
-        if db:
-            try:
-                user_ref = db.collection('users').document(user_session)
-                user_doc = user_ref.get()
-                
-                if user_doc.exists:
-                    user_ref.update({
-                        'tier': 'unlimited',
-                        'updated_at': datetime.now()
-                    })
-                    logger.info(f"Updated user account {user_session} with unlimited tier (fallback)")
-            except Exception as e:
-                logger.error(f"Failed to update user account (fallback): {e}")
+        activate_subscription(user_session, 'unlimited')
         
         logger.info(f"User {user_session} upgraded to unlimited (fallback)")
         
@@ -1033,10 +885,15 @@ def subscription_cancel():
 def get_user_tier_api():
     """Get current user tier and usage"""
     session_id = request.args.get('session_id', 'anonymous')
+    prefetch_session_documents(session_id)
+    tier = get_user_tier(session_id)
+    window = usage_window()
     return jsonify({
-        'tier': get_user_tier(session_id),
+        'tier': tier,
         'conversation_depth': get_conversation_depth(session_id),
-        'limit': 999 if get_user_tier(session_id) == 'unlimited' else 20
+        'limit': 999 if tier == 'unlimited' else 20,
+        'usage_period': window,
+        'usage_resets_at': window_resets_at(window).isoformat()
     })
 
 @app.route('/api/user/tier', methods=['POST'])
@@ -1111,9 +968,19 @@ def create_checkout_session():
                     'plan': plan,  # 'monthly' or 'annual'
                     'source': 'myconfessions_unlimited'
                 },
+                # Copied onto the subscription, so its webhook events carry the session too
+                subscription_data={
+                    'metadata': {
+                        'tier': 'unlimited',
+                        'user_session_id': session_id,
+                        'plan': plan
+                    }
+                },
                 allow_promotion_codes=True,
             )
             logger.info(f"Stripe checkout session created: {checkout_session.id}")
+            # The tier is about to change - don't keep serving a cached 'free' for this session
+            tier_cache.invalidate(session_id)
         except Exception as stripe_error:
             logger.error(f"Stripe checkout error: {stripe_error}")
             return jsonify({'error': 'Unable to create payment session'}), 500
@@ -1131,127 +998,676 @@ def get_stripe_config():
         'publishable_key': stripe_publishable_key
     })
 
+def summarize_conversation_turns(previous_summary, turns):
+    """Fold older chat turns into the running conversation summary"""
+    transcript = '\n'.join(f"{turn.get('role', 'user')}: {turn.get('content', '')}" for turn in turns)
+    if previous_summary:
+        content = f"Summary so far:\n{previous_summary}\n\nNew turns:\n{transcript}"
+    else:
+        content = transcript
+    
+    result = openai_client.chat_completion({
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {"role": "system", "content": CONVERSATION_ROLLING_SUMMARY_PROMPT},
+            {"role": "user", "content": content}
+        ],
+        "max_tokens": 150,
+        "temperature": 0.3
+    })
+    return result['choices'][0]['message']['content'].strip()
+
+# Prompt context is bounded by tokens, not by message count
+context_builder = ContextBuilder(
+    budget_tokens=int(os.getenv('CHAT_CONTEXT_TOKEN_BUDGET', '1500')),
+    summarize=summarize_conversation_turns
+)
+
+def build_chat_messages(conversation_id, message, conversation_history):
+    """Build the OpenAI message list for a chat turn"""
+    # Decide which system prompt to use based on whether we already have conversation history
+    if conversation_history:
+        system_prompt = CONFESSION_FOLLOWUP_PROMPT
+    else:
+        system_prompt = CONFESSION_INITIAL_PROMPT
+
+    # Recent turns fill the token budget; older ones are folded into a cached rolling summary
+    messages, summary_state = context_builder.build(
+        system_prompt,
+        conversation_history,
+        message,
+        conversation_store.get_summary(conversation_id)
+    )
+    conversation_store.set_summary(conversation_id, *summary_state)
+    return messages
+
+def build_chat_payload(messages):
+    """OpenAI chat completion request body for a chat turn"""
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": messages,
+        "max_tokens": 120,
+        "temperature": 0.7
+    }
+
+def request_chat_reply(payload):
+    """Run a non-streaming chat completion and return the reply text"""
+    result = openai_client.chat_completion(payload)
+    return result['choices'][0]['message']['content'].strip()
+
+def replay_cached_reply(reply):
+    """Send a cached reply through the same SSE path as a live completion"""
+    yield reply
+
+# Opening messages are few and repetitive ("I feel anxious") - serve them from a small reply cache
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '2000')),
+    ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', str(6 * 3600))),
+    variants=int(os.getenv('RESPONSE_CACHE_VARIANTS', '5'))
+)
+
+def format_sse(event, data):
+    """Format a single Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def open_conversation(session_id, conversation_id, legacy_history):
+    """Return (conversation_id, history) for a chat turn, starting a new conversation if needed"""
+    if conversation_id:
+        history = conversation_store.get_messages(conversation_id, session_id)
+        if history is not None:
+            return conversation_id, history
+    
+    # Unknown or expired conversation. Older clients still upload their history,
+    # so seed the new conversation with it once.
+    conversation_id = conversation_store.create(session_id)
+    history = [
+        {'role': msg.get('role', 'user'), 'content': msg.get('content', '')}
+        for msg in legacy_history
+    ]
+    if history:
+        conversation_store.append(conversation_id, session_id, history)
+    return conversation_id, history
+
+def complete_chat_turn(session_id, conversation_id, message, ai_response):
+    """Record a finished chat turn and return the tier/upgrade fields for the client"""
+    # Read tier once per turn - with a shared state backend every read is a round trip
+    tier = get_user_tier(session_id)
+    
+    # Append to the server-side history; premium journeys are saved to Firestore too
+    conversation_store.append(conversation_id, session_id, [
+        {'role': 'user', 'content': message, 'timestamp': datetime.now().isoformat()},
+        {'role': 'assistant', 'content': ai_response, 'timestamp': datetime.now().isoformat()}
+    ], persist=tier == 'unlimited')
+    
+    # INCREMENT CONVERSATION DEPTH
+    current_depth = increment_conversation_depth(session_id)
+    
+    # At most one activity write per session and day - the follow-up campaign measures inactivity from it
+    if db and session_id not in recently_active:
+        recently_active[session_id] = True
+        job_queue.enqueue('record_user_activity', session_id=session_id)
+    
+    # CHECK IF WE SHOULD SUGGEST UPGRADE (value-first approach)
+    suggest_upgrade = should_suggest_upgrade(session_id, tier, current_depth)
+    
+    # Send upgrade reminder email when user hits limit (once per month)
+    if current_depth == 20 and tier == 'free':
+        # Get user email if they're registered - in the background, off the chat reply path
+        job_queue.enqueue('send_free_tier_limit_reminder', session_id=session_id)
+    
+    return {
+        'session_id': session_id,
+        'conversation_id': conversation_id,
+        'timestamp': datetime.now().isoformat(),
+        'tier': tier,
+        'conversation_depth': current_depth,
+        'suggest_upgrade': suggest_upgrade,  # NEW: Suggest upgrade instead of blocking
+        'upgrade_message': {
+            'title': 'Continue Your Spiritual Journey',
+            'message': 'I sense you\'re seeking deeper guidance. Many souls like you find unlimited spiritual support helps them grow closer to God.',
+            'cta': 'Continue with Unlimited Guidance - $4.99/month'
+        } if suggest_upgrade else None
+    }
+
+def stream_chat_events(chat_stream, session_id, conversation_id, message, cache_key=None):
+    """Relay OpenAI tokens to the browser as SSE, then send the turn metadata as a final event"""
+    tokens = []
+    try:
+        for content in chat_stream:
+            tokens.append(content)
+            yield format_sse('token', {'content': content})
+    except Exception as e:
+        logger.error(f"OpenAI streaming error: {e}")
+        yield format_sse('error', {'error': 'Sorry, I cannot connect to the AI system right now. Please try again later.'})
+        return
+    finally:
+        chat_stream.close()
+    
+    ai_response = ''.join(tokens).strip()
+    if cache_key:
+        response_cache.put(cache_key, ai_response)
+    try:
+        turn = complete_chat_turn(session_id, conversation_id, message, ai_response)
+    except Exception as e:
+        logger.error(f"Error processing chat message: {e}")
+        yield format_sse('error', {'error': 'Sorry, something went wrong. Please try again.'})
+        return
+    
+    yield format_sse('done', {'success': True, 'response': ai_response, **turn})
+
 @app.route('/api/chat/message', methods=['POST'])
 def process_chat_message():
     """Handle chat messages for confession guidance"""
     try:
         data = request.get_json()
         message = data.get('message', '')
-        session_id = data.get('session_id', 'anonymous')
-        conversation_history = data.get('conversation_history', [])
+        # Clients without a session id get their own instead of all sharing 'anonymous'
+        session_id = data.get('session_id') or f"anonymous_{secrets.token_urlsafe(9)}"
+        conversation_id = data.get('conversation_id')
+        # Streaming is opt-in so existing JSON clients keep working
+        stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
         
         if not message:
             return jsonify({'error': 'Message is required'}), 400
+        # Too long for the prompt budget - tell the user instead of dropping the end of it
+        try:
+            context_builder.check_message(message)
+        except MessageTooLong as e:
+            return jsonify({
+                'error': f"Your message is too long - please keep it under {e.max_chars} characters.",
+                'max_characters': e.max_chars
+            }), 413
         
         logger.info(f"Processing confession chat for session {session_id}")
         
         # Generate AI response - ONLY use real AI, no fallbacks
-        if not openai_api_key:
+        if not openai_client:
             return jsonify({'error': 'AI service is not available. Please try again later.'}), 503
         
+        # Conversation, tier and usage documents in one round trip instead of three
+        prefetch_session_documents(session_id, conversation_id)
+        conversation_id, conversation_history = open_conversation(
+            session_id, conversation_id, data.get('conversation_history', []))
+        
         try:
-            # Decide which system prompt to use based on whether we already have conversation history
-            if conversation_history:
-                system_prompt = CONFESSION_FOLLOWUP_PROMPT
-            else:
-                system_prompt = CONFESSION_INITIAL_PROMPT
-
-            # Build conversation context
-            messages = [{"role": "system", "content": system_prompt}]
-
-            # Add conversation history (unlimited for all users - we want to show value)
-            recent_history = conversation_history[-10:] if len(conversation_history) > 10 else conversation_history
-                
-            for msg in recent_history:
-                messages.append({
-                    "role": msg.get('role', 'user'),
-                    "content": msg.get('content', '')
-                })
-            
-            # Add current message
-            messages.append({"role": "user", "content": message})
-                
-            # Make direct API call
-            headers = {
-                "Authorization": f"Bearer {openai_api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": messages,
-                "max_tokens": 120,
-                "temperature": 0.7
-            }
+            messages = build_chat_messages(conversation_id, message, conversation_history)
+            payload = build_chat_payload(messages)
+            # Only opening turns are cacheable; later prompts carry the user's own history
+            cache_key = None if conversation_history else response_cache.make_key(messages)
             
-            response = requests.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            if stream:
+                cached_reply = response_cache.get(cache_key) if cache_key else None
+                if cached_reply:
+                    chat_stream, cache_key = replay_cached_reply(cached_reply), None
+                else:
+                    # Connection and status are checked before streaming starts, so upstream
+                    # failures still surface as a regular JSON error to the client
+                    chat_stream = openai_client.stream_chat_completion(payload)
+                response = Response(
+                    stream_with_context(stream_chat_events(chat_stream, session_id, conversation_id, message, cache_key)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+                # A generator closed before its first chunk never runs its finally - if the client
+                # disconnects that early, this is what hands the upstream slot back
+                response.call_on_close(chat_stream.close)
+                return response
             
-            if response.status_code == 200:
-                result = response.json()
-                ai_response = result['choices'][0]['message']['content'].strip()
+            if cache_key:
+                ai_response = response_cache.get_or_compute(cache_key, lambda: request_chat_reply(payload))
             else:
-                logger.error(f"OpenAI API error: {response.status_code} - {response.text}")
-                return jsonify({'error': 'Sorry, I cannot connect to the AI system right now. Please try again later.'}), 500
+                ai_response = request_chat_reply(payload)
                 
+        except UpstreamUnavailable as e:
+            # Fail fast while OpenAI is unhealthy instead of pinning a worker on a doomed call
+            logger.warning(f"OpenAI unavailable: {e}")
+            return jsonify({'error': 'AI service is not available. Please try again later.'}), 503
+        except UpstreamError as e:
+            logger.error(f"OpenAI API error: {e.status_code} - {e.body}")
+            return jsonify({'error': 'Sorry, I cannot connect to the AI system right now. Please try again later.'}), 500
         except Exception as e:
             logger.error(f"OpenAI API error: {e}")
             return jsonify({'error': 'Sorry, I cannot connect to the AI system right now. Please try again later.'}), 500
         
-        # Store conversation in memory
-        if session_id not in conversations:
-            conversations[session_id] = []
-        
-        conversations[session_id].extend([
-            {'role': 'user', 'content': message, 'timestamp': datetime.now().isoformat()},
-            {'role': 'assistant', 'content': ai_response, 'timestamp': datetime.now().isoformat()}
-        ])
-        
-        # INCREMENT CONVERSATION DEPTH
-        increment_conversation_depth(session_id)
-        
-        # CHECK IF WE SHOULD SUGGEST UPGRADE (value-first approach)
-        suggest_upgrade = should_suggest_upgrade(session_id)
-        
-        # Send upgrade reminder email when user hits limit (only once)
-        current_depth = get_conversation_depth(session_id)
-        if current_depth == 20 and get_user_tier(session_id) == 'free':
-            # Get user email if they're registered
-            if db:
-                try:
-                    user_ref = db.collection('users').document(session_id)
-                    user_doc = user_ref.get()
-                    if user_doc.exists:
-                        user_data = user_doc.to_dict()
-                        user_email = user_data.get('email')
-                        user_name = user_data.get('name', '')
-                        
-                        if user_email:
-                            send_free_tier_upgrade_reminder(user_email, user_name, session_id)
-                            logger.info(f"Free tier upgrade reminder sent to {user_email}")
-                except Exception as e:
-                    logger.error(f"Failed to send upgrade reminder: {e}")
-        
         return jsonify({
             'success': True,
             'response': ai_response,
-            'timestamp': datetime.now().isoformat(),
-            'tier': get_user_tier(session_id),
-            'conversation_depth': get_conversation_depth(session_id),
-            'suggest_upgrade': suggest_upgrade,  # NEW: Suggest upgrade instead of blocking
-            'upgrade_message': {
-                'title': 'Continue Your Spiritual Journey',
-                'message': 'I sense you\'re seeking deeper guidance. Many souls like you find unlimited spiritual support helps them grow closer to God.',
-                'cta': 'Continue with Unlimited Guidance - $4.99/month'
-            } if suggest_upgrade else None
+            **complete_chat_turn(session_id, conversation_id, message, ai_response)
         })
         
     except Exception as e:
         logger.error(f"Error processing chat message: {e}")
         return jsonify({'error': 'Sorry, something went wrong. Please try again.'}), 500
 
+@app.route('/api/chat/conversations/<conversation_id>', methods=['GET'])
+def get_conversation(conversation_id):
+    """Return a conversation's history to the session that owns it (restores saved journeys)"""
+    session_id = request.args.get('session_id', 'anonymous')
+    history = conversation_store.get_messages(conversation_id, session_id)
+    if history is None:
+        return jsonify({'error': 'Conversation not found'}), 404
+    
+    return jsonify({
+        'success': True,
+        'conversation_id': conversation_id,
+        'messages': [{'role': msg['role'], 'content': msg['content']} for msg in history]
+    })
+
+# ============================================================================
+# COMMUNITY FEED
+# ============================================================================
+
+# Upvotes are counted in memory and written behind as Increment batches (see upvote_counter.py)
+upvote_counter = UpvoteCounter(
+    db,
+    flush_interval=float(os.getenv('UPVOTE_FLUSH_SECONDS', '10')),
+    spill_dir=os.getenv('JOB_SPILL_DIR', '/tmp/confessiones-jobs')
+) if db else None
+if upvote_counter:
+    atexit.register(upvote_counter.shutdown)
+
+# Readers are served from per-sort snapshots refreshed in the background (see confession_feed.py)
+confession_feed = ConfessionFeed(
+    db,
+    page_size=int(os.getenv('FEED_PAGE_SIZE', '20')),
+    snapshot_size=int(os.getenv('FEED_SNAPSHOT_SIZE', '100')),
+    refresh_seconds=int(os.getenv('FEED_REFRESH_SECONDS', '30')),
+    max_stale_seconds=int(os.getenv('FEED_MAX_STALE_SECONDS', '300')),
+    # Counts include upvotes that aren't written yet
+    overlay=upvote_counter.deltas if upvote_counter else None
+) if db else None
+
+# ?sort=trending: time-decayed hot scores fed by upvotes and shared prayers (see trending_ranking.py)
+trending_ranking = TrendingRanking(
+    db,
+    size=int(os.getenv('TRENDING_SIZE', '50')),
+    half_life_seconds=float(os.getenv('TRENDING_HALF_LIFE_HOURS', '24')) * 3600,
+    persist_seconds=float(os.getenv('TRENDING_PERSIST_SECONDS', '60'))
+) if db else None
+if trending_ranking:
+    atexit.register(trending_ranking.shutdown)
+
+# BM25 search over public prayers, started from a snapshot of the analyzed index (see search_index.py)
+def create_search_snapshot_store():
+    bucket = os.getenv('SEARCH_SNAPSHOT_BUCKET', os.getenv('FIREBASE_STORAGE_BUCKET'))
+    if bucket:
+        return StorageSnapshotStore(bucket)
+    return FileSnapshotStore(os.getenv('SEARCH_SNAPSHOT_PATH', '/tmp/confessiones-search/confessions-index.json.gz'))
+
+search_index = SearchIndex(
+    db,
+    store=create_search_snapshot_store(),
+    catchup_seconds=float(os.getenv('SEARCH_CATCHUP_SECONDS', '60'))
+) if db else None
+
+# "Prayers like yours": TF-IDF cosine similarity over the search index's prayers (see related_prayers.py)
+related_prayers = RelatedPrayers(
+    search_index,
+    cache_seconds=int(os.getenv('RELATED_CACHE_SECONDS', '600'))
+) if search_index else None
+
+@app.route('/api/confessions', methods=['GET'])
+def list_confessions():
+    """Public prayer feed: a JSON list, with the next page's cursor in X-Next-Cursor"""
+    if not confession_feed or not db:
+        return jsonify([])
+    
+    sort = request.args.get('sort', DEFAULT_SORT)
+    limit = request.args.get('limit', type=int)
+    try:
+        if sort == 'trending':
+            # One page: the trending view is the top TRENDING_SIZE prayers
+            items, etag = trending_ranking.page(limit)
+            next_cursor = None
+        else:
+            items, next_cursor, etag = confession_feed.page(sort, cursor=request.args.get('cursor'), limit=limit)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error loading the prayer feed: {e}")
+        return jsonify({'error': 'The prayer feed is unavailable right now'}), 503
+    
+    # Most readers revalidate a page they already have - answer those without a body
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(items)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.route('/api/confessions/search', methods=['GET'])
+def search_confessions():
+    """Search public prayers: a JSON list of feed items, best match first"""
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({'error': 'q is required'}), 400
+    if not search_index or not db:
+        return jsonify([])
+    
+    try:
+        results = search_index.search(query[:200], limit=max(1, min(request.args.get('limit', 20, type=int), 50)))
+    except Exception as e:
+        logger.error(f"Error searching prayers for '{query}': {e}")
+        return jsonify({'error': 'Search is unavailable right now'}), 503
+    return jsonify(results)
+
+@app.route('/api/confessions/<confession_id>/related', methods=['GET'])
+def related_confessions(confession_id):
+    """Public prayers similar to a prayer: a JSON list of feed items, most similar first"""
+    if not related_prayers or not db:
+        return jsonify([])
+    limit = max(1, min(request.args.get('limit', 5, type=int), 20))
+    
+    try:
+        results = related_prayers.related(confession_id, limit)
+        if results is None:
+            # Not in the search index: a private prayer, or one shared too recently to be caught up
+            snapshot = get_document(db.collection('confessions').document(confession_id))
+            if not snapshot.exists:
+                return jsonify({'error': 'Prayer not found'}), 404
+            stored = snapshot.to_dict() or {}
+            results = related_prayers.related(confession_id, limit, title=stored.get('title'), text=stored.get('text'))
+    except Exception as e:
+        logger.error(f"Error finding prayers related to {confession_id}: {e}")
+        return jsonify({'error': 'Related prayers are unavailable right now'}), 503
+    return jsonify(results)
+
+@app.route('/api/confessions/<confession_id>/upvote', methods=['POST'])
+def upvote_confession(confession_id):
+    """Upvote a public confession, once per session"""
+    if not upvote_counter or not db:
+        return jsonify({'error': 'Upvotes are not available'}), 503
+    
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id')
+    if not session_id:
+        return jsonify({'error': 'session_id is required'}), 400
+    
+    try:
+        counted = upvote_counter.vote(confession_id, session_id)
+    except UnknownConfession:
+        return jsonify({'error': 'Prayer not found'}), 404
+    except Exception as e:
+        logger.error(f"Error upvoting confession {confession_id}: {e}")
+        return jsonify({'error': 'Unable to record your upvote'}), 500
+    
+    # vote() just read the confession through this request's loader, so this costs nothing
+    item = feed_item(get_document(db.collection('confessions').document(confession_id)))
+    item['upvotes'] += upvote_counter.deltas().get(confession_id, 0)
+    if counted and trending_ranking:
+        trending_ranking.record_upvote(confession_id, item)
+    return jsonify({'success': True, 'counted': counted, 'upvotes': item['upvotes']})
+
+@app.route('/api/confessions/save', methods=['POST'])
+def save_confession():
+    """Save the prayer written in the review step, privately or shared with the community"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Saving prayers is not available right now'}), 503
+    
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session_id')
+    title = (data.get('title') or '').strip()
+    text = (data.get('confession_text') or '').strip()
+    if not session_id or not text:
+        return jsonify({'success': False, 'error': 'session_id and confession_text are required'}), 400
+    is_public = bool(data.get('is_public'))
+    
+    confession_ref = db.collection('confessions').document()
+    created_at = datetime.now()
+    try:
+        confession_ref.set({
+            'session_id': session_id,
+            'title': title,
+            'text': text,
+            'is_public': is_public,
+            'upvotes': 0,
+            'created_at': created_at
+        })
+    except Exception as e:
+        logger.error(f"Error saving confession for {session_id}: {e}")
+        return jsonify({'success': False, 'error': 'Could not save your prayer'}), 500
+    
+    item = {'id': confession_ref.id, 'title': title, 'text': text, 'created_at': created_at.isoformat(), 'upvotes': 0}
+    if is_public:
+        # Shown on the next read of the latest feed; new prayers start with some trending weight
+        confession_feed.invalidate('latest')
+        trending_ranking.record_save(confession_ref.id, item)
+        search_index.add(item)
+    
+    # Shown on the confirmation screen - a failure here mustn't fail the save
+    try:
+        related = related_prayers.related(confession_ref.id, 3, title=title, text=text)
+    except Exception as e:
+        logger.error(f"Error finding prayers related to {confession_ref.id}: {e}")
+        related = []
+    return jsonify({'success': True, 'confession': dict(item, is_public=is_public), 'related': related})
+
+# ============================================================================
+# WARMUP
+# ============================================================================
+
+# Run by App Engine's /_ah/warmup before the instance gets traffic, and by every
+# gunicorn worker when it boots (gunicorn.conf.py). Steps run concurrently.
+
+@warmup.step
+def firestore_channel():
+    """Build the Firestore client and open its gRPC channel by loading the feed snapshots"""
+    if not confession_feed or not db:
+        return None
+    loaded = confession_feed.preload()
+    trending_ranking.ensure_loaded()
+    return loaded
+
+@warmup.step
+def search_index_load():
+    """Load the search snapshot (and nltk) so the first search doesn't wait for them"""
+    if not search_index or not db:
+        return None
+    search_index.ensure_loaded()
+    return search_index.stats()['documents']
+
+@warmup.step
+def tier_cache_preload():
+    """Cache the tiers of the most recently updated subscriptions"""
+    if not db:
+        return 0
+    limit = int(os.getenv('WARMUP_TIER_PRELOAD', '200'))
+    docs = db.collection('subscriptions').order_by('updated_at', direction='DESCENDING').limit(limit).get()
+    for doc in docs:
+        tier_cache.set(doc.id, doc.to_dict().get('tier', 'free'))
+    return len(docs)
+
+@warmup.step
+def openai_pool():
+    """Open keep-alive connections to OpenAI"""
+    if not openai_client:
+        return None
+    return openai_client.prime(connections=int(os.getenv('WARMUP_OPENAI_CONNECTIONS', '2')))
+
+@warmup.step
+def stripe_sdk():
+    """Import and configure the Stripe SDK (it opens connections per request, so there is no pool to fill)"""
+    return stripe.version.VERSION if stripe_secret_key else None
+
+@warmup.step
+def sendgrid_client_init():
+    """Build the SendGrid client (python_http_client opens a connection per request)"""
+    return sendgrid_client.host if sendgrid_client else None
+
+@warmup.step
+def jinja_templates():
+    """Compile every page and email template into Jinja's cache"""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+@app.route('/_ah/warmup')
+def warmup_request():
+    """App Engine warmup request (inbound_services: warmup in app.yaml) - returns the timing report"""
+    return jsonify(warmup.run())
+
+def is_cron_request():
+    # App Engine strips X-Appengine-Cron from outside requests, so only its cron service can send it
+    return request.headers.get('X-Appengine-Cron') == 'true'
+
+def is_operator_request():
+    # Operators pass INTERNAL_STATS_TOKEN as X-Internal-Token; without the secret only cron gets in
+    token = os.getenv('INTERNAL_STATS_TOKEN')
+    supplied = request.headers.get('X-Internal-Token', '')
+    return is_cron_request() or bool(token) and secrets.compare_digest(supplied.encode('utf-8'), token.encode('utf-8'))
+
+@app.route('/api/internal/campaigns/weekly-insight', methods=['GET'])
+def weekly_insight_cron():
+    """Cron: send this week's spiritual insight to everyone who hasn't opted out"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    year, week, _ = datetime.now().isocalendar()
+    campaign_id = f"weekly_insight-{year}-W{week:02d}"
+    if not db:
+        return jsonify({'error': 'Firestore not configured'}), 503
+    created = start_email_campaign('weekly_insight', campaign_id)
+    return jsonify({'success': True, 'campaign_id': campaign_id, 'started': created})
+
+@app.route('/api/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    """Stripe webhook: verify and store the event, process it in the background"""
+    if not stripe_webhook_secret:
+        return jsonify({'error': 'Webhooks not configured'}), 503
+    try:
+        status = stripe_webhooks.receive(request.get_data(), request.headers.get('Stripe-Signature'))
+    except SignatureError as e:
+        logger.warning(f"Rejected Stripe webhook: {e}")
+        return jsonify({'error': 'Invalid signature'}), 400
+    except Exception as e:
+        # Not acknowledged - Stripe delivers the event again
+        logger.error(f"Failed to store Stripe webhook event: {e}")
+        return jsonify({'error': 'Event not stored'}), 500
+    return jsonify({'received': True, 'status': status})
+
+@app.route('/api/user/subscription-management', methods=['GET'])
+def subscription_management():
+    """Subscription details from the local mirror, plus a Stripe billing portal link"""
+    session_id = request.args.get('session_id', 'anonymous')
+    if not subscription_mirror or not db:
+        return jsonify({'success': False, 'error': 'Subscriptions not available'}), 503
+    
+    subscription = subscription_mirror.get(session_id)
+    if not subscription or not subscription.get('customer_id'):
+        return jsonify({'success': False, 'error': 'No subscription found'}), 404
+    
+    # The billing portal session is the only Stripe call - everything else comes from the mirror
+    try:
+        management_url = subscription_mirror.portal_url(subscription['customer_id'], request.host_url + 'app')
+    except Exception as e:
+        logger.error(f"Failed to create billing portal session for {session_id}: {e}")
+        management_url = None
+    
+    renews_at = subscription.get('current_period_end')
+    return jsonify({
+        'success': management_url is not None,
+        'management_url': management_url,
+        'subscription': {
+            'tier': subscription.get('tier'),
+            'status': subscription.get('status'),
+            'plan': subscription.get('plan'),
+            'renews_at': renews_at.isoformat() if renews_at else None,
+            'cancel_at_period_end': subscription.get('cancel_at_period_end', False),
+            'amount': subscription.get('amount'),
+            'currency': subscription.get('currency')
+        }
+    })
+
+@app.route('/api/internal/subscriptions/reconcile', methods=['GET'])
+def reconcile_subscriptions_cron():
+    """Cron: compare the subscription mirror with Stripe (one paged listing, not one call per user)"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not subscription_mirror or not db or not stripe_secret_key:
+        return jsonify({'error': 'Subscriptions not available'}), 503
+    job_queue.enqueue('reconcile_subscriptions')
+    return jsonify({'success': True})
+
+@app.route('/api/internal/subscriptions/renewal-reminders', methods=['GET'])
+def renewal_reminders_cron():
+    """Cron: email subscribers whose plan renews within RENEWAL_REMINDER_DAYS"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not subscription_mirror or not db:
+        return jsonify({'error': 'Firestore not configured'}), 503
+    job_queue.enqueue('send_renewal_reminders')
+    return jsonify({'success': True})
+
+@app.route('/api/internal/stripe/resume', methods=['GET'])
+def resume_stripe_events_cron():
+    """Cron: reschedule Stripe events whose processing job was lost (e.g. instance shutdown)"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    customers = stripe_webhooks.resume(idle_seconds=int(os.getenv('STRIPE_EVENT_STALL_SECONDS', '600')))
+    return jsonify({'success': True, 'customers': customers})
+
+@app.route('/api/internal/search/snapshot', methods=['GET'])
+def search_snapshot_cron():
+    """Cron: write the search index snapshot new workers start from"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not search_index or not db:
+        return jsonify({'error': 'Firestore not configured'}), 503
+    try:
+        documents = search_index.save_snapshot()
+    except Exception as e:
+        logger.error(f"Failed to save the search snapshot: {e}")
+        return jsonify({'error': 'Snapshot failed'}), 500
+    return jsonify({'success': True, 'documents': documents})
+
+@app.route('/api/internal/campaigns/resume', methods=['GET'])
+def resume_campaigns_cron():
+    """Cron: pick up campaigns whose worker went away mid-run"""
+    if not is_cron_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not db:
+        return jsonify({'error': 'Firestore not configured'}), 503
+    stalled = campaign_runner.stalled(idle_seconds=int(os.getenv('CAMPAIGN_STALL_SECONDS', '600')))
+    for campaign_id in stalled:
+        job_queue.enqueue('run_email_campaign', campaign_id=campaign_id)
+    return jsonify({'success': True, 'resumed': stalled})
+
+@app.route('/api/internal/stats', methods=['GET'])
+def internal_stats():
+    """Operational counters for the shared upstream clients"""
+    # Breaker state, counters and confession ids are not for the public - don't even admit the route exists
+    if not is_operator_request():
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify({
+        'openai': openai_client.stats() if openai_client else None,
+        'context': context_builder.stats(),
+        'response_cache': response_cache.stats(),
+        'session_state': state_backend.stats(),
+        'tier_cache': tier_cache.stats(),
+        'jobs': job_queue.stats(),
+        'email_outbox': email_outbox.stats(),
+        'campaigns': campaign_runner.stats(),
+        'stripe_webhooks': stripe_webhooks.stats(),
+        'subscription_mirror': subscription_mirror.stats() if subscription_mirror else None,
+        'confession_feed': confession_feed.stats() if confession_feed else None,
+        'upvotes': upvote_counter.stats() if upvote_counter else None,
+        'trending': trending_ranking.stats() if trending_ranking else None,
+        'search': search_index.stats() if search_index else None,
+        'related_prayers': related_prayers.stats() if related_prayers else None,
+        'startup': startup_timer.report(),
+        'firestore': firestore_stats.stats(),
+        'warmup': warmup.report(),
+        'usage': usage_meter.stats(),
+        'conversations': conversation_store.stats(),
+        'password_reset_tokens': password_reset_tokens.stats(),
+        'processed_checkouts': processed_checkouts.stats(),
+        # Peak resident set size of this process (kB on Linux)
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    })
+
+startup_timer.finish('routes')
+
 # ... rest of the file ...
\ No newline at end of file
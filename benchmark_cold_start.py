@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark: how long a fresh process takes to import app.py and serve its first request
+
+Each run starts a new interpreter (like an App Engine instance scaling from
+zero), imports the app, then sends one request through the Flask test
+client. Reported per run:
+
+- process:       interpreter start until the first response (what a user waits for)
+- import:        `import app`
+- first request: the first request, including any lazy SDK initialization it triggers
+- the app's own phase report (startup_timer) and which heavy SDKs were imported
+
+Point --app-dir at another checkout to compare revisions:
+
+    git worktree add /tmp/app-before HEAD~1
+    python3 benchmark_cold_start.py --runs 5 --app-dir /tmp/app-before
+    python3 benchmark_cold_start.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['firebase_admin', 'google.cloud.firestore', 'grpc', 'stripe', 'sendgrid', 'google.cloud.secretmanager']
+
+CHILD = r'''
+import json, os, sys, time
+started = time.perf_counter()
+app_dir, path = sys.argv[1], sys.argv[2]
+sys.path.insert(0, app_dir)
+os.chdir(app_dir)
+import app
+imported = time.perf_counter()
+status = app.app.test_client().get(path).status_code
+served = time.perf_counter()
+timer = getattr(app, 'startup_timer', None)
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (served - imported) * 1000,
+    'status': status,
+    'startup': timer.report() if timer else None,
+    'modules': [name for name in json.loads(sys.argv[3]) if name in sys.modules],
+}))
+'''
+
+
+def run_once(app_dir, path):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD, app_dir, path, json.dumps(HEAVY_MODULES)],
+        capture_output=True, text=True, check=True
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['process_ms'] = elapsed
+    return report
+
+
+def summarize(label, values):
+    print(f"{label:<16} median {statistics.median(values):>9.1f}ms   min {min(values):>9.1f}ms   max {max(values):>9.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--path', default='/api/user/tier?session_id=cold-start-benchmark',
+                        help='first request to send')
+    args = parser.parse_args()
+
+    reports = []
+    for index in range(args.runs):
+        report = run_once(args.app_dir, args.path)
+        reports.append(report)
+        print(f"run {index + 1}: {report['process_ms']:.0f}ms (import {report['import_ms']:.0f}ms, "
+              f"first request {report['first_request_ms']:.0f}ms, HTTP {report['status']})")
+
+    print(f"\n{args.app_dir}, {args.runs} runs\n")
+    summarize('process', [report['process_ms'] for report in reports])
+    summarize('import', [report['import_ms'] for report in reports])
+    summarize('first request', [report['first_request_ms'] for report in reports])
+
+    last = reports[-1]
+    if last['startup']:
+        print("\nStartup phases (last run):")
+        for phase, ms in last['startup']['phases'].items():
+            print(f"  {phase:<14} {ms:>9.1f}ms")
+        for name, ms in last['startup']['lazy_init_ms'].items():
+            print(f"  lazy {name:<9} {ms:>9.1f}ms")
+    print(f"\nSDKs imported by the first response: {', '.join(last['modules']) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Concurrency benchmark: sync vs gevent gunicorn workers for /api/chat/message
+
+Starts a local stand-in for the OpenAI API that answers after a fixed delay,
+boots the app under gunicorn with each worker class, fires a burst of
+concurrent chat requests and reports how many were in flight upstream at once.
+
+    python3 benchmark_concurrency.py --requests 200 --latency 1.0
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completions after `server.latency` seconds, tracking peak concurrency"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        with server.lock:
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            body = json.dumps({
+                'choices': [{'message': {'content': 'Peace be with you.'}}]
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def start_fake_openai(latency):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 1024
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.in_flight = 0
+    server.peak = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_app(worker_class, workers, upstream_port):
+    port = free_port()
+    env = dict(
+        os.environ,
+        PORT=str(port),
+        GUNICORN_WORKER_CLASS=worker_class,
+        WEB_CONCURRENCY=str(workers),
+        OPENAI_API_KEY='sk-benchmark',
+        OPENAI_API_BASE=f"http://127.0.0.1:{upstream_port}/v1",
+        OPENAI_MAX_CONCURRENCY='1000',
+        OPENAI_POOL_SIZE='1000',
+        # Skip Secret Manager lookups; nothing below talks to these services
+        STRIPE_SECRET_KEY='sk_test_benchmark',
+        STRIPE_PUBLISHABLE_KEY='pk_test_benchmark',
+        STRIPE_PRICE_ID_UNLIMITED='price_benchmark',
+        STRIPE_PRICE_ID_ANNUAL='price_benchmark',
+        FIREBASE_API_KEY='benchmark',
+        SENDGRID_API_KEY='benchmark',
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--log-level', 'warning',
+         '--access-logfile', '/dev/null', 'app:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        try:
+            if requests.get(f"{base_url}/api/stripe/config", timeout=1).ok:
+                return process, base_url
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) did not start")
+
+
+def run_burst(base_url, total):
+    def one(i):
+        started = time.perf_counter()
+        try:
+            response = requests.post(
+                f"{base_url}/api/chat/message",
+                json={'message': 'I feel anxious', 'session_id': f"bench_{i}"},
+                timeout=600,
+            )
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=total) as pool:
+        results = list(pool.map(one, range(total)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(latency for ok, latency in results if ok)
+    return {
+        'ok': len(latencies),
+        'wall': wall,
+        'p50': statistics.median(latencies) if latencies else 0.0,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='concurrent chat requests per run')
+    parser.add_argument('--latency', type=float, default=1.0, help='simulated OpenAI latency (seconds)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    args = parser.parse_args()
+
+    upstream = start_fake_openai(args.latency)
+    upstream_port = upstream.server_address[1]
+
+    print(f"{args.requests} concurrent chats, {args.latency:.1f}s upstream latency, {args.workers} workers\n")
+    print(f"{'worker':<8} {'ok':>5} {'peak in-flight':>15} {'wall (s)':>9} {'p50 (s)':>8} {'p95 (s)':>8}")
+    for worker_class in ('sync', 'gevent'):
+        upstream.peak = 0
+        process, base_url = start_app(worker_class, args.workers, upstream_port)
+        try:
+            result = run_burst(base_url, args.requests)
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{worker_class:<8} {result['ok']:>5} {upstream.peak:>15} {result['wall']:>9.1f} "
+              f"{result['p50']:>8.2f} {result['p95']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Email rendering benchmark: legacy f-string builders vs Jinja templates
+
+Renders the weekly insight email (with unsubscribe footer) for N recipients
+three ways and reports throughput:
+
+- legacy:      the previous f-string + add_unsubscribe_footer + EMAIL_BASE_TEMPLATE.format
+- render:      EmailTemplates.render, one full template render per recipient
+- render_many: EmailTemplates.render_many, one render plus a join per recipient
+
+    python3 benchmark_email_render.py --recipients 5000
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from email_templates import EmailTemplates
+
+# --- Legacy implementation (as it was in app.py), kept here as the baseline ---
+
+LEGACY_BASE_TEMPLATE = '''
+<div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+    <div style="background: linear-gradient(135deg, #1e40af 0%, #3b82f6 100%); color: white; padding: 30px; text-align: center;">
+        <h1 style="margin: 0; font-size: 28px;">✝️ My Confessions</h1>
+        <p style="margin: 10px 0 0; opacity: 0.9;">Biblical Guidance for Your Spiritual Journey</p>
+    </div>
+
+    <div style="padding: 30px; background: white;">
+        {content}
+    </div>
+
+    <div style="background: #f9fafb; padding: 20px; text-align: center; color: #6b7280; font-size: 12px;">
+        <p style="margin: 0;">
+            Need help? Contact us at <a href="mailto:support@myconfessions.org" style="color: #2563eb;">support@myconfessions.org</a>
+        </p>
+        <p style="margin: 10px 0 0;">
+            © 2025 My Confessions. All rights reserved.
+        </p>
+    </div>
+</div>
+'''
+
+
+def legacy_unsubscribe_footer(content, session_id, email_type='all'):
+    unsubscribe_link = f"https://myconfessions.org/api/user/unsubscribe?session_id={session_id}&type={email_type}"
+    return content + f'''
+        <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb; text-align: center;">
+            <p style="color: #9ca3af; font-size: 11px; margin: 0;">
+                Don't want to receive these emails?
+                <a href="{unsubscribe_link}" style="color: #6b7280; text-decoration: underline;">Unsubscribe</a>
+            </p>
+        </div>
+    '''
+
+
+def legacy_weekly_insight(name, session_id):
+    content = f'''
+        <h2 style="color: #1e40af; margin-top: 0;">Weekly Spiritual Insight 📖</h2>
+
+        <p style="color: #374151; line-height: 1.6;">
+            Dear {name or 'Child of God'},
+        </p>
+
+        <p style="color: #374151; line-height: 1.6;">
+            This week, we invite you to reflect on God's grace in your daily life.
+        </p>
+
+        <div style="background: #eff6ff; border-left: 4px solid #3b82f6; padding: 20px; margin: 25px 0;">
+            <h3 style="color: #1e40af; margin: 0 0 15px;">This Week's Reflection:</h3>
+            <p style="color: #1e40af; font-style: italic; margin: 0; font-size: 16px;">
+                "Be still, and know that I am God; I will be exalted among the nations, I will be exalted in the earth."
+            </p>
+            <p style="color: #1e40af; font-size: 12px; margin: 10px 0 0; text-align: right;">
+                — Psalm 46:10
+            </p>
+        </div>
+
+        <h3 style="color: #1e40af; margin-top: 25px;">Reflection Questions:</h3>
+        <ul style="color: #374151; line-height: 1.8;">
+            <li>When do you find it hardest to "be still" in your daily life?</li>
+            <li>How can you create more space for God's presence this week?</li>
+            <li>What worries can you surrender to Him today?</li>
+        </ul>
+
+        <div style="background: #fef3c7; border-left: 4px solid #f59e0b; padding: 15px; margin: 20px 0;">
+            <p style="color: #92400e; margin: 0;">
+                <strong>💡 This Week's Practice:</strong><br>
+                Take 5 minutes each morning to sit in silence with God. Let Him speak to your heart.
+            </p>
+        </div>
+
+        <div style="text-align: center; margin: 30px 0;">
+            <a href="https://myconfessions.org"
+               style="background: #2563eb; color: white; padding: 12px 30px; text-decoration: none; border-radius: 8px; display: inline-block; font-weight: bold;">
+                Talk with Your Spiritual Guide
+            </a>
+        </div>
+
+        <p style="color: #6b7280; font-size: 14px; margin-top: 30px; padding-top: 20px; border-top: 1px solid #e5e7eb;">
+            Walking alongside you in faith,<br>
+            <strong>My Confessions Ministry</strong>
+        </p>
+    '''
+    content = legacy_unsubscribe_footer(content, session_id, 'insights')
+    return LEGACY_BASE_TEMPLATE.format(content=content)
+
+
+# --- Benchmark ---
+
+def unsubscribe_link(session_id):
+    return f"https://myconfessions.org/api/user/unsubscribe?session_id={session_id}&type=insights"
+
+
+def measure(label, render, recipients):
+    tracemalloc.start()
+    start = time.perf_counter()
+    rendered = render(recipients)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Timing again without tracemalloc overhead
+    start = time.perf_counter()
+    render(recipients)
+    elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"{label:<12} {len(rendered):>8} {elapsed * 1000:>10.1f} {len(rendered) / elapsed:>12,.0f} {peak / 1024 / 1024:>12.1f}")
+    return rendered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=5000, help='emails to render per run')
+    args = parser.parse_args()
+
+    # Same loader and autoescape rules as Flask's app.jinja_env
+    env = Environment(
+        loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+        autoescape=select_autoescape(['html', 'htm', 'xml'])
+    )
+    templates = EmailTemplates(env)
+    templates.get_template('weekly_insight.html')  # compile outside the timed runs
+
+    recipients = [
+        {'name': f"Friend {index}", 'unsubscribe_link': unsubscribe_link(f"session_{index}")}
+        for index in range(args.recipients)
+    ]
+
+    print(f"Weekly insight email, {args.recipients} recipients\n")
+    print(f"{'renderer':<12} {'emails':>8} {'time (ms)':>10} {'emails/s':>12} {'peak (MiB)':>12}")
+    measure('legacy', lambda rs: [legacy_weekly_insight(r['name'], f"session_{i}") for i, r in enumerate(rs)], recipients)
+    single = measure('render', lambda rs: [templates.render('weekly_insight.html', **r) for r in rs], recipients)
+    bulk = measure('render_many', lambda rs: templates.render_many('weekly_insight.html', rs), recipients)
+    assert single == bulk, "render_many output differs from render"
+
+
+if __name__ == "__main__":
+    main()
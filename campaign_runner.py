@@ -0,0 +1,209 @@
+"""
+Bulk email campaigns: weekly insights and follow-ups.
+
+Sending a campaign through the single-recipient helpers costs a Firestore
+read per user (check_email_preferences) before any email goes out. The
+runner works a page at a time instead:
+
+- it pages through `users` by document id, fetching only the fields it
+  needs, or loads an explicit list of users with batched get_all calls
+- missing addresses and opt-outs are filtered in memory
+- the page is rendered once with SendGrid substitution tags
+  (EmailTemplates.render_substitutions) and handed to the email outbox,
+  which sends it as a few batched requests; a campaign whose template needs
+  per-recipient values (the follow-up's days since last activity) maps each
+  user document to them, and recipients with the same values share a render
+- progress is checkpointed in campaigns/{campaign_id} *before* the page is
+  queued, with a precondition on the checkpoint's update time: a page is
+  claimed by exactly one worker, and a resumed campaign continues after the
+  last claimed page instead of sending it again
+
+run_page() handles one page and returns whether there is more; scheduling
+the next page is up to the caller (see run_email_campaign in app.py).
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# The only user fields a campaign reads
+USER_FIELDS = ['email', 'name', 'session_id', 'email_preferences']
+
+
+class CampaignRunner:
+    """Pages campaign recipients out of Firestore and queues their emails on an EmailOutbox"""
+
+    def __init__(self, db, templates, outbox, unsubscribe_link, page_size=500, get_all_size=100):
+        """
+        templates: EmailTemplates
+        unsubscribe_link: callable(session_id, email_type) -> URL
+        """
+        self.db = db
+        self.templates = templates
+        self.outbox = outbox
+        self.unsubscribe_link = unsubscribe_link
+        self.page_size = page_size
+        self.get_all_size = get_all_size
+        self._campaigns = {}
+        self._lock = threading.Lock()
+        self._stats = {'pages': 0, 'queued': 0, 'opted_out': 0, 'no_email': 0, 'conflicts': 0}
+
+    def register(self, campaign_type, template, subject, preference, recipient_context=None, fields=()):
+        """Declare a campaign type; users with email_preferences[preference] == False are skipped
+
+        recipient_context: callable(user data) -> template values for that recipient (hashable
+        values; they override the campaign's context), reading the extra user `fields`.
+        """
+        self._campaigns[campaign_type] = {'template': template, 'subject': subject, 'preference': preference,
+                                          'recipient_context': recipient_context,
+                                          'fields': USER_FIELDS + [field for field in fields if field not in USER_FIELDS]}
+
+    def start(self, campaign_type, campaign_id, user_ids=None, context=None):
+        """Create the campaign's checkpoint; returns False if it already exists (it is resumed instead)
+
+        user_ids limits the campaign to those users (in order); otherwise it covers every user.
+        context holds template values shared by all recipients.
+        """
+        from google.api_core.exceptions import AlreadyExists
+        if campaign_type not in self._campaigns:
+            raise KeyError(f"Unknown campaign type '{campaign_type}'")
+        try:
+            self.db.collection('campaigns').document(campaign_id).create({
+                'type': campaign_type,
+                'status': 'running',
+                'user_ids': list(user_ids) if user_ids is not None else None,
+                'position': 0,
+                'cursor': None,
+                'context': context or {},
+                'queued': 0,
+                'opted_out': 0,
+                'no_email': 0,
+                'started_at': datetime.now(),
+                'updated_at': datetime.now()
+            })
+        except AlreadyExists:
+            return False
+        logger.info(f"Started {campaign_type} campaign {campaign_id}")
+        return True
+
+    def _users_page(self, cursor, fields):
+        query = self.db.collection('users').select(fields).order_by('__name__').limit(self.page_size)
+        if cursor:
+            query = query.start_after({'__name__': cursor})
+        return list(query.stream())
+
+    def _get_users(self, user_ids, fields):
+        users_ref = self.db.collection('users')
+        users = []
+        for offset in range(0, len(user_ids), self.get_all_size):
+            refs = [users_ref.document(user_id) for user_id in user_ids[offset:offset + self.get_all_size]]
+            users.extend(doc for doc in self.db.get_all(refs, field_paths=fields) if doc.exists)
+        return users
+
+    def _recipients(self, users, preference):
+        recipients, opted_out, no_email = [], 0, 0
+        for doc in users:
+            data = doc.to_dict() or {}
+            if not data.get('email'):
+                no_email += 1
+            elif (data.get('email_preferences') or {}).get(preference, True) is False:
+                opted_out += 1
+            else:
+                recipients.append((doc.id, data))
+        return recipients, opted_out, no_email
+
+    def run_page(self, campaign_id):
+        """Queue the next page of a campaign; returns True if there are more pages"""
+        from google.api_core.exceptions import FailedPrecondition
+        campaign_ref = self.db.collection('campaigns').document(campaign_id)
+        snapshot = campaign_ref.get()
+        if not snapshot.exists:
+            logger.error(f"Campaign {campaign_id} not found")
+            return False
+        state = snapshot.to_dict()
+        if state['status'] != 'running':
+            return False
+        campaign = self._campaigns[state['type']]
+
+        if state.get('user_ids') is not None:
+            user_ids = state['user_ids'][state['position']:state['position'] + self.page_size]
+            users = self._get_users(user_ids, campaign['fields'])
+            progress = {'position': state['position'] + len(user_ids)}
+            done = progress['position'] >= len(state['user_ids'])
+        else:
+            users = self._users_page(state.get('cursor'), campaign['fields'])
+            progress = {'cursor': users[-1].id if users else state.get('cursor')}
+            done = len(users) < self.page_size
+
+        recipients, opted_out, no_email = self._recipients(users, campaign['preference'])
+        rendered = self._render(campaign, recipients, state.get('context', {}))
+
+        # Claim the page before queuing it: after a crash these emails are skipped, never sent twice
+        progress.update({
+            'status': 'done' if done else 'running',
+            'queued': state['queued'] + len(recipients),
+            'opted_out': state['opted_out'] + opted_out,
+            'no_email': state['no_email'] + no_email,
+            'updated_at': datetime.now()
+        })
+        if done:
+            progress['completed_at'] = datetime.now()
+        try:
+            campaign_ref.update(progress, option=self.db.write_option(last_update_time=snapshot.update_time))
+        except FailedPrecondition:
+            # Another worker claimed this page first
+            with self._lock:
+                self._stats['conflicts'] += 1
+            return False
+
+        for (user_id, data), (html, substitutions) in zip(recipients, rendered):
+            self.outbox.enqueue(data['email'], campaign['subject'], html, template=state['type'],
+                                dedup_key=f"campaign:{campaign_id}:{user_id}", substitutions=substitutions)
+        with self._lock:
+            self._stats['pages'] += 1
+            self._stats['queued'] += len(recipients)
+            self._stats['opted_out'] += opted_out
+            self._stats['no_email'] += no_email
+        logger.info(f"Campaign {campaign_id}: queued {len(recipients)} emails, skipped {opted_out} opted out"
+                    f"{' - done' if done else ''}")
+        return not done
+
+    def _render(self, campaign, recipients, context):
+        """(html, substitutions) per recipient, one render_substitutions call per distinct recipient context"""
+        groups = {}
+        for position, (user_id, data) in enumerate(recipients):
+            values = campaign['recipient_context'](data) if campaign['recipient_context'] else {}
+            groups.setdefault(tuple(sorted(values.items())), []).append(position)
+        rendered = [None] * len(recipients)
+        for values, positions in groups.items():
+            results = self.templates.render_substitutions(
+                campaign['template'],
+                [{
+                    'name': recipients[position][1].get('name') or '',
+                    'unsubscribe_link': self.unsubscribe_link(
+                        recipients[position][1].get('session_id') or recipients[position][0], campaign['preference'])
+                } for position in positions],
+                **{**context, **dict(values)}
+            )
+            for position, result in zip(positions, results):
+                rendered[position] = result
+        return rendered
+
+    def stalled(self, idle_seconds=600):
+        """Ids of running campaigns whose checkpoint hasn't moved for `idle_seconds`"""
+        # Firestore returns timestamps in UTC
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=idle_seconds)
+        stalled = []
+        for doc in self.db.collection('campaigns').where('status', '==', 'running').select(['updated_at']).stream():
+            updated_at = (doc.to_dict() or {}).get('updated_at')
+            if updated_at is None or updated_at < cutoff:
+                stalled.append(doc.id)
+        return stalled
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['campaign_types'] = sorted(self._campaigns)
+        return stats
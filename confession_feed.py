@@ -0,0 +1,260 @@
+"""
+Community prayer feed: cursor-paginated, projected and served from per-sort snapshots.
+
+Every page view of the feed used to mean a Firestore query. ConfessionFeed
+keeps one snapshot per sort order instead:
+
+- a snapshot holds the first `snapshot_size` public confessions in that
+  order, read with the fields the UI renders (FEED_FIELDS) and one query
+  on the composite index (is_public + created_at / is_public + upvotes)
+- pages inside the snapshot are slices; a snapshot older than
+  `refresh_seconds` is still served while one background thread reloads it,
+  and only a snapshot older than `max_stale_seconds` (or none at all) makes
+  a reader wait - for a single query shared by everyone waiting
+- pages past the snapshot are read with start_after on the same index and
+  cached for `refresh_seconds`
+- every page has an ETag derived from the snapshot's content, so clients
+  revalidate with If-None-Match and get 304 until the feed actually changes
+- an optional `overlay(read_at)` adds upvotes that were counted after the
+  data was read (see upvote_counter.py), so counts look live between
+  refreshes; the ETag covers the overlay too
+
+Cursors are opaque strings (the sort, the last item's sort value and id) and
+go back to the client in the X-Next-Cursor header.
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# The only fields the feed renders
+FEED_FIELDS = ['title', 'text', 'created_at', 'upvotes']
+
+# sort name -> field ordered by (descending), on the is_public composite indexes
+SORTS = {'latest': 'created_at', 'popular': 'upvotes'}
+DEFAULT_SORT = 'latest'
+
+
+class InvalidCursor(ValueError):
+    """The cursor wasn't produced by this feed (or belongs to another sort)"""
+
+
+def feed_item(doc):
+    """The feed's JSON for a confession document"""
+    data = doc.to_dict() or {}
+    created_at = data.get('created_at')
+    return {
+        'id': doc.id,
+        'title': data.get('title'),
+        'text': data.get('text'),
+        'created_at': created_at.isoformat() if created_at else None,
+        'upvotes': data.get('upvotes', 0),
+    }
+
+
+def _digest(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()[:16]
+
+
+class _Snapshot:
+    __slots__ = ('items', 'positions', 'complete', 'version', 'loaded_at', 'invalidated')
+
+    def __init__(self, items, complete, loaded_at):
+        self.items = items
+        self.positions = {item['id']: index for index, item in enumerate(items)}
+        self.complete = complete
+        self.version = _digest(json.dumps(items, sort_keys=True))
+        # When the query finished - a flush committed while it ran may already be in the items,
+        # so only flushes after this are overlaid (a vote is never counted twice)
+        self.loaded_at = loaded_at
+        self.invalidated = False
+
+
+class ConfessionFeed:
+    """Per-sort snapshots of the public feed with cursor pagination and background refresh"""
+
+    def __init__(self, db, page_size=20, snapshot_size=100, refresh_seconds=30, max_stale_seconds=300, overlay=None):
+        """overlay: callable(read_at) -> {confession id: upvotes to add} for data read at monotonic time read_at"""
+        self.db = db
+        self.overlay = overlay
+        self.page_size = page_size
+        self.snapshot_size = snapshot_size
+        self.refresh_seconds = refresh_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self._snapshots = {}
+        self._locks = {sort: threading.Lock() for sort in SORTS}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._deep_pages = BoundedStore(max_entries=1000, ttl_seconds=refresh_seconds)
+        self._stats = {'snapshot_pages': 0, 'stale_pages': 0, 'deep_page_hits': 0, 'deep_page_queries': 0,
+                       'refreshes': 0, 'refresh_errors': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _query(self, sort):
+        from google.cloud.firestore import Query
+        return (self.db.collection('confessions')
+                .where('is_public', '==', True)
+                .select(FEED_FIELDS)
+                .order_by(SORTS[sort], direction=Query.DESCENDING)
+                .order_by('__name__', direction=Query.DESCENDING))
+
+    # Cursors
+
+    def encode_cursor(self, sort, item):
+        raw = json.dumps([sort, item[SORTS[sort]], item['id']]).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, sort, cursor):
+        """(sort value, document id) for a cursor of this sort"""
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            cursor_sort, value, doc_id = json.loads(base64.urlsafe_b64decode(padded))
+        except (ValueError, TypeError) as e:
+            raise InvalidCursor(f"Malformed cursor: {e}")
+        if cursor_sort != sort:
+            raise InvalidCursor(f"Cursor belongs to the '{cursor_sort}' feed")
+        if SORTS[sort] == 'created_at' and value is not None:
+            value = datetime.fromisoformat(value)
+        return value, doc_id
+
+    # Snapshots
+
+    def _load(self, sort):
+        docs = list(self._query(sort).limit(self.snapshot_size + 1).stream())
+        snapshot = _Snapshot([feed_item(doc) for doc in docs[:self.snapshot_size]],
+                             complete=len(docs) <= self.snapshot_size, loaded_at=time.monotonic())
+        self._snapshots[sort] = snapshot
+        self._count('refreshes')
+        return snapshot
+
+    def _refresh_in_background(self, sort):
+        with self._lock:
+            if sort in self._refreshing:
+                return
+            self._refreshing.add(sort)
+
+        def refresh():
+            try:
+                with self._locks[sort]:
+                    self._load(sort)
+            except Exception as e:
+                self._count('refresh_errors')
+                logger.error(f"Failed to refresh the '{sort}' feed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(sort)
+
+        threading.Thread(target=refresh, name=f"feed-refresh-{sort}", daemon=True).start()
+
+    def snapshot(self, sort):
+        """The sort's snapshot; loaded now only if there is none or it is too stale to serve"""
+        snapshot = self._snapshots.get(sort)
+        age = time.monotonic() - snapshot.loaded_at if snapshot else None
+        if snapshot is None or age > self.max_stale_seconds:
+            with self._locks[sort]:
+                # Someone else may have loaded it while we waited
+                current = self._snapshots.get(sort)
+                if current is snapshot:
+                    try:
+                        current = self._load(sort)
+                    except Exception as e:
+                        self._count('refresh_errors')
+                        if snapshot is None:
+                            raise
+                        logger.error(f"Failed to reload the '{sort}' feed - serving the stale snapshot: {e}")
+                return current
+        if age > self.refresh_seconds or snapshot.invalidated:
+            self._count('stale_pages')
+            self._refresh_in_background(sort)
+        return snapshot
+
+    def preload(self):
+        """Load every sort's snapshot (warmup); returns the number of items loaded"""
+        return sum(len(self.snapshot(sort).items) for sort in SORTS)
+
+    def invalidate(self, sort=None):
+        """Reload on the next read, e.g. after a confession was published"""
+        for name in ([sort] if sort else SORTS):
+            snapshot = self._snapshots.get(name)
+            if snapshot:
+                # Still served, but refreshed in the background on the next read
+                snapshot.invalidated = True
+
+    # Pages
+
+    def page(self, sort, cursor=None, limit=None):
+        """(items, next_cursor, etag) for one page of the feed; next_cursor is None on the last page
+
+        The etag is unquoted (see Response.set_etag).
+        """
+        if sort not in SORTS:
+            sort = DEFAULT_SORT
+        limit = max(1, min(limit or self.page_size, self.snapshot_size))
+        snapshot = self.snapshot(sort)
+
+        start = 0
+        if cursor:
+            _, doc_id = self.decode_cursor(sort, cursor)
+            position = snapshot.positions.get(doc_id)
+            if position is None:
+                return self._deep_page(sort, cursor, limit)
+            start = position + 1
+
+        end = start + limit
+        if end > len(snapshot.items) and not snapshot.complete:
+            # Runs past the snapshot - read it from Firestore
+            return self._deep_page(sort, cursor, limit)
+        self._count('snapshot_pages')
+        items = snapshot.items[start:end]
+        has_more = end < len(snapshot.items) or not snapshot.complete
+        next_cursor = self.encode_cursor(sort, items[-1]) if items and has_more else None
+        return self._overlaid(items, next_cursor, f"{snapshot.version}-{start}-{limit}", snapshot.loaded_at)
+
+    def _deep_page(self, sort, cursor, limit):
+        key = (sort, cursor, limit)
+        page = self._deep_pages.get(key)
+        if page is not None:
+            self._count('deep_page_hits')
+        else:
+            value, doc_id = self.decode_cursor(sort, cursor)
+            docs = list(self._query(sort).start_after({SORTS[sort]: value, '__name__': doc_id}).limit(limit + 1).stream())
+            read_at = time.monotonic()
+            self._count('deep_page_queries')
+            items = [feed_item(doc) for doc in docs[:limit]]
+            next_cursor = self.encode_cursor(sort, items[-1]) if len(docs) > limit else None
+            page = (items, next_cursor, _digest(json.dumps(items, sort_keys=True)), read_at)
+            self._deep_pages[key] = page
+        return self._overlaid(*page)
+
+    def _overlaid(self, items, next_cursor, etag, read_at):
+        """Add the overlay's upvotes to a page (cursors keep the stored values the index orders by)"""
+        deltas = self.overlay(read_at) if self.overlay else None
+        if not deltas:
+            return items, next_cursor, etag
+        applied = {item['id']: deltas[item['id']] for item in items if item['id'] in deltas}
+        if not applied:
+            return items, next_cursor, etag
+        items = [dict(item, upvotes=item['upvotes'] + applied[item['id']]) if item['id'] in applied else item
+                 for item in items]
+        return items, next_cursor, f"{etag}-{_digest(json.dumps(applied, sort_keys=True))}"
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+        stats['snapshots'] = {
+            sort: {'items': len(snapshot.items), 'age_seconds': round(now - snapshot.loaded_at, 1)}
+            for sort, snapshot in list(self._snapshots.items())
+        }
+        return stats
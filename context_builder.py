@@ -0,0 +1,166 @@
+"""
+Token-budgeted prompt context for chat turns.
+
+Recent turns are added newest-first until the budget is spent. Older turns
+that no longer fit are folded into a rolling summary that is cached on the
+conversation and extended incrementally, so a long conversation costs one
+small summarization call every few turns instead of an ever-growing prompt.
+
+Tokens are estimated from characters, which undercounts text that isn't
+plain English, so part of the budget is held back as headroom. The user's
+own message is never shortened: one over its share of the budget raises
+MessageTooLong, for the caller to report.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Chat format overhead per message (role, separators) in OpenAI's accounting
+TOKENS_PER_MESSAGE = 4
+
+# Typical for English text; other languages and unusual text take more tokens per character
+CHARS_PER_TOKEN = 4
+
+
+class MessageTooLong(ValueError):
+    """The user's message doesn't fit its share of the prompt budget"""
+
+    def __init__(self, max_chars):
+        super().__init__(f"message is longer than {max_chars} characters")
+        self.max_chars = max_chars
+
+
+def count_tokens(text):
+    """Estimate the token count of a string (~4 characters per token for English text)"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message):
+    return count_tokens(message.get('content', '')) + TOKENS_PER_MESSAGE
+
+
+class ContextBuilder:
+    """Builds bounded prompts and keeps per-conversation rolling summaries up to date"""
+
+    def __init__(self, budget_tokens=1500, summarize=None, fold_headroom=0.6, estimate_headroom=0.2,
+                 message_share=0.5):
+        """
+        budget_tokens: hard cap for system prompt + summary + history + new message
+        summarize: callable(previous_summary, messages) -> new summary text, or None
+        fold_headroom: when folding, keep only this share of the history budget
+            verbatim so the next few turns fit without another summarization
+        estimate_headroom: share of the budget held back for estimation error
+        message_share: largest share of the budget the new message may take
+        """
+        self.budget_tokens = budget_tokens
+        self.summarize = summarize
+        self.fold_headroom = fold_headroom
+        # Estimated tokens may only fill this much, so the real count stays under budget_tokens
+        self.usable_tokens = int(budget_tokens * (1 - estimate_headroom))
+        self.max_message_tokens = int(budget_tokens * message_share)
+        self._lock = threading.Lock()
+        self._stats = {
+            'prompts_built': 0,
+            'prompt_tokens': 0,
+            'full_history_tokens': 0,
+            'tokens_saved': 0,
+            'summaries_refreshed': 0,
+            'summary_failures': 0,
+            'messages_too_long': 0,
+        }
+
+    @property
+    def max_message_chars(self):
+        return self.max_message_tokens * CHARS_PER_TOKEN
+
+    def check_message(self, message):
+        """Raise MessageTooLong if the message doesn't fit its share of the budget"""
+        if count_tokens(message) > self.max_message_tokens:
+            with self._lock:
+                self._stats['messages_too_long'] += 1
+            raise MessageTooLong(self.max_message_chars)
+
+    def build(self, system_prompt, history, message, summary_state=(None, 0)):
+        """Return (messages, new_summary_state) for a chat turn.
+
+        summary_state is (summary_text, number_of_history_messages_it_covers).
+        Raises MessageTooLong rather than cutting the message.
+        """
+        summary, summarized_upto = summary_state
+        summarized_upto = min(summarized_upto, len(history))
+
+        # Never let one enormous message blow the budget on its own
+        self.check_message(message)
+        fixed = count_tokens(system_prompt) + TOKENS_PER_MESSAGE + count_tokens(message) + TOKENS_PER_MESSAGE
+        history_budget = max(self.usable_tokens - fixed, 0)
+
+        def summary_cost(text):
+            return count_tokens(text) + TOKENS_PER_MESSAGE + 8 if text else 0
+
+        keep_from = self._fit(history, summarized_upto, history_budget - summary_cost(summary))
+        if keep_from > summarized_upto:
+            # Turns fell out of the window. Fold them - plus some headroom - into the summary.
+            fold_to = self._fit(history, summarized_upto, int(history_budget * self.fold_headroom) - summary_cost(summary))
+            new_summary = self._refresh_summary(summary, history[summarized_upto:fold_to])
+            if new_summary:
+                summary, summarized_upto = new_summary, fold_to
+                keep_from = self._fit(history, summarized_upto, history_budget - summary_cost(summary))
+
+        messages = [{'role': 'system', 'content': system_prompt}]
+        if summary:
+            messages.append({'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"})
+        messages.extend(
+            {'role': msg.get('role', 'user'), 'content': msg.get('content', '')}
+            for msg in history[keep_from:]
+        )
+        messages.append({'role': 'user', 'content': message})
+
+        self._record(history, message, messages)
+        return messages, (summary, summarized_upto)
+
+    def _fit(self, history, lower, budget):
+        """Index of the oldest message (>= lower) such that history[index:] fits in budget"""
+        used = 0
+        index = len(history)
+        while index > lower:
+            cost = message_tokens(history[index - 1])
+            if used + cost > budget:
+                break
+            used += cost
+            index -= 1
+        return index
+
+    def _refresh_summary(self, summary, folded):
+        if not folded or not self.summarize:
+            return None
+        try:
+            new_summary = self.summarize(summary, folded)
+        except Exception as e:
+            logger.error(f"Failed to refresh conversation summary: {e}")
+            new_summary = None
+        with self._lock:
+            self._stats['summaries_refreshed' if new_summary else 'summary_failures'] += 1
+        return new_summary
+
+    def _record(self, history, message, messages):
+        prompt_tokens = sum(message_tokens(msg) for msg in messages)
+        full_tokens = (
+            message_tokens(messages[0])
+            + sum(message_tokens(msg) for msg in history)
+            + count_tokens(message) + TOKENS_PER_MESSAGE
+        )
+        with self._lock:
+            self._stats['prompts_built'] += 1
+            self._stats['prompt_tokens'] += prompt_tokens
+            self._stats['full_history_tokens'] += full_tokens
+            self._stats['tokens_saved'] += max(full_tokens - prompt_tokens, 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['budget_tokens'] = self.budget_tokens
+        stats['usable_tokens'] = self.usable_tokens
+        stats['avg_prompt_tokens'] = round(stats['prompt_tokens'] / stats['prompts_built'], 1) if stats['prompts_built'] else 0
+        return stats
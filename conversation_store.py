@@ -0,0 +1,139 @@
+"""
+Server-side chat history: append-only conversations keyed by conversation id
+and owned by the session that started them.
+
+Histories live in a bounded in-memory store (LRU + idle TTL + memory
+budget) in front of the state backend (state_backend.py). Conversations of
+premium users ("Journey saved") are written through to the backend so they
+survive restarts and evictions. With a shared backend every conversation is
+written through, and each read checks the stored message count, so any
+worker or instance can continue a conversation another one started.
+"""
+
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime
+
+from session_state import BoundedStore
+
+
+class _Conversation:
+    """Compact conversation record; messages are (role, content, epoch_seconds) tuples"""
+
+    __slots__ = ('session_id', 'messages', 'persisted', 'summary', 'summarized_upto')
+
+    def __init__(self, session_id, messages=None):
+        self.session_id = session_id
+        self.messages = messages or []
+        self.persisted = len(self.messages)
+        self.summary = None
+        self.summarized_upto = 0
+
+
+def _compact(message):
+    timestamp = message.get('timestamp')
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.fromisoformat(timestamp).timestamp()
+        except ValueError:
+            timestamp = None
+    elif isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    # sys.intern shares one copy of 'user' / 'assistant' across every message
+    return (sys.intern(message.get('role', 'user')), message.get('content', ''), timestamp or time.time())
+
+
+class ConversationStore:
+    """Append-only conversation histories cached in memory in front of a state backend"""
+
+    def __init__(self, backend=None, max_bytes=64 * 1024 * 1024, ttl_seconds=24 * 3600):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._conversations = BoundedStore(max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+
+    @property
+    def shared(self):
+        return bool(self.backend and self.backend.shared)
+
+    def create(self, session_id):
+        """Start a new conversation for a session and return its id"""
+        conversation_id = f"conv_{secrets.token_urlsafe(12)}"
+        self._conversations[conversation_id] = _Conversation(session_id)
+        return conversation_id
+
+    def get_messages(self, conversation_id, session_id):
+        """Return the history as role/content dicts, or None if unknown or owned by another session"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None or self.shared:
+            conversation = self._sync(conversation_id, conversation)
+            if conversation is None:
+                return None
+        if conversation.session_id != session_id:
+            return None
+        with self._lock:
+            return [{'role': role, 'content': content} for role, content, _ in conversation.messages]
+
+    def reads_backend(self, conversation_id):
+        """True if get_messages() will read the backend for this conversation"""
+        return bool(self.backend) and (self.shared or self._conversations.peek(conversation_id) is None)
+
+    def append(self, conversation_id, session_id, messages, persist=False):
+        """Append messages to a conversation; persist=True writes them through to the backend"""
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None or conversation.session_id != session_id:
+                raise KeyError(conversation_id)
+            conversation.messages.extend(_compact(message) for message in messages)
+            # Re-insert so the store re-measures the grown record against its budget
+            self._conversations[conversation_id] = conversation
+            if not (persist or self.shared):
+                return
+            start = conversation.persisted
+            pending = conversation.messages[start:]
+            conversation.persisted = len(conversation.messages)
+        if self.backend:
+            self.backend.save_messages(conversation_id, session_id, start, pending)
+
+    def get_summary(self, conversation_id):
+        """Return (rolling_summary, number_of_messages_it_covers)"""
+        conversation = self._conversations.peek(conversation_id)
+        if conversation is None:
+            return None, 0
+        return conversation.summary, conversation.summarized_upto
+
+    def set_summary(self, conversation_id, summary, summarized_upto):
+        with self._lock:
+            conversation = self._conversations.peek(conversation_id)
+            if conversation is not None:
+                conversation.summary = summary
+                conversation.summarized_upto = summarized_upto
+
+    def stats(self):
+        return self._conversations.stats()
+
+    def _sync(self, conversation_id, conversation):
+        """Bring a cached conversation up to date with the backend (or load it if not cached)"""
+        if not self.backend:
+            return conversation
+        if conversation is not None:
+            stored = self.backend.message_count(conversation_id)
+            # Nothing stored yet, or another worker has not added anything since
+            if stored is None or stored[1] <= len(conversation.messages):
+                return conversation
+        loaded = self.backend.load_messages(conversation_id, conversation.persisted if conversation else 0)
+        if loaded is None:
+            return conversation
+        owner, messages = loaded
+        with self._lock:
+            if conversation is None:
+                # Another request may have loaded it meanwhile - keep whichever got there first
+                conversation = self._conversations.setdefault(conversation_id, _Conversation(owner))
+            start = conversation.persisted
+            tail = [_compact(message) for message in messages if message.get('seq', start) >= start]
+            if tail:
+                conversation.messages[start:] = tail
+                conversation.persisted = len(conversation.messages)
+                self._conversations[conversation_id] = conversation
+        return conversation
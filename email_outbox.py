@@ -0,0 +1,342 @@
+"""
+Email outbox: queued, deduplicated, batched SendGrid delivery.
+
+send_email used to make one blocking SendGrid request per recipient and give
+up on the first error. Messages are now enqueued with a dedup key and a
+sender thread drains the outbox:
+
+- messages with the same subject and body go out together, one SendGrid
+  personalization per recipient (up to 1000 per request); per-recipient
+  values can be passed as SendGrid substitutions
+- requests are paced by a token bucket and back off on 429 Retry-After
+- 429/5xx/network failures are retried with exponential backoff; a batch
+  rejected with 400 is split in halves until the offending recipients are
+  isolated, and only those - with other 4xx rejections and messages out of
+  attempts - go to the dead-letter handler
+- anything still queued at shutdown is spilled to disk and picked up by the
+  next worker (see job_queue.append_jsonl / claim_jsonl)
+
+Per-template counters, latency (enqueue to accepted) and throughput are
+available from stats(). SENDGRID_API_HOST points the client at a local
+stand-in (sendgrid_standin.py) for testing.
+"""
+
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from job_queue import append_jsonl, claim_jsonl
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# SendGrid accepts at most 1000 personalizations per request
+MAX_PERSONALIZATIONS = 1000
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class SendGridTransport:
+    """Posts raw v3 mail/send payloads through a SendGridAPIClient"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def send(self, payload):
+        """Return (status_code, retry_after_seconds); network errors are raised"""
+        from python_http_client.exceptions import HTTPError
+        try:
+            response = self.client.send(payload)
+            return response.status_code, None
+        except HTTPError as e:
+            retry_after = None
+            headers = e.headers or {}
+            if headers.get('Retry-After'):
+                try:
+                    retry_after = float(headers.get('Retry-After'))
+                except ValueError:
+                    pass
+            return e.status_code, retry_after
+
+
+class _TemplateMetrics:
+    __slots__ = ('enqueued', 'deduped', 'sent', 'retried', 'dead', 'latencies', 'sent_times')
+
+    def __init__(self):
+        self.enqueued = 0
+        self.deduped = 0
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self.latencies = deque(maxlen=500)
+        self.sent_times = deque(maxlen=5000)
+
+    def snapshot(self, now):
+        latencies = sorted(self.latencies)
+        recent = sum(1 for sent_at in self.sent_times if now - sent_at <= 60)
+        return {
+            'enqueued': self.enqueued,
+            'deduped': self.deduped,
+            'sent': self.sent,
+            'retried': self.retried,
+            'dead': self.dead,
+            'sent_last_minute': recent,
+            'avg_latency_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            'p95_latency_ms': round(latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000, 1) if latencies else None,
+        }
+
+
+class EmailOutbox:
+    """Deduplicating outbox drained in SendGrid batches by a background sender"""
+
+    def __init__(self, transport, from_email, batch_size=MAX_PERSONALIZATIONS, max_requests_per_second=5.0,
+                 flush_interval=1.0, max_attempts=5, backoff_base=2.0, backoff_cap=600.0,
+                 dedup_ttl_seconds=24 * 3600, spill_dir=None, dead_letter=None):
+        """
+        transport: object with send(payload) -> (status_code, retry_after), e.g. SendGridTransport
+        dead_letter: callable(messages, reason) for messages that will not be retried
+        """
+        self.transport = transport
+        self.from_email = from_email
+        self.batch_size = min(batch_size, MAX_PERSONALIZATIONS)
+        self.min_interval = 1.0 / max_requests_per_second if max_requests_per_second else 0
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.spill_dir = spill_dir
+        self.dead_letter = dead_letter
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._ready = deque()
+        self._retries = []  # (due, seq, message)
+        self._seq = itertools.count()
+        self._seen = BoundedStore(max_entries=200000, ttl_seconds=dedup_ttl_seconds)
+        self._metrics = {}
+        self._next_request_at = 0.0
+        self._requests = 0
+        self._sender = None
+
+    @staticmethod
+    def make_key(template, to_email, subject, html):
+        return hashlib.sha256(f"{template}\0{to_email}\0{subject}\0{html}".encode('utf-8')).hexdigest()[:32]
+
+    def enqueue(self, to_email, subject, html, template='generic', dedup_key=None, substitutions=None):
+        """Queue a message; returns False if a message with the same dedup key was already queued or sent"""
+        key = dedup_key or self.make_key(template, to_email, subject, html)
+        with self._lock:
+            metrics = self._metrics_for(template)
+            if key in self._seen:
+                metrics.deduped += 1
+                return False
+            self._seen[key] = True
+            metrics.enqueued += 1
+            self._ready.append({
+                'key': key,
+                'template': template,
+                'to': to_email,
+                'subject': subject,
+                'html': html,
+                'substitutions': substitutions or None,
+                'enqueued_at': time.time(),
+                'attempts': 0,
+            })
+            batch_full = len(self._ready) >= self.batch_size
+        self.start()
+        if batch_full:
+            self._wakeup.set()
+        return True
+
+    def _metrics_for(self, template):
+        metrics = self._metrics.get(template)
+        if metrics is None:
+            metrics = self._metrics[template] = _TemplateMetrics()
+        return metrics
+
+    def start(self):
+        """Start the sender and restore spilled messages (idempotent)"""
+        # Started lazily so the thread belongs to the serving (post-fork) worker process
+        if self._sender is not None:
+            return
+        with self._lock:
+            if self._sender is not None:
+                return
+            self._sender = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+            self._sender.start()
+        self.restore()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Email outbox sender error: {e}")
+
+    def _take_due(self):
+        """Move due retries to the ready queue and return everything ready"""
+        now = time.monotonic()
+        with self._lock:
+            while self._retries and self._retries[0][0] <= now:
+                self._ready.append(heapq.heappop(self._retries)[2])
+            messages = list(self._ready)
+            self._ready.clear()
+        return messages
+
+    def flush(self):
+        """Send everything that is due; returns the number of messages accepted by SendGrid"""
+        with self._send_lock:
+            messages = self._take_due()
+            if not messages:
+                return 0
+            if not self.transport:
+                self._dead(messages, 'SendGrid not configured')
+                return 0
+
+            # Messages with the same subject and body share one request
+            groups = {}
+            for message in messages:
+                groups.setdefault((message['subject'], message['html']), []).append(message)
+            sent = 0
+            for group in groups.values():
+                for offset in range(0, len(group), self.batch_size):
+                    sent += self._send_batch(group[offset:offset + self.batch_size])
+            return sent
+
+    def _send_batch(self, batch):
+        subject, html = batch[0]['subject'], batch[0]['html']
+        payload = {
+            'from': {'email': self.from_email},
+            'subject': subject,
+            'content': [{'type': 'text/html', 'value': html}],
+            'personalizations': [],
+        }
+        for message in batch:
+            personalization = {'to': [{'email': message['to']}]}
+            if message['substitutions']:
+                personalization['substitutions'] = message['substitutions']
+            payload['personalizations'].append(personalization)
+
+        self._pace()
+        try:
+            status_code, retry_after = self.transport.send(payload)
+        except Exception as e:
+            logger.error(f"SendGrid request for {len(batch)} emails failed: {e}")
+            self._retry(batch, str(e))
+            return 0
+
+        if 200 <= status_code < 300:
+            now_wall, now = time.time(), time.monotonic()
+            with self._lock:
+                for message in batch:
+                    metrics = self._metrics_for(message['template'])
+                    metrics.sent += 1
+                    metrics.latencies.append(now_wall - message['enqueued_at'])
+                    metrics.sent_times.append(now)
+            logger.info(f"Email batch sent: {len(batch)} recipients, subject: {subject}, status: {status_code}")
+            return len(batch)
+
+        if status_code in RETRYABLE_STATUS_CODES:
+            if retry_after:
+                # Rate limited - hold every request, not just this batch
+                with self._lock:
+                    self._next_request_at = max(self._next_request_at, time.monotonic() + retry_after)
+            self._retry(batch, f"HTTP {status_code}", retry_after)
+        elif status_code == 400 and len(batch) > 1:
+            # Usually one bad address rejects the whole request - halve until it's isolated
+            middle = len(batch) // 2
+            logger.warning(f"SendGrid rejected a batch of {len(batch)} emails (HTTP 400) - retrying in halves")
+            return self._send_batch(batch[:middle]) + self._send_batch(batch[middle:])
+        else:
+            self._dead(batch, f"HTTP {status_code}")
+        return 0
+
+    def _pace(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self.min_interval
+            self._requests += 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def _retry(self, batch, reason, retry_after=None):
+        exhausted = []
+        with self._lock:
+            for message in batch:
+                message['attempts'] += 1
+                if message['attempts'] >= self.max_attempts:
+                    exhausted.append(message)
+                    continue
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** message['attempts']))
+                delay = max(delay, retry_after or 0)
+                heapq.heappush(self._retries, (time.monotonic() + delay, next(self._seq), message))
+                self._metrics_for(message['template']).retried += 1
+        if exhausted:
+            self._dead(exhausted, f"{reason} after {self.max_attempts} attempts")
+
+    def _dead(self, messages, reason):
+        logger.error(f"Giving up on {len(messages)} emails: {reason}")
+        with self._lock:
+            for message in messages:
+                self._metrics_for(message['template']).dead += 1
+        if self.dead_letter:
+            try:
+                self.dead_letter(messages, reason)
+            except Exception as e:
+                logger.error(f"Failed to record dead-lettered emails: {e}")
+
+    def restore(self):
+        """Queue messages spilled by this or earlier processes"""
+        if not self.spill_dir:
+            return 0
+        messages = claim_jsonl(self.spill_dir, 'outbox-*.jsonl')
+        with self._lock:
+            for message in messages:
+                self._seen[message['key']] = True
+                self._ready.append(message)
+        if messages:
+            logger.info(f"Restored {len(messages)} spilled emails")
+            self._wakeup.set()
+        return len(messages)
+
+    def shutdown(self, timeout=5.0):
+        """Try to send what is due, then spill whatever is left"""
+        if self._send_lock.acquire(timeout=timeout):
+            self._send_lock.release()
+            if self.transport and timeout > 0:
+                self.flush()
+        with self._lock:
+            pending = list(self._ready) + [message for _, _, message in self._retries]
+            self._ready.clear()
+            self._retries = []
+        if pending and self.spill_dir:
+            try:
+                append_jsonl(os.path.join(self.spill_dir, f"outbox-{os.getpid()}.jsonl"), pending)
+            except OSError as e:
+                logger.error(f"Failed to spill {len(pending)} emails: {e}")
+        return len(pending)
+
+    def backlog(self):
+        """Messages queued or waiting for a retry - producers can hold off while this is high"""
+        with self._lock:
+            return len(self._ready) + len(self._retries)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            templates = {name: metrics.snapshot(now) for name, metrics in self._metrics.items()}
+            return {
+                'ready': len(self._ready),
+                'retrying': len(self._retries),
+                'requests': self._requests,
+                'templates': templates,
+            }
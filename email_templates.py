@@ -0,0 +1,107 @@
+"""
+Email rendering from Jinja templates in templates/emails/.
+
+Templates are compiled once by the Flask Jinja environment (autoescaping is
+on for .html, so names and prayer titles are escaped) and cached there.
+
+render_many() renders one template for many recipients. The template is
+rendered a single time with placeholder markers for the per-recipient
+fields and split into static chunks; each recipient then costs one escape
+per field and one ''.join. Per-recipient fields may be output directly or
+with an `or` default (`{{ name or 'Friend' }}`), but must not drive other
+template logic. Recipients with an empty field fall back to a full render,
+so those defaults still apply.
+
+render_substitutions() uses the same single render but leaves SendGrid
+substitution tags (-name-) in the body, so a whole campaign page shares a
+couple of HTML bodies and goes out in one or two SendGrid requests.
+"""
+
+import re
+
+from markupsafe import escape
+
+_MARKER = re.compile('\x00(\\d+)\x00')
+
+
+class EmailTemplates:
+    """Renders templates/emails/* through a Jinja environment"""
+
+    def __init__(self, jinja_env, prefix='emails/'):
+        self.jinja_env = jinja_env
+        self.prefix = prefix
+
+    def get_template(self, template_name):
+        # Jinja caches compiled templates, so this is a dictionary lookup after the first call
+        return self.jinja_env.get_template(self.prefix + template_name)
+
+    def render(self, template_name, /, **context):
+        return self.get_template(template_name).render(**context)
+
+    def _layout(self, template, fields, shared):
+        """Render once with a marker per field; None if a field doesn't reach the output unchanged"""
+        skeleton = template.render(**shared, **{field: f"\x00{index}\x00" for index, field in enumerate(fields)})
+        parts = _MARKER.split(skeleton)
+        slots = [(position, fields[int(parts[position])]) for position in range(1, len(parts), 2)]
+        if len({field for _, field in slots}) < len(fields):
+            return None
+        return parts, slots
+
+    def render_many(self, template_name, recipients, /, **shared):
+        """Render a template once per recipient dict; `shared` values are the same for every recipient"""
+        recipients = list(recipients)
+        if not recipients:
+            return []
+        template = self.get_template(template_name)
+        fields = list(recipients[0])
+        layout = self._layout(template, fields, shared)
+        if layout is None:
+            # A field never reaches the output unchanged (filtered or used in logic) - render each in full
+            return [template.render(**shared, **recipient) for recipient in recipients]
+
+        parts, slots = layout
+        rendered = []
+        for recipient in recipients:
+            if not all(recipient.get(field) for field in fields):
+                rendered.append(template.render(**shared, **recipient))
+                continue
+            values = {field: escape(recipient[field]) for field in fields}
+            for position, field in slots:
+                parts[position] = values[field]
+            rendered.append(''.join(parts))
+        return rendered
+
+    def render_substitutions(self, template_name, recipients, /, **shared):
+        """Return (html, substitutions) per recipient for SendGrid personalizations
+
+        Recipients share a body with -field- tags and get their escaped values as
+        substitutions. Empty fields are rendered into the body instead, so the
+        template's defaults apply; recipients whose fields can't be tagged (see
+        render_many) get a full render and None.
+        """
+        recipients = list(recipients)
+        if not recipients:
+            return []
+        template = self.get_template(template_name)
+        fields = list(recipients[0])
+        bodies = {}  # empty (field, value) pairs -> (tagged body, tagged fields), or None
+        rendered = []
+        for recipient in recipients:
+            empty = tuple((field, recipient.get(field)) for field in fields if not recipient.get(field))
+            if empty not in bodies:
+                tagged = [field for field in fields if recipient.get(field)]
+                layout = self._layout(template, tagged, {**shared, **dict(empty)})
+                if layout is None:
+                    bodies[empty] = None
+                else:
+                    parts, slots = layout
+                    for position, field in slots:
+                        parts[position] = f"-{field}-"
+                    bodies[empty] = (''.join(parts), tagged)
+            body = bodies[empty]
+            if body is None:
+                rendered.append((template.render(**shared, **recipient), None))
+            else:
+                html, tagged = body
+                rendered.append((html, {f"-{field}-": str(escape(recipient[field])) for field in tagged} or None))
+        return rendered
@@ -0,0 +1,145 @@
+"""
+Request-scoped Firestore document loading.
+
+One request (or background job) often reads the same document more than once
+- the conversation document is read by ConversationStore._sync and again by
+load_messages, the user document by a job and again by
+check_email_preferences - and makes independent single-document reads one
+round trip after another. A DocumentLoader lives for one request (flask.g)
+or one background job (loader_scope) and:
+
+- caches every snapshot it reads, so a repeated read costs nothing
+- loads several documents with one get_all (prefetch / get_many)
+- counts round trips, documents and cache hits, and the time spent waiting
+
+Writes made through the same scope should call forget_document() so later
+reads in the scope see them. FirestoreCallStats aggregates the counters per
+endpoint or job for /api/internal/stats.
+
+get_document() is what the state backends call: it goes through the current
+loader when there is one and falls back to a plain read otherwise.
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+# Documents per get_all round trip
+MAX_GET_ALL = 100
+
+_job_loader = contextvars.ContextVar('firestore_loader', default=None)
+
+
+class DocumentLoader:
+    """Per-scope cache of document snapshots with batched loading"""
+
+    def __init__(self, db):
+        self.db = db
+        self._snapshots = {}  # document path -> snapshot
+        self.calls = 0
+        self.documents = 0
+        self.hits = 0
+        self.wait_seconds = 0.0
+
+    def get(self, ref):
+        snapshot = self._snapshots.get(ref.path)
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+        started = time.perf_counter()
+        snapshot = ref.get()
+        self._record(started, 1)
+        self._snapshots[ref.path] = snapshot
+        return snapshot
+
+    def get_many(self, refs):
+        """Snapshots for refs, in order; everything not cached yet is loaded with get_all"""
+        self.prefetch(refs)
+        return [self._snapshots[ref.path] for ref in refs]
+
+    def prefetch(self, refs):
+        """Load the uncached refs in as few round trips as possible"""
+        missing = list({ref.path: ref for ref in refs if ref.path not in self._snapshots}.values())
+        self.hits += len(refs) - len(missing)
+        for offset in range(0, len(missing), MAX_GET_ALL):
+            chunk = missing[offset:offset + MAX_GET_ALL]
+            started = time.perf_counter()
+            snapshots = list(self.db.get_all(chunk))
+            self._record(started, len(chunk))
+            for snapshot in snapshots:
+                self._snapshots[snapshot.reference.path] = snapshot
+
+    def forget(self, ref):
+        self._snapshots.pop(ref.path, None)
+
+    def _record(self, started, documents):
+        self.wait_seconds += time.perf_counter() - started
+        self.calls += 1
+        self.documents += documents
+
+
+def current_loader():
+    """The loader for the current request or background job, or None"""
+    if has_request_context():
+        return g.get('firestore_loader')
+    return _job_loader.get()
+
+
+def get_document(ref):
+    """Read a document through the current loader (cached per scope), or directly without one"""
+    loader = current_loader()
+    return loader.get(ref) if loader else ref.get()
+
+
+def forget_document(ref):
+    """Drop a document the current scope just wrote, so its next read goes to Firestore"""
+    loader = current_loader()
+    if loader:
+        loader.forget(ref)
+
+
+@contextmanager
+def loader_scope(db, stats, scope):
+    """Give the code inside (a background job) its own loader; counters are recorded under `scope`"""
+    loader = DocumentLoader(db)
+    token = _job_loader.set(loader)
+    try:
+        yield loader
+    finally:
+        _job_loader.reset(token)
+        stats.record(scope, loader)
+
+
+class FirestoreCallStats:
+    """Firestore round trips, documents, cache hits and wait time per endpoint or job"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scopes = {}
+
+    def record(self, scope, loader):
+        if not loader.calls and not loader.hits:
+            return
+        with self._lock:
+            totals = self._scopes.setdefault(scope, {'scopes': 0, 'calls': 0, 'documents': 0, 'hits': 0, 'wait_seconds': 0.0})
+            totals['scopes'] += 1
+            totals['calls'] += loader.calls
+            totals['documents'] += loader.documents
+            totals['hits'] += loader.hits
+            totals['wait_seconds'] += loader.wait_seconds
+
+    def stats(self):
+        with self._lock:
+            return {
+                scope: {
+                    'requests': totals['scopes'],
+                    'calls_per_request': round(totals['calls'] / totals['scopes'], 2),
+                    'documents_per_request': round(totals['documents'] / totals['scopes'], 2),
+                    'deduplicated_reads': totals['hits'],
+                    'avg_wait_ms': round(totals['wait_seconds'] / totals['scopes'] * 1000, 1),
+                }
+                for scope, totals in self._scopes.items()
+            }
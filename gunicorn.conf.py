@@ -0,0 +1,32 @@
+"""
+Gunicorn settings for App Engine (see ASYNC_WORKERS.md)
+
+Chat, Stripe and Firestore calls spend almost all of their time waiting on the
+network, so workers are gevent-based: each worker process multiplexes
+hundreds of in-flight requests instead of holding one request per process.
+"""
+
+import os
+
+bind = f":{os.getenv('PORT', '8080')}"
+
+# One process per vCPU is plenty - concurrency comes from greenlets, not processes
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+# Max simultaneous requests per worker (gevent workers only)
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '500'))
+
+# Streaming chat replies can legitimately stay open for the full upstream read timeout
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    # App Engine's /_ah/warmup request reaches a single worker; warm the others as they boot
+    if os.getenv('WARMUP_ON_BOOT', '1') == '1':
+        from startup import warmup
+        warmup.start_background()
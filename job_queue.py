@@ -0,0 +1,234 @@
+"""
+In-process background jobs for side effects that don't belong on the request path.
+
+Handlers are registered by name and jobs carry JSON-serializable keyword
+arguments, so a job can be written to disk and picked up again later:
+
+- the queue is bounded; jobs that don't fit are appended to a spill file
+  instead of being dropped, and read back once the queue has drained
+- failed jobs are retried with exponential backoff (full jitter) up to
+  `max_attempts`, then logged and counted as dead
+- on shutdown everything still queued is spilled, and the next process to
+  start claims the spill files and runs those jobs
+
+Handlers must be idempotent - a job can run again after a crash or a retry.
+"""
+
+import glob
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def append_jsonl(path, records):
+    """Append records to a JSON-lines file, creating its directory if needed"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as spill_file:
+        for record in records:
+            spill_file.write(json.dumps(record) + '\n')
+
+
+def claim_jsonl(directory, pattern):
+    """Take ownership of spill files matching `pattern` and return their records"""
+    records = []
+    for path in glob.glob(os.path.join(directory, pattern)):
+        claimed = f"{path}.claimed-{os.getpid()}"
+        try:
+            # rename is atomic, so two workers starting together never both load a file
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        try:
+            with open(claimed) as spill_file:
+                records.extend(json.loads(line) for line in spill_file if line.strip())
+            os.remove(claimed)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to restore records from {claimed}: {e}")
+    return records
+
+
+class JobQueue:
+    """Bounded delay-queue served by worker threads, with retries and a JSONL spill file"""
+
+    def __init__(self, max_pending=1000, workers=2, max_attempts=5, backoff_base=1.0, backoff_cap=300.0,
+                 spill_dir=None, job_context=None):
+        """job_context: optional callable(job_name) -> context manager entered around each handler call"""
+        self.max_pending = max_pending
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.spill_dir = spill_dir
+        self.job_context = job_context
+        self._handlers = {}
+        self._heap = []  # (run_at, seq, job)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._started = False
+        self._stopping = False
+        self._running = 0
+        self._overflowed = False
+        self._stats = {'enqueued': 0, 'completed': 0, 'retried': 0, 'dead': 0, 'spilled': 0, 'restored': 0}
+
+    def handler(self, func):
+        """Decorator: register a function as the handler for jobs named after it"""
+        self._handlers[func.__name__] = func
+        return func
+
+    def enqueue(self, name, delay=0, **kwargs):
+        """Queue a job for a registered handler and return its id"""
+        if name not in self._handlers:
+            raise KeyError(f"No job handler registered for '{name}'")
+        job = {'id': secrets.token_hex(8), 'name': name, 'kwargs': kwargs, 'attempts': 0}
+        self.start()
+        with self._cond:
+            self._stats['enqueued'] += 1
+            if len(self._heap) >= self.max_pending:
+                self._spill([job])
+                self._overflowed = True
+            else:
+                self._push(job, time.monotonic() + delay)
+        return job['id']
+
+    def _push(self, job, run_at):
+        heapq.heappush(self._heap, (run_at, next(self._seq), job))
+        self._cond.notify()
+
+    def start(self):
+        """Start the workers and restore spilled jobs (idempotent)"""
+        # Threads are started lazily so they belong to the serving (post-fork) worker process
+        if self._started:
+            return
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self.restore()
+
+    def _next_job(self):
+        with self._cond:
+            while not self._stopping:
+                if self._heap:
+                    wait = self._heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        self._running += 1
+                        return heapq.heappop(self._heap)[2]
+                else:
+                    wait = None
+                self._cond.wait(wait)
+            return None
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+                    drained = self._overflowed and not self._heap
+                    if drained:
+                        self._overflowed = False
+            if drained:
+                self.restore(own_only=True)
+
+    def _run(self, job):
+        job['attempts'] += 1
+        try:
+            if self.job_context:
+                with self.job_context(job['name']):
+                    self._handlers[job['name']](**job['kwargs'])
+            else:
+                self._handlers[job['name']](**job['kwargs'])
+        except Exception as e:
+            if job['attempts'] >= self.max_attempts:
+                logger.error(f"Job {job['name']} ({job['id']}) failed permanently after {job['attempts']} attempts: {e}")
+                with self._cond:
+                    self._stats['dead'] += 1
+                return
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (job['attempts'] - 1)))
+            logger.warning(f"Job {job['name']} ({job['id']}) failed (attempt {job['attempts']}), retrying in {delay:.1f}s: {e}")
+            with self._cond:
+                self._stats['retried'] += 1
+                self._push(job, time.monotonic() + delay)
+            return
+        with self._cond:
+            self._stats['completed'] += 1
+
+    def _spill(self, jobs):
+        """Append jobs to this process's spill file (caller holds the lock)"""
+        if not jobs:
+            return
+        if not self.spill_dir:
+            logger.error(f"Job queue full and no spill directory - dropping {len(jobs)} jobs")
+            return
+        try:
+            append_jsonl(os.path.join(self.spill_dir, f"jobs-{os.getpid()}.jsonl"), jobs)
+            self._stats['spilled'] += len(jobs)
+        except (OSError, TypeError, ValueError) as e:
+            logger.error(f"Failed to spill {len(jobs)} jobs: {e}")
+
+    def restore(self, own_only=False):
+        """Claim spill files left by this or earlier processes and queue their jobs"""
+        if not self.spill_dir:
+            return 0
+        pattern = f"jobs-{os.getpid()}.jsonl" if own_only else 'jobs-*.jsonl'
+        jobs = claim_jsonl(self.spill_dir, pattern)
+
+        now = time.monotonic()
+        with self._cond:
+            overflow = []
+            for job in jobs:
+                if job.get('name') not in self._handlers:
+                    logger.error(f"Dropping spilled job with unknown handler: {job.get('name')}")
+                elif len(self._heap) >= self.max_pending:
+                    overflow.append(job)
+                    self._overflowed = True
+                else:
+                    self._push(job, now)
+                    self._stats['restored'] += 1
+            self._spill(overflow)
+        if jobs:
+            logger.info(f"Restored {len(jobs)} spilled background jobs")
+        return len(jobs)
+
+    def shutdown(self, timeout=5.0):
+        """Let due jobs finish for up to `timeout` seconds, then spill whatever is left"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while (self._running or (self._heap and self._heap[0][0] <= time.monotonic())) and self._threads:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            self._stopping = True
+            self._cond.notify_all()
+            pending = [job for _, _, job in self._heap]
+            self._heap = []
+            self._spill(pending)
+        return len(pending)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._heap)
+            stats['running'] = self._running
+        stats['max_pending'] = self.max_pending
+        stats['workers'] = self.workers
+        return stats
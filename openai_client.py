@@ -0,0 +1,312 @@
+"""
+Shared OpenAI HTTP client: pooled keep-alive connections, bounded concurrency,
+jittered retries on 429/5xx and a circuit breaker that fails fast when the
+upstream is unhealthy.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+    """Raised when the circuit is open or every upstream slot is busy"""
+
+
+class UpstreamError(Exception):
+    """Raised when OpenAI answers with a non-200 status after all retries"""
+
+    def __init__(self, status_code, body):
+        super().__init__(f"OpenAI returned {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._times_opened = 0
+        self._rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow_request(self):
+        """Return True if a call may go upstream right now"""
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self._rejected += 1
+                    return False
+                # Cool-down elapsed: let exactly one probe through
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._rejected += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                logger.info("OpenAI circuit closed")
+            self._state = self.CLOSED
+            self._consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self._times_opened += 1
+                    logger.warning(f"OpenAI circuit opened after {self._consecutive_failures} consecutive failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'times_opened': self._times_opened,
+                'rejected': self._rejected,
+            }
+
+
+class ChatStream:
+    """Iterator over content deltas of a streaming chat completion.
+
+    Holds an upstream concurrency slot until it is exhausted or closed; close()
+    can be called any number of times and is also tried when the stream is collected.
+    """
+
+    def __init__(self, response, on_close):
+        self._response = response
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            self._response.encoding = 'utf-8'
+            # chunk_size=None hands lines over as soon as they arrive instead of waiting for 512-byte blocks
+            for line in self._response.iter_lines(chunk_size=None, decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                payload = line[len('data:'):].strip()
+                if payload == '[DONE]':
+                    break
+                chunk = json.loads(payload)
+                choices = chunk.get('choices') or [{}]
+                content = choices[0].get('delta', {}).get('content')
+                if content:
+                    yield content
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._response.close()
+        self._on_close()
+
+    def __del__(self):
+        # Last resort for a stream dropped without being iterated or closed
+        self.close()
+
+
+class OpenAIClient:
+    """Process-wide OpenAI client shared by every request handler"""
+
+    def __init__(self, api_key, base_url='https://api.openai.com/v1', pool_size=20,
+                 max_concurrency=20, max_retries=2, connect_timeout=5, read_timeout=30,
+                 acquire_timeout=5.0, backoff_base=0.5, backoff_cap=8.0, breaker=None):
+        self.base_url = base_url.rstrip('/')
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = (connect_timeout, read_timeout)
+        self.acquire_timeout = acquire_timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.breaker = breaker or CircuitBreaker()
+
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self._adapter)
+        self.session.mount('http://', self._adapter)
+        self.session.headers.update({
+            'Authorization': f"Bearer {api_key}",
+            'Content-Type': 'application/json',
+        })
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counters = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'saturated': 0,
+        }
+
+    def chat_completion(self, payload):
+        """Run a non-streaming chat completion and return the decoded JSON body"""
+        response = self._post('/chat/completions', payload, stream=False)
+        try:
+            return response.json()
+        finally:
+            response.close()
+            self._release()
+
+    def stream_chat_completion(self, payload):
+        """Open a streaming chat completion.
+
+        Connection errors and non-200 statuses raise here, before the first delta.
+        """
+        response = self._post('/chat/completions', dict(payload, stream=True), stream=True)
+        return ChatStream(response, self._release)
+
+    def prime(self, connections=2):
+        """Open keep-alive connections ahead of traffic (GET /models) so early chats skip TCP/TLS setup"""
+        def fetch(_):
+            # Requests made at the same time each take their own connection from the pool
+            return self.session.get(f"{self.base_url}/models", timeout=self.timeout).status_code
+
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            return list(pool.map(fetch, range(connections)))
+
+    def _post(self, path, payload, stream):
+        # Take the slot before consulting the breaker so a rejected acquire never
+        # strands the half-open probe
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            self._bump('saturated')
+            raise UpstreamUnavailable('all upstream slots are busy')
+        with self._lock:
+            self._in_flight += 1
+
+        try:
+            if not self.breaker.allow_request():
+                raise UpstreamUnavailable('circuit breaker is open')
+            return self._post_with_retries(path, payload, stream)
+        except BaseException:
+            self._release()
+            raise
+
+    def _post_with_retries(self, path, payload, stream):
+        url = f"{self.base_url}{path}"
+        attempt = 0
+        while True:
+            self._bump('requests')
+            retry_after = None
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+            except requests.RequestException as e:
+                if attempt >= self.max_retries:
+                    self._bump('failures')
+                    self.breaker.record_failure()
+                    raise
+                logger.warning(f"OpenAI request failed ({e}), retrying")
+            else:
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    return response
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    # 4xx means the upstream is healthy and the request is at fault
+                    self.breaker.record_success()
+                    raise self._error(response)
+                if attempt >= self.max_retries:
+                    self._bump('failures')
+                    self.breaker.record_failure()
+                    raise self._error(response)
+                retry_after = response.headers.get('Retry-After')
+                response.close()
+                logger.warning(f"OpenAI returned {response.status_code}, retrying")
+
+            self._bump('retries')
+            time.sleep(self._backoff(attempt, retry_after))
+            attempt += 1
+
+    @staticmethod
+    def _error(response):
+        """UpstreamError for a failed response, which is read and closed so its pooled connection is freed"""
+        try:
+            return UpstreamError(response.status_code, response.text)
+        finally:
+            response.close()
+
+    def _backoff(self, attempt, retry_after=None):
+        """Full-jitter exponential backoff, honouring Retry-After when it is reasonable"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_cap)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _bump(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def pool_stats(self):
+        """Connection pool occupancy per upstream host"""
+        pools = {}
+        manager = self._adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                'connections_opened': pool.num_connections,
+                'requests_sent': pool.num_requests,
+                # urllib3 pre-fills the queue with None placeholders for unopened slots
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                'max_size': pool.pool.maxsize if pool.pool else 0,
+            }
+        return pools
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            in_flight = self._in_flight
+        return {
+            'in_flight': in_flight,
+            'max_concurrency': self.max_concurrency,
+            **counters,
+            'pools': self.pool_stats(),
+            'breaker': self.breaker.stats(),
+        }
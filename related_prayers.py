@@ -0,0 +1,228 @@
+"""
+"Prayers like yours": TF-IDF cosine similarity over public prayers, in NumPy.
+
+Comparing a prayer with every other one per request, in Python, is far too
+slow. RelatedPrayers keeps the public prayers as one sparse TF-IDF matrix:
+
+- rows come from the search index (search_index.py), which has already
+  analyzed every public prayer; document numbers there only grow, so
+  sync() appends the rows added since the last call - built in one batch
+  the first time, a few rows at a time after that
+- the matrix is stored as coordinates (row, column, 1 + log tf) - a few
+  dozen entries per prayer instead of a dense row per vocabulary - with
+  the idf vector and row norms recomputed, vectorized, whenever rows are
+  appended (smooth idf: log((1 + N) / (1 + df)) + 1)
+- a query is a single vectorized product: the query's weights are spread
+  over the vocabulary, gathered at each entry's column and summed per row
+  with bincount, then divided by the row norms and cut to the top k with
+  argpartition
+- results for a prayer are cached for `cache_seconds`, so reopening the
+  same prayer doesn't recompute them; a private prayer's results are keyed
+  by its text too, so an edit isn't answered from the cache
+- every result list is checked with the search index's verify() before it
+  is returned. Prayers that aren't public anymore leave the index, and
+  sync() drops their rows
+
+NumPy is imported on first use, not at startup.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from search_index import analyze
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+
+class RelatedPrayers:
+    """Top-k cosine similarity between prayers over a TF-IDF matrix fed by the search index"""
+
+    def __init__(self, index, cache_seconds=600, cache_entries=10000):
+        """index: the SearchIndex whose analyzed documents become the matrix rows"""
+        self.index = index
+        self._lock = threading.Lock()
+        self._ids = []  # row -> confession id
+        self._items = []  # row -> feed item
+        self._rows = {}  # confession id -> row
+        self._vocabulary = {}  # term -> column
+        self._entry_rows = self._entry_columns = self._entry_weights = None
+        self._idf = None
+        self._norms = None
+        self._synced = 0  # search index documents consumed
+        self._removals_synced = 0  # search index removals consumed
+        self._dropped = set()  # rows of prayers the index removed - kept, without entries
+        self._generation = 0  # bumped when rows are dropped, so cached results are recomputed
+        self._results = BoundedStore(max_entries=cache_entries, ttl_seconds=cache_seconds)
+        self._stats = {'queries': 0, 'cache_hits': 0, 'query_ms_total': 0.0, 'rows_appended': 0, 'rows_dropped': 0,
+                       'syncs': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    # Matrix
+
+    def sync(self):
+        """Catch up with the search index: append its new prayers, drop removed ones; returns rows appended"""
+        import numpy as np
+        with self._lock:
+            appended = self._append(np)
+            dropped = self._drop(np)
+            if appended or dropped:
+                self._reweigh(np)
+                self._stats['syncs'] += 1
+        return appended
+
+    def _append(self, np):
+        """Rows for documents the index added (lock held)"""
+        batch = self.index.documents(self._synced)
+        self._synced += len(batch)
+        # Numbers of documents removed from the index stay taken; they get no row
+        documents = [(item, terms) for item, terms in batch if item is not None]
+        if not documents:
+            return 0
+        rows, columns, weights = [], [], []
+        for offset, (item, terms) in enumerate(documents):
+            row = len(self._ids) + offset
+            for term, frequency in terms.items():
+                column = self._vocabulary.setdefault(term, len(self._vocabulary))
+                rows.append(row)
+                columns.append(column)
+                weights.append(1 + math.log(frequency))
+        for item, _ in documents:
+            self._rows[item['id']] = len(self._ids)
+            self._ids.append(item['id'])
+            self._items.append(item)
+
+        new_rows = np.array(rows, dtype=np.int32)
+        new_columns = np.array(columns, dtype=np.int32)
+        new_weights = np.array(weights, dtype=np.float32)
+        if self._entry_rows is None:
+            self._entry_rows, self._entry_columns, self._entry_weights = new_rows, new_columns, new_weights
+        else:
+            self._entry_rows = np.concatenate([self._entry_rows, new_rows])
+            self._entry_columns = np.concatenate([self._entry_columns, new_columns])
+            self._entry_weights = np.concatenate([self._entry_weights, new_weights])
+        self._stats['rows_appended'] += len(documents)
+        return len(documents)
+
+    def _drop(self, np):
+        """Remove the entries of prayers the index removed (lock held); their rows stay, empty"""
+        removed = self.index.removals(self._removals_synced)
+        self._removals_synced += len(removed)
+        rows = [self._rows.pop(confession_id) for confession_id in removed if confession_id in self._rows]
+        if not rows:
+            return 0
+        self._dropped.update(rows)
+        keep = ~np.isin(self._entry_rows, np.array(rows, dtype=np.int32))
+        self._entry_rows = self._entry_rows[keep]
+        self._entry_columns = self._entry_columns[keep]
+        self._entry_weights = self._entry_weights[keep]
+        # Cached results may include them
+        self._generation += 1
+        self._stats['rows_dropped'] += len(rows)
+        return len(rows)
+
+    def _reweigh(self, np):
+        """Recompute idf and row norms for the current rows (lock held)"""
+        count = len(self._ids) - len(self._dropped)
+        document_frequency = np.bincount(self._entry_columns, minlength=len(self._vocabulary))
+        self._idf = (np.log((1 + count) / (1 + document_frequency)) + 1).astype(np.float32)
+        weighted = self._entry_weights * self._idf[self._entry_columns]
+        norms = np.sqrt(np.bincount(self._entry_rows, weights=weighted * weighted, minlength=len(self._ids)))
+        # Prayers without a single indexed word (or dropped ones) never match anything
+        norms[norms == 0] = np.inf
+        self._norms = norms
+
+    # Queries
+
+    def _top(self, query_terms, limit, exclude=None):
+        """Feed items of the `limit` rows most similar to the analyzed terms, with a `similarity`"""
+        import numpy as np
+        with self._lock:
+            if not self._ids:
+                return []
+            query = np.zeros(len(self._vocabulary), dtype=np.float32)
+            for term, frequency in query_terms.items():
+                column = self._vocabulary.get(term)
+                if column is not None:
+                    query[column] = (1 + math.log(frequency)) * self._idf[column]
+            query_norm = float(np.linalg.norm(query))
+            if query_norm == 0:
+                return []
+            # X @ q over the coordinate entries: gather the query weight at each entry's column, sum per row
+            products = self._entry_weights * self._idf[self._entry_columns] * query[self._entry_columns]
+            scores = np.bincount(self._entry_rows, weights=products, minlength=len(self._ids)) / (self._norms * query_norm)
+            if exclude is not None and exclude in self._rows:
+                scores[self._rows[exclude]] = -1
+            wanted = min(limit, len(scores))
+            best = np.argpartition(-scores, wanted - 1)[:wanted]
+            best = best[np.argsort(-scores[best])]
+            return [dict(self._items[row], similarity=round(float(scores[row]), 4))
+                    for row in best if scores[row] > 0]
+
+    @staticmethod
+    def _term_frequencies(title, text):
+        terms = {}
+        for term in analyze(f"{title or ''} {text or ''}"):
+            terms[term] = terms.get(term, 0) + 1
+        return terms
+
+    def related(self, confession_id, limit=5, title=None, text=None):
+        """Public prayers most similar to a prayer, most similar first
+
+        Prayers in the search index are compared by their row; others (private
+        ones) need their `title` and `text`. None if the prayer is unknown.
+        """
+        self.index.ensure_loaded()
+        self.sync()
+        while True:
+            results = self._related(confession_id, limit, title, text)
+            if results is None:
+                return None
+            verified = self.index.verify(results)
+            if len(verified) == len(results):
+                return verified
+            # Some weren't public anymore and left the index - drop their rows and look again
+            self.sync()
+
+    def _related(self, confession_id, limit, title, text):
+        """Unverified results, cached per prayer (and per text, for a prayer outside the index)"""
+        with self._lock:
+            row = self._rows.get(confession_id)
+            if row is not None:
+                title, text = self._items[row]['title'], self._items[row]['text']
+            generation = self._generation
+        if row is None and text is None:
+            return None
+        if row is None:
+            digest = hashlib.sha1(f"{title or ''}\0{text}".encode('utf-8')).hexdigest()
+            key = (confession_id, limit, digest)
+        else:
+            key = (confession_id, limit)
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == generation:
+            self._count('cache_hits')
+            return cached[1]
+
+        started = time.perf_counter()
+        results = self._top(self._term_frequencies(title, text), limit, exclude=confession_id)
+        with self._lock:
+            self._stats['queries'] += 1
+            self._stats['query_ms_total'] += (time.perf_counter() - started) * 1000
+        self._results[key] = (generation, results)
+        return results
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['rows'] = len(self._ids) - len(self._dropped)
+            stats['vocabulary'] = len(self._vocabulary)
+            stats['entries'] = 0 if self._entry_rows is None else int(self._entry_rows.shape[0])
+        queries = stats.pop('query_ms_total')
+        stats['average_query_ms'] = round(queries / stats['queries'], 2) if stats['queries'] else None
+        return stats
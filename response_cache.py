@@ -0,0 +1,134 @@
+"""
+Cache of AI replies for repeated prompts (mostly opening messages).
+
+Keys are the system prompt plus normalized messages. Each key collects up to
+`variants` distinct replies before it starts serving hits, and hits pick one
+of them at random so cached answers don't feel canned. Identical requests
+that miss at the same time share one upstream call (single-flight).
+"""
+
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace"""
+    return _WHITESPACE.sub(' ', _PUNCTUATION.sub('', text.lower())).strip()
+
+
+class _Flight:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ResponseCache:
+    """LRU + TTL reply cache with multiple variants per key and single-flight misses"""
+
+    def __init__(self, max_entries=2000, ttl_seconds=6 * 3600, variants=5, wait_timeout=35.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = variants
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    @staticmethod
+    def make_key(messages):
+        """Cache key for a message list: roles plus normalized contents"""
+        normalized = [(msg['role'], normalize_text(msg['content'])) for msg in messages]
+        return hashlib.sha256(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return a cached reply, or None until the key has collected all its variants"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] <= time.monotonic():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                entry = None
+            if entry is None or len(entry['replies']) < self.variants:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return random.choice(entry['replies'])
+
+    def put(self, key, reply):
+        """Add a reply variant for a key"""
+        if not reply:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['expires_at'] <= time.monotonic():
+                entry = {'replies': [], 'expires_at': time.monotonic() + self.ttl_seconds}
+                self._entries[key] = entry
+            if reply not in entry['replies'] and len(entry['replies']) < self.variants:
+                entry['replies'].append(reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def get_or_compute(self, key, compute):
+        """Return a cached reply or compute one, coalescing identical concurrent misses"""
+        reply = self.get(key)
+        if reply is not None:
+            return reply
+
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = _Flight()
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            if flight.event.wait(self.wait_timeout) and flight.error is None:
+                return flight.result
+            if flight.error is not None:
+                raise flight.error
+            return compute()
+
+        try:
+            flight.result = compute()
+            self.put(key, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['in_flight'] = len(self._in_flight)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['variants'] = self.variants
+        return stats
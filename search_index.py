@@ -0,0 +1,417 @@
+"""
+Full-text search over public prayers: an in-memory inverted index ranked with BM25.
+
+Finding "prayers about grief" used to mean reading the whole confessions
+collection. SearchIndex keeps an inverted index of the title and text of
+every public confession instead:
+
+- text is lowercased, split into words, stripped of stop words and reduced
+  with nltk's PorterStemmer, so "grieving" also finds prayers that say
+  "grieve" or "grieved"; the query goes through the same analyzer
+- postings map each term to {document number: term frequency}, and a query
+  only touches the postings of its own terms, scored with BM25 (k1=1.2,
+  b=0.75) and cut to the top `limit` with a heap
+- prayers saved on this worker are added right away (add()); prayers saved
+  elsewhere are picked up by a catch-up query every `catchup_seconds` for
+  public confessions created after the watermark
+- snapshot() is the analyzed index (terms, not text to re-stem) with its
+  watermark. A snapshot store keeps it in Cloud Storage (or a local file),
+  and a new worker loads it and only catches up on what's newer. The full
+  scan only happens when there is no snapshot yet
+- catching up never sees a prayer that was made private or deleted, so the
+  hits of every query are checked against Firestore (one get_all of `limit`
+  documents) before they are returned. Prayers that aren't public anymore
+  are removed - from the index, later snapshots and the related prayers
+
+The index holds title, text, created_at and upvotes of each prayer so
+results render without another read; upvote counts are as of indexing.
+"""
+
+import gzip
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from confession_feed import FEED_FIELDS, feed_item
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# BM25 parameters (the usual defaults)
+K1 = 1.2
+B = 0.75
+
+# Saves on other workers may carry a slightly different clock; catch-up re-reads this far back
+WATERMARK_OVERLAP = timedelta(minutes=2)
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between
+both but by can could did do does doing down during each few for from further had has have having he her
+here hers herself him himself his how i if in into is it its itself just me more most my myself no nor not
+now of off on once only or other our ours ourselves out over own s same she should so some such t than that
+the their theirs them themselves then there these they this those through to too under until up very was we
+were what when where which while who whom why will with would you your yours yourself yourselves
+""".split())
+
+
+@lru_cache(maxsize=1)
+def _stemmer():
+    # nltk takes ~0.3 s to import - only pay for it when the index is first used
+    from nltk.stem.porter import PorterStemmer
+    return PorterStemmer()
+
+
+@lru_cache(maxsize=50000)
+def stem(word):
+    return _stemmer().stem(word)
+
+
+def analyze(text):
+    """The index terms of a text, in order"""
+    return [stem(word) for word in WORD_PATTERN.findall((text or '').lower()) if word not in STOP_WORDS]
+
+
+def _aware(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+class FileSnapshotStore:
+    """Snapshot as a gzipped JSON file (local runs; App Engine's /tmp doesn't outlive the instance)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with gzip.open(self.path, 'rt') as snapshot_file:
+                return json.load(snapshot_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, snapshot):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary = f"{self.path}.{os.getpid()}"
+        with gzip.open(temporary, 'wt') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        # rename is atomic - a worker loading meanwhile never sees half a snapshot
+        os.replace(temporary, self.path)
+
+
+class StorageSnapshotStore:
+    """Snapshot as a gzipped JSON object in Cloud Storage, shared by every instance"""
+
+    def __init__(self, bucket, name='search/confessions-index.json.gz'):
+        self.bucket = bucket
+        self.name = name
+        self._blob = None
+
+    def _get_blob(self):
+        if self._blob is None:
+            from google.cloud import storage
+            self._blob = storage.Client().bucket(self.bucket).blob(self.name)
+        return self._blob
+
+    def load(self):
+        from google.api_core.exceptions import NotFound
+        try:
+            return json.loads(gzip.decompress(self._get_blob().download_as_bytes()))
+        except NotFound:
+            return None
+
+    def save(self, snapshot):
+        self._get_blob().upload_from_string(gzip.compress(json.dumps(snapshot).encode('utf-8')),
+                                            content_type='application/gzip')
+
+
+class SearchIndex:
+    """BM25 search over the title and text of public confessions"""
+
+    def __init__(self, db, store=None, catchup_seconds=60.0, cache_entries=1000):
+        self.db = db
+        self.store = store
+        self.catchup_seconds = catchup_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._items = []  # document number -> feed item
+        self._lengths = []  # document number -> number of terms
+        self._terms = []  # document number -> {term: frequency}, kept for snapshots
+        self._numbers = {}  # confession id -> document number, for documents still in the index
+        self._removed = []  # confession ids removed, in order (their numbers stay taken)
+        self._postings = {}  # term -> {document number: frequency}
+        self._total_length = 0
+        self._watermark = None  # newest created_at seen by a Firestore read (aware datetime)
+        self._version = 0
+        self._results = BoundedStore(max_entries=cache_entries, ttl_seconds=3600)
+        self._loaded = False
+        self._catcher = None
+        self._stats = {'queries': 0, 'cache_hits': 0, 'query_ms_total': 0.0, 'added': 0, 'removed': 0,
+                       'catchups': 0, 'catchup_errors': 0, 'snapshot_loaded': 0, 'snapshots_saved': 0,
+                       'full_scans': 0}
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    # Indexing
+
+    def _index(self, item, terms):
+        """Add an analyzed prayer (lock held); False if it was already indexed"""
+        if item['id'] in self._numbers:
+            return False
+        number = len(self._items)
+        self._numbers[item['id']] = number
+        self._items.append(item)
+        self._terms.append(terms)
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[number] = frequency
+        self._version += 1
+        return True
+
+    @staticmethod
+    def _term_frequencies(item):
+        terms = {}
+        for term in analyze(f"{item.get('title') or ''} {item.get('text') or ''}"):
+            terms[term] = terms.get(term, 0) + 1
+        return terms
+
+    def add(self, item):
+        """Index a public prayer (a feed item); returns False if it was already indexed"""
+        terms = self._term_frequencies(item)
+        with self._lock:
+            added = self._index(item, terms)
+            if added:
+                self._stats['added'] += 1
+        return added
+
+    def remove(self, confession_id):
+        """Take a prayer out of the index (made private or deleted); returns False if it wasn't in it"""
+        with self._lock:
+            number = self._numbers.pop(confession_id, None)
+            if number is None:
+                return False
+            for term in self._terms[number]:
+                postings = self._postings[term]
+                del postings[number]
+                if not postings:
+                    del self._postings[term]
+            self._total_length -= self._lengths[number]
+            self._items[number] = self._terms[number] = None
+            self._removed.append(confession_id)
+            self._version += 1
+            self._stats['removed'] += 1
+        logger.info(f"Removed prayer {confession_id} from the search index")
+        return True
+
+    def verify(self, items):
+        """The items whose confession is still public, in order; the others are removed from the index"""
+        if not items:
+            return items
+        refs = [self.db.collection('confessions').document(item['id']) for item in items]
+        public = {doc.id for doc in self.db.get_all(refs, field_paths=['is_public'])
+                  if doc.exists and (doc.to_dict() or {}).get('is_public')}
+        for item in items:
+            if item['id'] not in public:
+                self.remove(item['id'])
+        return [item for item in items if item['id'] in public]
+
+    def _add_documents(self, docs):
+        """Index confession documents read from Firestore and advance the watermark"""
+        added = 0
+        for doc in docs:
+            item = feed_item(doc)
+            terms = self._term_frequencies(item)
+            created_at = (doc.to_dict() or {}).get('created_at')
+            with self._lock:
+                added += self._index(item, terms)
+                if created_at and (self._watermark is None or _aware(created_at) > self._watermark):
+                    self._watermark = _aware(created_at)
+        return added
+
+    def _query_public(self):
+        from google.cloud.firestore import Query
+        return (self.db.collection('confessions')
+                .where('is_public', '==', True)
+                .select(FEED_FIELDS)
+                .order_by('created_at', direction=Query.DESCENDING))
+
+    def catch_up(self):
+        """Index public confessions created since the watermark (saved by other workers); returns how many"""
+        self.ensure_loaded()
+        with self._lock:
+            watermark = self._watermark
+        query = self._query_public()
+        if watermark is not None:
+            query = query.where('created_at', '>', watermark - WATERMARK_OVERLAP)
+        added = self._add_documents(query.stream())
+        self._count('catchups')
+        if added:
+            logger.info(f"Search index caught up on {added} prayers")
+        return added
+
+    # Loading and snapshots
+
+    def ensure_loaded(self):
+        """Load the snapshot and catch up, or scan every public confession if there is none (once)"""
+        if self._loaded:
+            return
+        with self._load_lock:
+            if self._loaded:
+                return
+            snapshot = None
+            if self.store:
+                try:
+                    snapshot = self.store.load()
+                except Exception as e:
+                    logger.error(f"Failed to load the search snapshot - rebuilding: {e}")
+            if snapshot and snapshot.get('version') == SNAPSHOT_VERSION:
+                self._restore(snapshot)
+                self._loaded = True
+                try:
+                    self.catch_up()
+                except Exception as e:
+                    self._count('catchup_errors')
+                    logger.error(f"Search index catch-up failed: {e}")
+            else:
+                started = time.perf_counter()
+                count = self._add_documents(self._query_public().stream())
+                self._count('full_scans')
+                self._loaded = True
+                logger.info(f"Indexed {count} public prayers in {(time.perf_counter() - started) * 1000:.0f}ms")
+                if self.store:
+                    # So the next worker starts from the snapshot instead of scanning too
+                    try:
+                        self.store.save(self.snapshot())
+                        self._count('snapshots_saved')
+                    except Exception as e:
+                        logger.error(f"Failed to save the search snapshot: {e}")
+        self.start()
+
+    def _restore(self, snapshot):
+        with self._lock:
+            for document in snapshot['documents']:
+                self._index(document['item'], document['terms'])
+            self._watermark = _aware(snapshot['watermark']) if snapshot.get('watermark') else None
+            self._stats['snapshot_loaded'] = len(snapshot['documents'])
+        logger.info(f"Loaded {len(snapshot['documents'])} prayers from the search snapshot")
+
+    def documents(self, start=0):
+        """(item, term frequencies) of documents numbered `start` and up - numbers only ever grow
+
+        A removed document is (None, None) - its number stays taken.
+        """
+        with self._lock:
+            return list(zip(self._items[start:], self._terms[start:]))
+
+    def removals(self, start=0):
+        """Ids of the prayers removed from the index, from the `start`-th removal on"""
+        with self._lock:
+            return self._removed[start:]
+
+    def snapshot(self):
+        """The analyzed index and its watermark, as JSON-serializable data"""
+        with self._lock:
+            return {
+                'version': SNAPSHOT_VERSION,
+                'watermark': self._watermark.isoformat() if self._watermark else None,
+                'documents': [{'item': item, 'terms': terms} for item, terms in zip(self._items, self._terms)
+                              if item is not None],
+            }
+
+    def save_snapshot(self):
+        """Catch up and write the snapshot to the store; returns the number of prayers in it"""
+        self.catch_up()
+        snapshot = self.snapshot()
+        self.store.save(snapshot)
+        self._count('snapshots_saved')
+        return len(snapshot['documents'])
+
+    def start(self):
+        """Start the catch-up thread (idempotent)"""
+        # Started lazily so the thread belongs to the serving (post-fork) worker process
+        if self._catcher is not None or not self.catchup_seconds:
+            return
+        with self._lock:
+            if self._catcher is not None:
+                return
+            self._catcher = threading.Thread(target=self._run, name='search-catchup', daemon=True)
+            self._catcher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.catchup_seconds)
+            try:
+                self.catch_up()
+            except Exception as e:
+                self._count('catchup_errors')
+                logger.error(f"Search index catch-up failed: {e}")
+
+    # Queries
+
+    def search(self, query, limit=20):
+        """Feed items of the public prayers matching `query`, best first, each with its BM25 `score`"""
+        self.ensure_loaded()
+        terms = sorted(set(analyze(query)))
+        if not terms:
+            return []
+        while True:
+            results = self._ranked(terms, limit)
+            verified = self.verify(results)
+            if len(verified) == len(results):
+                return verified
+            # Some hits weren't public anymore and are gone from the index - rank again to fill the page
+
+    def _ranked(self, terms, limit):
+        """The top `limit` hits for analyzed terms, cached until the index changes"""
+        started = time.perf_counter()
+        key = (' '.join(terms), limit)
+        with self._lock:
+            version = self._version
+        cached = self._results.get(key)
+        if cached is not None and cached[0] == version:
+            self._count('cache_hits')
+            return cached[1]
+
+        with self._lock:
+            count = len(self._numbers)
+            average_length = self._total_length / count if count else 0
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for number, frequency in postings.items():
+                    norm = K1 * (1 - B + B * self._lengths[number] / average_length)
+                    scores[number] = scores.get(number, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+            best = heapq.nlargest(limit, scores.items(), key=lambda entry: entry[1])
+            results = [dict(self._items[number], score=round(score, 4)) for number, score in best]
+            self._stats['queries'] += 1
+            self._stats['query_ms_total'] += (time.perf_counter() - started) * 1000
+        self._results[key] = (version, results)
+        return results
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['documents'] = len(self._numbers)
+            stats['terms'] = len(self._postings)
+            stats['watermark'] = self._watermark.isoformat() if self._watermark else None
+        queries = stats.pop('query_ms_total')
+        stats['average_query_ms'] = round(queries / stats['queries'], 2) if stats['queries'] else None
+        return stats
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the SendGrid v3 mail/send API.
+
+Accepts POST /v3/mail/send like SendGrid (202 Accepted) and keeps every
+request in memory; GET /messages returns what was received. Optional rate
+limiting and failure injection exercise the outbox's retry paths.
+
+    python3 sendgrid_standin.py --port 8025 --rate-limit 5 --fail-rate 0.1
+    SENDGRID_API_HOST=http://127.0.0.1:8025 flask --app app run --port 8080
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class SendGridStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path != '/v3/mail/send':
+            return self._reply(404, {'errors': [{'message': 'Not found'}]})
+
+        with server.lock:
+            now = time.monotonic()
+            if server.rate_limit:
+                # Fixed one-second window, like SendGrid's per-second limits
+                if now - server.window_start >= 1.0:
+                    server.window_start, server.window_count = now, 0
+                server.window_count += 1
+                if server.window_count > server.rate_limit:
+                    server.rejected += 1
+                    return self._reply(429, {'errors': [{'message': 'Too many requests'}]}, {'Retry-After': '1'})
+            if random.random() < server.fail_rate:
+                server.rejected += 1
+                return self._reply(503, {'errors': [{'message': 'Service unavailable'}]})
+
+            if not payload.get('personalizations') or not payload.get('from'):
+                return self._reply(400, {'errors': [{'message': 'Invalid payload'}]})
+            server.requests.append(payload)
+        self._reply(202)
+
+    def do_GET(self):
+        server = self.server
+        if self.path != '/messages':
+            return self._reply(404, {'errors': [{'message': 'Not found'}]})
+        with server.lock:
+            recipients = sum(len(request['personalizations']) for request in server.requests)
+            self._reply(200, {
+                'requests': len(server.requests),
+                'recipients': recipients,
+                'rejected': server.rejected,
+                'messages': server.requests,
+            })
+
+
+def start_standin(port=0, rate_limit=0, fail_rate=0.0):
+    """Start the stand-in on a background thread and return the server (see server.server_port)"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), SendGridStandInHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.rejected = 0
+    server.rate_limit = rate_limit
+    server.fail_rate = fail_rate
+    server.window_start = time.monotonic()
+    server.window_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--rate-limit', type=int, default=0, help='requests per second before 429 (0 = unlimited)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered with 503')
+    args = parser.parse_args()
+
+    server = start_standin(args.port, args.rate_limit, args.fail_rate)
+    print(f"SendGrid stand-in listening on http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
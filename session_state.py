@@ -0,0 +1,201 @@
+"""
+Bounded in-memory session state.
+
+BoundedStore is a dict-like LRU with an idle TTL and an approximate memory
+budget; SessionStateStore keeps compact per-session records (tier, Stripe ids)
+on top of it. Anonymous visitors therefore cost a fixed,
+small amount of memory and age out instead of accumulating for the life of
+the process.
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def approx_sizeof(obj):
+    """Approximate deep size in bytes of the simple objects kept in session state"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approx_sizeof(k) + approx_sizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(approx_sizeof(item) for item in obj)
+    slots = getattr(type(obj), '__slots__', ())
+    return size + sum(approx_sizeof(getattr(obj, slot, None)) for slot in slots)
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'touched')
+
+    def __init__(self, value, size, touched):
+        self.value = value
+        self.size = size
+        self.touched = touched
+
+
+class BoundedStore:
+    """Dict-like store with LRU eviction, an idle TTL and a memory budget"""
+
+    def __init__(self, max_bytes=None, max_entries=None, ttl_seconds=None, sizeof=approx_sizeof):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._sizeof = sizeof
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def _live_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.ttl_seconds is not None and now - entry.touched > self.ttl_seconds:
+            self._remove(key)
+            self._expirations += 1
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            now = time.monotonic()
+            entry = self._live_entry(key, now)
+            if entry is None:
+                return default
+            entry.touched = now
+            self._entries.move_to_end(key)
+            return entry.value
+
+    def peek(self, key, default=None):
+        """Read without refreshing recency or TTL"""
+        with self._lock:
+            entry = self._live_entry(key, time.monotonic())
+            return default if entry is None else entry.value
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        """Insert or replace a value; also call this after mutating a value so its size is re-measured"""
+        size = approx_sizeof(key) + self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, size, time.monotonic())
+            self._bytes += size
+            self._enforce_limits()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live_entry(key, time.monotonic()) is not None
+
+    def __delitem__(self, key):
+        with self._lock:
+            if key not in self._entries:
+                raise KeyError(key)
+            self._remove(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._live_entry(key, time.monotonic())
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry.value
+
+    def setdefault(self, key, value):
+        with self._lock:
+            existing = self.get(key)
+            if existing is not None:
+                return existing
+            self[key] = value
+            return value
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def _enforce_limits(self):
+        now = time.monotonic()
+        # Entries are in last-access order, so expired ones are all at the front
+        if self.ttl_seconds is not None:
+            while self._entries:
+                key, entry = next(iter(self._entries.items()))
+                if now - entry.touched <= self.ttl_seconds:
+                    break
+                self._remove(key)
+                self._expirations += 1
+        while self._entries and (
+            (self.max_bytes is not None and self._bytes > self.max_bytes)
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            self._remove(next(iter(self._entries)))
+            self._evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+            }
+
+
+class SessionRecord:
+    """Per-session state; timestamps are epoch floats rather than datetimes or ISO strings"""
+
+    __slots__ = ('tier', 'customer_id', 'subscription_id', 'created_at', 'updated_at')
+
+    def __init__(self, tier='free'):
+        now = time.time()
+        self.tier = tier
+        self.customer_id = None
+        self.subscription_id = None
+        self.created_at = now
+        self.updated_at = now
+
+
+class SessionStateStore:
+    """Tier and Stripe ids per session, bounded by memory and idle time"""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self._records = BoundedStore(max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Return the session's record, or None - reads never create records"""
+        return self._records.get(session_id)
+
+    def set_tier(self, session_id, tier, customer_id=None, subscription_id=None, updated_at=None):
+        with self._lock:
+            record = self._records.get(session_id)
+            if record is None:
+                record = SessionRecord(tier)
+            record.tier = tier
+            record.updated_at = updated_at or time.time()
+            if customer_id:
+                record.customer_id = customer_id
+            if subscription_id:
+                record.subscription_id = subscription_id
+            # (Re-)insert so the store re-measures the record's size
+            self._records[session_id] = record
+            return record
+
+    def stats(self):
+        return self._records.stats()
@@ -0,0 +1,251 @@
+"""
+Cold-start helpers: concurrent secret loading, lazy SDK clients and a startup timing report.
+
+With min_instances: 0 every scale-from-zero imports app.py before serving
+the first request. That import used to fetch each secret one after another
+(a new Secret Manager client per secret) and import and initialize
+firebase_admin, stripe and SendGrid up front.
+
+- load_secrets() fetches every missing secret concurrently through one
+  Secret Manager client
+- LazyClient / LazyModule stand in for db, sendgrid_client and stripe: the
+  SDK is imported and the client built on first use, and `if db:` keeps
+  working without building anything
+- startup_timer records how long each phase of the import took, plus the
+  first-use cost of every lazy client (see /api/internal/stats)
+- warmup runs registered steps (build clients, open pooled connections,
+  compile templates, preload caches) before the instance takes traffic:
+  from App Engine's /_ah/warmup request and, for the other workers, from
+  gunicorn's post_worker_init hook
+
+benchmark_cold_start.py measures the whole thing in fresh processes.
+"""
+
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer:
+    """Sequential phase timings for module import, plus first-use timings of lazy clients"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self._phases = []
+        self._lazy = {}
+        self._finished = None
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        """Record the time since the previous mark (or since startup began) as `phase`"""
+        now = time.perf_counter()
+        with self._lock:
+            self._phases.append((phase, now - self._last))
+            self._last = now
+
+    def finish(self, phase):
+        """Mark the last phase and log the report"""
+        self.mark(phase)
+        self._finished = time.perf_counter()
+        phases = ', '.join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self._phases)
+        logger.info(f"Startup finished in {(self._finished - self.started) * 1000:.0f}ms ({phases})")
+
+    def record_lazy(self, name, seconds):
+        with self._lock:
+            self._lazy[name] = seconds
+
+    def report(self):
+        with self._lock:
+            return {
+                'total_ms': round((self._finished - self.started) * 1000, 1) if self._finished else None,
+                'phases': {name: round(seconds * 1000, 1) for name, seconds in self._phases},
+                'lazy_init_ms': {name: round(seconds * 1000, 1) for name, seconds in self._lazy.items()},
+            }
+
+
+# Created when app.py first imports this module, so the report includes the imports that follow
+startup_timer = StartupTimer()
+
+
+def load_secrets(secrets, project_id, max_workers=8):
+    """Fetch secrets from Secret Manager concurrently; `secrets` maps env var name -> secret name
+
+    Variables that are already set (local .env, app.yaml) are left alone. Fetched values
+    are put into os.environ; returns the names of the variables that were loaded.
+    """
+    missing = {env_name: secret_name for env_name, secret_name in secrets.items() if not os.getenv(env_name)}
+    if not missing:
+        return []
+
+    try:
+        from google.cloud import secretmanager
+        client = secretmanager.SecretManagerServiceClient(transport='rest')
+    except Exception as e:
+        logger.warning(f"Could not create Secret Manager client - {len(missing)} secrets not loaded: {e}")
+        return []
+
+    def fetch(secret_name):
+        secret_path = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
+        response = client.access_secret_version(request={"name": secret_path})
+        return response.payload.data.decode('UTF-8')
+
+    loaded = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as pool:
+        futures = {env_name: pool.submit(fetch, secret_name) for env_name, secret_name in missing.items()}
+        for env_name, future in futures.items():
+            try:
+                os.environ[env_name] = future.result()
+                loaded.append(env_name)
+            except Exception as e:
+                logger.warning(f"Could not load secret '{missing[env_name]}' from Secret Manager: {e}")
+    if loaded:
+        logger.info(f"Loaded {len(loaded)} secrets from Secret Manager")
+    return loaded
+
+
+class LazyClient:
+    """Builds an SDK client on first use and forwards attribute access to it
+
+    The factory returns the client, or None if it can't be built (the error is
+    logged, not raised). Truth-testing never builds the client: the proxy is
+    truthy while it is configured and becomes falsy once a build has failed,
+    so wiring at import decides on configuration alone and request-time
+    `if db:` checks fall back after the first failed use.
+    """
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._client = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._client is None and not self._failed:
+            with self._lock:
+                if self._client is None and not self._failed:
+                    started = time.perf_counter()
+                    try:
+                        self._client = self._factory()
+                    except Exception as e:
+                        logger.error(f"Could not initialize {self._name}: {e}")
+                    self._failed = self._client is None
+                    startup_timer.record_lazy(self._name, time.perf_counter() - started)
+        return self._client
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def __bool__(self):
+        return not self._failed
+
+    def __getattr__(self, attr):
+        client = self._get()
+        if client is None:
+            raise RuntimeError(f"{self._name} is not available")
+        return getattr(client, attr)
+
+
+class LazyModule:
+    """Imports a module on first attribute access; `setup(module)` configures it once"""
+
+    def __init__(self, module_name, setup=None):
+        self._module_name = module_name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    started = time.perf_counter()
+                    module = importlib.import_module(self._module_name)
+                    if self._setup:
+                        self._setup(module)
+                    self._module = module
+                    startup_timer.record_lazy(self._module_name, time.perf_counter() - started)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr.startswith('_'):
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._load(), attr, value)
+
+
+class Warmup:
+    """Named warmup steps, run concurrently once per process, with a timing report"""
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._steps = {}
+        self._done = {}  # step name -> result of its last successful run
+        self._report = None
+        self._lock = threading.Lock()
+
+    def step(self, func):
+        """Decorator: register a warmup step named after the function; its return value is reported"""
+        self._steps[func.__name__] = func
+        return func
+
+    def _run_step(self, name):
+        started = time.perf_counter()
+        try:
+            result = {'ok': True, 'result': self._steps[name]()}
+        except Exception as e:
+            logger.warning(f"Warmup step '{name}' failed: {e}")
+            result = {'ok': False, 'error': str(e)}
+        result['ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    def run(self):
+        """Run every step that hasn't succeeded yet and return the report
+
+        Steps that already succeeded in this process are skipped, so a second
+        warmup (or one racing the background run) is cheap; failed steps are retried.
+        """
+        with self._lock:
+            started = time.perf_counter()
+            pending = [name for name in self._steps if name not in self._done]
+            if pending:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as pool:
+                    results = dict(zip(pending, pool.map(self._run_step, pending)))
+                for name, result in results.items():
+                    if result['ok']:
+                        self._done[name] = result
+            else:
+                results = {}
+            # Steps done by an earlier run keep that run's timing
+            steps = {name: results.get(name) or dict(self._done[name], skipped=True) for name in self._steps}
+            self._report = {
+                'warm': all(step['ok'] for step in steps.values()),
+                'total_ms': round((time.perf_counter() - started) * 1000, 1),
+                'steps': steps,
+            }
+            if results:
+                summary = ', '.join(f"{name} {step['ms']:.0f}ms{'' if step['ok'] else ' (failed)'}"
+                                    for name, step in results.items())
+                logger.info(f"Warmup finished in {self._report['total_ms']:.0f}ms ({summary})")
+            return self._report
+
+    def start_background(self):
+        """Warm this process without blocking the caller"""
+        threading.Thread(target=self.run, name='warmup', daemon=True).start()
+
+    def report(self):
+        # Not under the lock - that is held for the whole run
+        return self._report
+
+
+warmup = Warmup()
@@ -0,0 +1,454 @@
+"""
+Pluggable storage for per-session state (tier, monthly usage counts) and
+chat histories.
+
+- InProcessStateBackend keeps state in this worker's bounded memory. Every
+  gunicorn worker and every instance has its own copy, so it only gives
+  consistent answers with a single worker on a single instance.
+- FirestoreStateBackend keeps everything in Firestore, so all workers and
+  instances agree and App Engine can run more than one instance.
+- SQLiteStateBackend is a shared stand-in for local runs and tests: every
+  worker process on the machine opens the same database file.
+
+Select one with STATE_BACKEND=memory|firestore|sqlite (see create_state_backend).
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from firestore_loader import forget_document, get_document
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+
+class _FirestoreConversations:
+    """Chat histories under conversations/{conversation_id}/messages"""
+
+    db = None
+
+    def save_messages(self, conversation_id, session_id, start, messages):
+        """Write messages[start:] of a conversation; messages are (role, content, epoch) tuples"""
+        if not self.db or not messages:
+            return
+        try:
+            conversation_ref = self.db.collection('conversations').document(conversation_id)
+            batch = self.db.batch()
+            batch.set(conversation_ref, {
+                'session_id': session_id,
+                'message_count': start + len(messages),
+                'updated_at': datetime.now(),
+            }, merge=True)
+            for seq, (role, content, timestamp) in enumerate(messages, start):
+                # Zero-padded ids keep the subcollection in message order
+                batch.set(conversation_ref.collection('messages').document(f"{seq:06d}"), {
+                    'seq': seq,
+                    'role': role,
+                    'content': content,
+                    'timestamp': datetime.fromtimestamp(timestamp),
+                })
+            batch.commit()
+            forget_document(conversation_ref)
+        except Exception as e:
+            logger.error(f"Failed to save conversation {conversation_id}: {e}")
+
+    def message_count(self, conversation_id):
+        """Return (owner_session_id, stored_message_count), or None if the conversation is unknown"""
+        if not self.db:
+            return None
+        try:
+            # Read through the request's loader - _sync reads this again via load_messages
+            snapshot = get_document(self.conversation_ref(conversation_id))
+            if not snapshot.exists:
+                return None
+            data = snapshot.to_dict()
+            return data.get('session_id'), data.get('message_count', 0)
+        except Exception as e:
+            logger.error(f"Failed to read conversation {conversation_id}: {e}")
+            return None
+
+    def conversation_ref(self, conversation_id):
+        return self.db.collection('conversations').document(conversation_id)
+
+    def load_messages(self, conversation_id, start=0):
+        """Return (owner_session_id, message dicts from seq `start` on), or None if unknown"""
+        owner = self.message_count(conversation_id)
+        if owner is None:
+            return None
+        try:
+            query = self.db.collection('conversations').document(conversation_id).collection('messages')
+            if start:
+                query = query.where('seq', '>=', start)
+            return owner[0], [doc.to_dict() for doc in query.order_by('seq').stream()]
+        except Exception as e:
+            logger.error(f"Failed to load conversation {conversation_id}: {e}")
+            return None
+
+
+class _FirestoreDocuments:
+    """Batched reads: the documents a request is about to read one at a time"""
+
+    db = None
+
+    def document_refs(self, tier_session_id=None, usage_key=None, conversation_id=None):
+        """Documents load_tier / load_usage / message_count would read, for one get_all"""
+        if not self.db:
+            return []
+        refs = []
+        if tier_session_id:
+            refs.append(self.db.collection('subscriptions').document(tier_session_id))
+        if usage_key:
+            refs.append(self.usage_ref(*usage_key))
+        if conversation_id:
+            refs.append(self.conversation_ref(conversation_id))
+        return refs
+
+
+def _load_firestore_tier(db, session_id):
+    """Tier from the single subscriptions/{session_id} document, or None without one"""
+    snapshot = get_document(db.collection('subscriptions').document(session_id))
+    return snapshot.to_dict().get('tier', 'free') if snapshot.exists else None
+
+
+class _FirestoreUsage:
+    """Monthly usage counters in usage/{session_id}_{window}, written with atomic increments"""
+
+    db = None
+
+    def load_usage(self, session_id, window):
+        if not self.db:
+            return 0
+        snapshot = get_document(self.usage_ref(session_id, window))
+        return snapshot.to_dict().get('count', 0) if snapshot.exists else 0
+
+    def usage_ref(self, session_id, window):
+        return self.db.collection('usage').document(f"{session_id}_{window}")
+
+    def add_usage(self, deltas):
+        """Apply {(session_id, window): delta} in batched writes"""
+        if not self.db or not deltas:
+            return
+        from firebase_admin import firestore
+        items = list(deltas.items())
+        # Firestore batches are limited to 500 writes
+        for offset in range(0, len(items), 500):
+            batch = self.db.batch()
+            for (session_id, window), delta in items[offset:offset + 500]:
+                # Increment is applied server-side, so concurrent workers never lose an update
+                batch.set(self.usage_ref(session_id, window), {
+                    'session_id': session_id,
+                    'window': window,
+                    'count': firestore.Increment(delta),
+                    'updated_at': datetime.now(),
+                }, merge=True)
+            batch.commit()
+
+
+class InProcessStateBackend(_FirestoreConversations, _FirestoreUsage, _FirestoreDocuments):
+    """Per-process state; subscriptions, usage and premium journeys are still written to Firestore"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self, sessions, db=None, usage_entries=100000):
+        self.sessions = sessions
+        self.db = db
+        # Usage counts when there is no Firestore to keep them; a month's window idles out after 32 days
+        self._usage = BoundedStore(max_entries=usage_entries, ttl_seconds=32 * 24 * 3600)
+        self._usage_lock = threading.Lock()
+
+    def load_usage(self, session_id, window):
+        if self.db:
+            return super().load_usage(session_id, window)
+        return self._usage.get((session_id, window), 0)
+
+    def add_usage(self, deltas):
+        if self.db:
+            return super().add_usage(deltas)
+        with self._usage_lock:
+            for key, delta in deltas.items():
+                self._usage[key] = self._usage.get(key, 0) + delta
+
+    def document_refs(self, tier_session_id=None, usage_key=None, conversation_id=None):
+        # Tiers come from Firestore only for sessions this process doesn't know
+        if tier_session_id and self.sessions.get(tier_session_id) is not None:
+            tier_session_id = None
+        return super().document_refs(tier_session_id, usage_key, conversation_id)
+
+    def load_tier(self, session_id):
+        """Tier for a session, or None if it has no subscription; falls back to Firestore after restarts"""
+        record = self.sessions.get(session_id)
+        if record is not None:
+            return record.tier
+        return _load_firestore_tier(self.db, session_id) if self.db else None
+
+    def set_tier(self, session_id, tier, customer_id=None, subscription_id=None, batch=None):
+        """Record a tier; Firestore errors are raised so the caller can retry
+
+        With a Firestore `batch` the subscription write is added to it and the caller commits.
+        """
+        record = self.sessions.set_tier(session_id, tier, customer_id, subscription_id)
+
+        # Also store in Firestore for persistence
+        if not self.db:
+            return
+        subscription_data = {
+            'tier': tier,
+            'session_id': session_id,
+            'updated_at': datetime.now(),
+            'created_at': datetime.fromtimestamp(record.created_at)
+        }
+        if customer_id:
+            subscription_data['customer_id'] = customer_id
+        if subscription_id:
+            subscription_data['subscription_id'] = subscription_id
+        subscription_ref = self.db.collection('subscriptions').document(session_id)
+        if batch is not None:
+            batch.set(subscription_ref, subscription_data)
+        else:
+            subscription_ref.set(subscription_data)
+        forget_document(subscription_ref)
+        logger.info(f"Stored subscription {tier} for session {session_id} in Firestore")
+
+    def stats(self):
+        return {'backend': self.name, 'shared': self.shared, 'sessions': self.sessions.stats(),
+                'usage': None if self.db else self._usage.stats()}
+
+
+class FirestoreStateBackend(_FirestoreConversations, _FirestoreUsage, _FirestoreDocuments):
+    """Shared state in Firestore: tiers in subscriptions/{session_id}, usage in usage/{session_id}_{window}"""
+
+    name = 'firestore'
+    shared = True
+
+    def __init__(self, db, fallback=None):
+        """fallback: backend used instead once the Firestore client has failed to build (db is falsy)"""
+        self.db = db
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._stats = {'reads': 0, 'writes': 0, 'errors': 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _unavailable(self):
+        return not self.db and self.fallback is not None
+
+    def load_usage(self, session_id, window):
+        if self._unavailable():
+            return self.fallback.load_usage(session_id, window)
+        return super().load_usage(session_id, window)
+
+    def add_usage(self, deltas):
+        if self._unavailable():
+            return self.fallback.add_usage(deltas)
+        return super().add_usage(deltas)
+
+    def load_tier(self, session_id):
+        """Tier for a session, or None if it has no subscription"""
+        if self._unavailable():
+            return self.fallback.load_tier(session_id)
+        try:
+            self._count('reads')
+            return _load_firestore_tier(self.db, session_id)
+        except Exception:
+            self._count('errors')
+            raise
+
+    def set_tier(self, session_id, tier, customer_id=None, subscription_id=None, batch=None):
+        """Record a tier; Firestore errors are raised so the caller can retry
+
+        With a Firestore `batch` the subscription write is added to it and the caller commits.
+        """
+        if self._unavailable():
+            return self.fallback.set_tier(session_id, tier, customer_id, subscription_id)
+        subscription_data = {
+            'tier': tier,
+            'session_id': session_id,
+            'updated_at': datetime.now(),
+        }
+        if customer_id:
+            subscription_data['customer_id'] = customer_id
+        if subscription_id:
+            subscription_data['subscription_id'] = subscription_id
+        try:
+            self._count('writes')
+            # merge keeps created_at and Stripe ids that this update doesn't carry
+            subscription_ref = self.db.collection('subscriptions').document(session_id)
+            if batch is not None:
+                batch.set(subscription_ref, subscription_data, merge=True)
+            else:
+                subscription_ref.set(subscription_data, merge=True)
+            forget_document(subscription_ref)
+            logger.info(f"Stored subscription {tier} for session {session_id} in Firestore")
+        except Exception:
+            self._count('errors')
+            raise
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update({'backend': self.name, 'shared': self.shared})
+        if self._unavailable():
+            stats['fallback'] = self.fallback.stats()
+        return stats
+
+
+class SQLiteStateBackend:
+    """Shared state in a local SQLite file - the stand-in for Firestore across local workers"""
+
+    name = 'sqlite'
+    shared = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            tier TEXT NOT NULL DEFAULT 'free',
+            customer_id TEXT,
+            subscription_id TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS usage (
+            session_id TEXT NOT NULL,
+            window TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (session_id, window)
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            session_id TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            conversation_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp REAL NOT NULL,
+            PRIMARY KEY (conversation_id, seq)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        # One connection per thread; WAL lets readers in other workers proceed during writes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def document_refs(self, tier_session_id=None, usage_key=None, conversation_id=None):
+        return []
+
+    def load_tier(self, session_id):
+        row = self._connect().execute('SELECT tier FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_tier(self, session_id, tier, customer_id=None, subscription_id=None, batch=None):
+        # SQLite has no part in a Firestore batch; the row is written right away
+        now = time.time()
+        self._connect().execute(
+            'INSERT INTO sessions (session_id, tier, customer_id, subscription_id, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(session_id) DO UPDATE SET tier = excluded.tier, updated_at = excluded.updated_at, '
+            'customer_id = COALESCE(excluded.customer_id, customer_id), '
+            'subscription_id = COALESCE(excluded.subscription_id, subscription_id)',
+            (session_id, tier, customer_id, subscription_id, now, now)
+        )
+
+    def load_usage(self, session_id, window):
+        row = self._connect().execute(
+            'SELECT count FROM usage WHERE session_id = ? AND window = ?', (session_id, window)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add_usage(self, deltas):
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT INTO usage (session_id, window, count) VALUES (?, ?, ?) '
+                'ON CONFLICT(session_id, window) DO UPDATE SET count = count + excluded.count',
+                [(session_id, window, delta) for (session_id, window), delta in deltas.items()]
+            )
+
+    def save_messages(self, conversation_id, session_id, start, messages):
+        if not messages:
+            return
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT INTO conversations (conversation_id, session_id, message_count, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(conversation_id) DO UPDATE SET message_count = excluded.message_count, '
+                'updated_at = excluded.updated_at',
+                (conversation_id, session_id, start + len(messages), time.time())
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO conversation_messages (conversation_id, seq, role, content, timestamp) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(conversation_id, seq, role, content, timestamp)
+                 for seq, (role, content, timestamp) in enumerate(messages, start)]
+            )
+
+    def message_count(self, conversation_id):
+        row = self._connect().execute(
+            'SELECT session_id, message_count FROM conversations WHERE conversation_id = ?', (conversation_id,)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def load_messages(self, conversation_id, start=0):
+        owner = self.message_count(conversation_id)
+        if owner is None:
+            return None
+        rows = self._connect().execute(
+            'SELECT seq, role, content, timestamp FROM conversation_messages '
+            'WHERE conversation_id = ? AND seq >= ? ORDER BY seq',
+            (conversation_id, start)
+        ).fetchall()
+        return owner[0], [{'seq': seq, 'role': role, 'content': content, 'timestamp': timestamp}
+                          for seq, role, content, timestamp in rows]
+
+    def stats(self):
+        conn = self._connect()
+        return {
+            'backend': self.name,
+            'shared': self.shared,
+            'path': self.path,
+            'sessions': conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0],
+            'conversations': conn.execute('SELECT COUNT(*) FROM conversations').fetchone()[0],
+        }
+
+
+def create_state_backend(kind, sessions, db=None):
+    """Build the backend named by STATE_BACKEND; falls back to in-process state if it can't be used"""
+    kind = (kind or 'memory').lower()
+    if kind == 'firestore':
+        if db:
+            # db is only configured here; if the client can't be built, state stays in this process
+            return FirestoreStateBackend(db, fallback=InProcessStateBackend(sessions, db))
+        logger.warning("STATE_BACKEND=firestore but Firestore is not available - using in-process state")
+    elif kind == 'sqlite':
+        path = os.getenv('STATE_SQLITE_PATH', '/tmp/confessiones-state.sqlite3')
+        try:
+            return SQLiteStateBackend(path)
+        except sqlite3.Error as e:
+            logger.error(f"Could not open SQLite state at {path}: {e} - using in-process state")
+    elif kind != 'memory':
+        logger.warning(f"Unknown STATE_BACKEND '{kind}' - using in-process state")
+    return InProcessStateBackend(sessions, db)
@@ -3,6 +3,7 @@ const { useState, useEffect, useMemo } = React;
 const MyConfessionsApp = () => {
   const [currentView, setCurrentView] = useState('confess');
   const [messages, setMessages] = useState([]);
+  const [conversationId, setConversationId] = useState(null); // server keeps the history
   const [inputMessage, setInputMessage] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [sessionId] = useState(`session_${Math.random().toString(36).substr(2, 9)}`);
@@ -118,17 +119,31 @@ const MyConfessionsApp = () => {
       const currentSessionId = isLoggedIn ? userSessionId : sessionId;
       const response = await fetch('/api/chat/message', {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: {
+          'Content-Type': 'application/json',
+          'Accept': 'text/event-stream, application/json'
+        },
         body: JSON.stringify({
           message: messageToSend,
           session_id: currentSessionId,
-          conversation_history: messages
+          conversation_id: conversationId,
+          stream: true
         })
       });
 
-      const data = await response.json();
+      const contentType = response.headers.get('Content-Type') || '';
+      const data = contentType.includes('text/event-stream')
+        ? await readChatStream(response)
+        : await response.json();
       if (data.success) {
-        setMessages(prev => [...prev, { role: 'assistant', content: data.response }]);
+        setMessages(prev => {
+          // Streaming already rendered the reply token by token - just settle the final text
+          if (prev.length && prev[prev.length - 1].streaming) {
+            return [...prev.slice(0, -1), { role: 'assistant', content: data.response }];
+          }
+          return [...prev, { role: 'assistant', content: data.response }];
+        });
+        setConversationId(data.conversation_id);
         // Update value-first service state
         setUserTier(data.tier || 'free');
         setConversationDepth(data.conversation_depth || 0);
@@ -142,15 +157,22 @@ const MyConfessionsApp = () => {
             conversation_depth: data.conversation_depth 
           });
         }
+      } else if (response.status === 413) {
+        // Too long for one message - give the text back so it can be shortened
+        setInputMessage(messageToSend);
+        setMessages(prev => [...prev.filter(m => !m.streaming), { 
+          role: 'assistant', 
+          content: data.error 
+        }]);
       } else {
-        setMessages(prev => [...prev, { 
+        setMessages(prev => [...prev.filter(m => !m.streaming), { 
           role: 'assistant', 
           content: 'Sorry, I encountered an error. Please try again.' 
         }]);
       }
     } catch (error) {
       console.error('Chat error:', error);
-      setMessages(prev => [...prev, { 
+      setMessages(prev => [...prev.filter(m => !m.streaming), { 
         role: 'assistant', 
         content: 'Sorry, I encountered an error. Please try again.' 
       }]);
@@ -158,6 +180,53 @@ const MyConfessionsApp = () => {
     setIsLoading(false);
   };
 
+  // Read a Server-Sent Events chat reply, rendering tokens as they arrive.
+  // Resolves with the final 'done' payload (same shape as the JSON response).
+  const readChatStream = async (response) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = { success: false };
+
+    const handleEvent = (rawEvent) => {
+      let eventName = 'message';
+      let dataLines = [];
+      rawEvent.split('\n').forEach(line => {
+        if (line.startsWith('event:')) eventName = line.slice(6).trim();
+        else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+      });
+      if (!dataLines.length) return;
+      const payload = JSON.parse(dataLines.join('\n'));
+
+      if (eventName === 'token') {
+        // First token opens the assistant bubble (which replaces the typing indicator)
+        setMessages(prev => {
+          const last = prev[prev.length - 1];
+          if (last && last.streaming) {
+            return [...prev.slice(0, -1), { ...last, content: last.content + payload.content }];
+          }
+          return [...prev, { role: 'assistant', content: payload.content, streaming: true }];
+        });
+      } else if (eventName === 'done') {
+        result = payload;
+      } else if (eventName === 'error') {
+        result = { success: false, error: payload.error };
+      }
+    };
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        handleEvent(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+      }
+    }
+    return result;
+  };
+
 const handleSharePrayer = (confession) => {
     track('prayer_shared', { prayer_id: confession.id });
     
@@ -181,13 +250,16 @@ const handleSharePrayer = (confession) => {
       const response = await fetch(`/api/confessions/${confessionId}/upvote`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
+        // The server counts one upvote per session
+        body: JSON.stringify({ session_id: isLoggedIn ? userSessionId : sessionId })
       });
 
       if (response.ok) {
-        // Optimistically update the UI
+        const data = await response.json();
+        // Show the server's count (it includes upvotes not written yet)
         const newConfessions = confessions.map(c => {
           if (c.id === confessionId) {
-            return { ...c, upvotes: (c.upvotes || 0) + 1 };
+            return { ...c, upvotes: data.upvotes ?? (c.upvotes || 0) + 1 };
           }
           return c;
         });
@@ -238,11 +310,12 @@ const handleSharePrayer = (confession) => {
 
       const data = await response.json();
       if (data.success) {
-        setCurrentConfession(data.confession);
+        setCurrentConfession({ ...data.confession, related: data.related || [] });
         setMessages([]);
+        setConversationId(null);
         setGeneratedSummary('');
         if (isPublic) {
-          await fetchConfessions();
+          await fetchConfessions(confessionFilter);
         }
         setCurrentView('confession');
       } else {
@@ -360,7 +433,7 @@ const handleSharePrayer = (confession) => {
                 </div>
               ))}
 
-              {isLoading && (
+              {isLoading && !messages[messages.length - 1]?.streaming && (
                 <div className="flex justify-start">
                   <div className="bg-white border border-gray-100 px-4 py-3 rounded-2xl rounded-bl-sm shadow-sm">
                     <div className="flex items-center space-x-1.5">
@@ -475,6 +548,20 @@ const handleSharePrayer = (confession) => {
               : "Your prayer has been offered to God in privacy."}
           </p>
 
+          {currentConfession?.related?.length > 0 && (
+            <div className="mb-8 text-left">
+              <h3 className="text-sm font-semibold text-gray-900 mb-3">Prayers like yours</h3>
+              <div className="space-y-3">
+                {currentConfession.related.map((prayer) => (
+                  <div key={prayer.id} className="bg-gray-50 rounded-xl p-4 border border-gray-100">
+                    <p className="font-semibold text-gray-900 text-sm mb-1">{prayer.title || "A Prayer"}</p>
+                    <p className="text-gray-600 text-xs leading-relaxed line-clamp-3">{prayer.text}</p>
+                  </div>
+                ))}
+              </div>
+            </div>
+          )}
+
           <div className="space-y-3">
             <button
               onClick={() => setCurrentView('confess')}
@@ -545,6 +632,12 @@ const handleSharePrayer = (confession) => {
                 >
                   Popular
                 </button>
+                <button
+                  onClick={() => setConfessionFilter('trending')}
+                  className={`px-4 py-1.5 text-xs font-semibold rounded-md transition-all ${confessionFilter === 'trending' ? 'bg-white text-gray-900 shadow-sm' : 'text-gray-500 hover:text-gray-700'}`}
+                >
+                  Trending
+                </button>
               </div>
             </div>
 
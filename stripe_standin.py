@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Stripe's webhook delivery.
+
+Sends the recorded events in fixtures/stripe_events to the app's webhook
+endpoint, signed with the endpoint secret the way Stripe signs them. Options
+reproduce what Stripe does in production: delivering an event more than once
+(--duplicates) and out of order (--shuffle).
+
+    STRIPE_WEBHOOK_SECRET=whsec_standin flask --app app run --port 8080
+    python3 stripe_standin.py --url http://127.0.0.1:8080/api/stripe/webhook \\
+        --secret whsec_standin --duplicates 2 --shuffle
+
+Event ids get a per-run suffix so every run is processed; pass --run-id to
+replay the exact events of an earlier run (they should all come back as
+duplicates).
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import secrets
+import sys
+import urllib.error
+import urllib.request
+
+from stripe_webhooks import sign_payload
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'stripe_events')
+
+
+def load_fixtures(directory, run_id):
+    """Recorded events, in file order, with ids made unique to this run"""
+    events = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        with open(path) as fixture:
+            event = json.load(fixture)
+        event['id'] = f"{event['id']}_{run_id}"
+        events.append(event)
+    return events
+
+
+def deliver(url, secret, event):
+    """POST one signed event; returns (HTTP status, response body)"""
+    payload = json.dumps(event).encode('utf-8')
+    request = urllib.request.Request(url, data=payload, method='POST', headers={
+        'Content-Type': 'application/json',
+        'Stripe-Signature': sign_payload(payload, secret),
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, json.loads(response.read() or b'{}')
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080/api/stripe/webhook')
+    parser.add_argument('--secret', default=os.getenv('STRIPE_WEBHOOK_SECRET', 'whsec_standin'))
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--duplicates', type=int, default=1, help='deliveries of each event')
+    parser.add_argument('--shuffle', action='store_true', help='deliver in random order')
+    parser.add_argument('--run-id', default=None, help='reuse the event ids of an earlier run')
+    args = parser.parse_args()
+
+    run_id = args.run_id or secrets.token_hex(4)
+    deliveries = [event for event in load_fixtures(args.fixtures, run_id) for _ in range(args.duplicates)]
+    if args.shuffle:
+        random.shuffle(deliveries)
+
+    print(f"run {run_id}: {len(deliveries)} deliveries to {args.url}")
+    failures = 0
+    for event in deliveries:
+        status, body = deliver(args.url, args.secret, event)
+        failures += status != 200
+        print(f"  {status} {body.get('status') or body.get('error', ''):<10} {event['type']:<32} {event['id']}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
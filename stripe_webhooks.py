@@ -0,0 +1,367 @@
+"""
+Stripe webhook ingestion: verified, deduplicated events processed in the background, in order per customer.
+
+Subscription state used to change only when the user's browser reached
+/subscription-success, so cancellations and failed payments never reached
+us. The webhook endpoint hands the raw request to StripeWebhookProcessor:
+
+- the Stripe-Signature header is checked against the endpoint secret
+  (HMAC-SHA256 over "timestamp.payload", five minutes of tolerance), without
+  importing the Stripe SDK on the request path
+- the event is stored under its id (stripe_events/{event_id}) with create(),
+  so a redelivered event is acknowledged and dropped
+- the endpoint answers right away; `schedule(customer)` arranges for
+  process_customer() to run in the background (a job in app.py)
+- process_customer() runs the customer's pending events in `created` order,
+  one worker per customer at a time across all instances: it first takes the
+  customer's lease (stripe_event_leases/{customer}, acquired in a
+  transaction and renewed before every event). A worker that finds the
+  lease held raises CustomerBusy, so its job is retried later
+- a failing event stops the customer's queue (later events wait behind it)
+  until it succeeds or runs out of attempts
+
+Handlers are registered per event type with @processor.on(...) and receive
+the parsed event. Events of types nobody handles are acknowledged and not
+stored. sign_payload() produces valid headers for recorded fixtures (see
+stripe_standin.py).
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# Stripe's default tolerance for the signature timestamp
+SIGNATURE_TOLERANCE_SECONDS = 300
+
+# Ordering key for events that don't belong to a customer
+NO_CUSTOMER = '-'
+
+
+class SignatureError(ValueError):
+    """The request was not signed with the endpoint secret"""
+
+
+class CustomerBusy(RuntimeError):
+    """Another worker holds the customer's lease; try again later"""
+
+
+def sign_payload(payload, secret, timestamp=None):
+    """Stripe-Signature header value for payload (bytes), as Stripe would send it"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    signature = hmac.new(secret.encode('utf-8'), f"{timestamp}.".encode('utf-8') + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={signature}"
+
+
+def verify_signature(payload, header, secret, tolerance=SIGNATURE_TOLERANCE_SECONDS):
+    """Raise SignatureError unless `header` is a valid, recent Stripe signature of payload (bytes)"""
+    timestamp, signatures = None, []
+    for item in (header or '').split(','):
+        key, _, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        raise SignatureError('Malformed Stripe-Signature header')
+    if tolerance and abs(time.time() - int(timestamp)) > tolerance:
+        raise SignatureError('Signature timestamp outside the tolerance')
+    expected = sign_payload(payload, secret, int(timestamp)).split('v1=', 1)[1]
+    if not any(hmac.compare_digest(expected, signature) for signature in signatures):
+        raise SignatureError('No matching signature')
+
+
+def event_customer(event):
+    """The customer an event belongs to - its processing order is kept per customer"""
+    obj = event.get('data', {}).get('object', {})
+    if obj.get('object') == 'customer':
+        return obj.get('id') or NO_CUSTOMER
+    customer = obj.get('customer')
+    if isinstance(customer, dict):
+        customer = customer.get('id')
+    return customer or NO_CUSTOMER
+
+
+class FirestoreEventStore:
+    """Events in stripe_events/{event_id}; shared by every instance"""
+
+    def __init__(self, db, collection='stripe_events', lease_collection='stripe_event_leases'):
+        self.db = db
+        self.collection = collection
+        self.lease_collection = lease_collection
+
+    def add(self, event):
+        """Store a new event as pending; False if it was stored before"""
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            self.db.collection(self.collection).document(event['id']).create({
+                'type': event['type'],
+                'customer': event_customer(event),
+                'created': event.get('created', 0),
+                'payload': json.dumps(event),
+                'status': 'pending',
+                'attempts': 0,
+                'received_at': datetime.now(timezone.utc),
+            })
+        except AlreadyExists:
+            return False
+        return True
+
+    def pending(self, customer, limit=100):
+        """(event, attempts) for a customer's pending events, oldest first"""
+        query = (self.db.collection(self.collection)
+                 .where('customer', '==', customer)
+                 .where('status', '==', 'pending')
+                 .order_by('created')
+                 .limit(limit))
+        return [(json.loads(data['payload']), data.get('attempts', 0))
+                for data in (doc.to_dict() for doc in query.stream())]
+
+    def mark(self, event_id, status, attempts, error=None):
+        updates = {'status': status, 'attempts': attempts, 'updated_at': datetime.now(timezone.utc)}
+        if error:
+            updates['last_error'] = error[:500]
+        self.db.collection(self.collection).document(event_id).update(updates)
+
+    def stalled_customers(self, idle_seconds):
+        """Customers with events that have been pending for more than `idle_seconds`"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=idle_seconds)
+        query = (self.db.collection(self.collection)
+                 .where('status', '==', 'pending')
+                 .where('received_at', '<', cutoff)
+                 .select(['customer']))
+        return sorted({(doc.to_dict() or {}).get('customer') or NO_CUSTOMER for doc in query.stream()})
+
+    def acquire(self, customer, owner, lease_seconds):
+        """Take or renew the customer's lease for `owner`; False if someone else holds it"""
+        from google.cloud import firestore
+        lease_ref = self.db.collection(self.lease_collection).document(customer)
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            lease = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            if lease.get('owner') not in (None, owner) and lease.get('expires_at') and lease['expires_at'] > now:
+                return False
+            transaction.set(lease_ref, {'owner': owner, 'expires_at': now + timedelta(seconds=lease_seconds)})
+            return True
+
+        return claim(self.db.transaction())
+
+    def release(self, customer, owner):
+        from google.cloud import firestore
+        lease_ref = self.db.collection(self.lease_collection).document(customer)
+
+        @firestore.transactional
+        def drop(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            if snapshot.exists and (snapshot.to_dict() or {}).get('owner') == owner:
+                transaction.delete(lease_ref)
+
+        drop(self.db.transaction())
+
+
+class InMemoryEventStore:
+    """Events in this process only - for local runs without Firestore"""
+
+    def __init__(self, max_entries=10000, ttl_seconds=3 * 24 * 3600):
+        self._lock = threading.Lock()
+        self._seen = BoundedStore(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self._pending = {}  # event id -> {'event', 'customer', 'attempts', 'received_at'}
+        self._leases = {}  # customer -> (owner, expires at)
+
+    def add(self, event):
+        with self._lock:
+            if event['id'] in self._seen:
+                return False
+            self._seen[event['id']] = True
+            self._pending[event['id']] = {
+                'event': event,
+                'customer': event_customer(event),
+                'attempts': 0,
+                'received_at': time.time(),
+            }
+        return True
+
+    def pending(self, customer, limit=100):
+        with self._lock:
+            entries = [entry for entry in self._pending.values() if entry['customer'] == customer]
+        entries.sort(key=lambda entry: entry['event'].get('created', 0))
+        return [(entry['event'], entry['attempts']) for entry in entries[:limit]]
+
+    def mark(self, event_id, status, attempts, error=None):
+        with self._lock:
+            if status == 'pending':
+                if event_id in self._pending:
+                    self._pending[event_id]['attempts'] = attempts
+            else:
+                self._pending.pop(event_id, None)
+
+    def stalled_customers(self, idle_seconds):
+        cutoff = time.time() - idle_seconds
+        with self._lock:
+            return sorted({entry['customer'] for entry in self._pending.values() if entry['received_at'] < cutoff})
+
+    def acquire(self, customer, owner, lease_seconds):
+        with self._lock:
+            holder, expires_at = self._leases.get(customer, (None, 0))
+            if holder not in (None, owner) and expires_at > time.time():
+                return False
+            self._leases[customer] = (owner, time.time() + lease_seconds)
+            return True
+
+    def release(self, customer, owner):
+        with self._lock:
+            if self._leases.get(customer, (None, 0))[0] == owner:
+                del self._leases[customer]
+
+
+class StripeWebhookProcessor:
+    """Verifies and stores incoming events, then runs their handlers per customer in order"""
+
+    def __init__(self, store, secret, schedule, max_attempts=5, tolerance=SIGNATURE_TOLERANCE_SECONDS,
+                 lease_seconds=60):
+        """
+        store: FirestoreEventStore or InMemoryEventStore
+        schedule: callable(customer) that runs process_customer(customer) in the background
+        lease_seconds: how long a customer's lease lasts without renewal (it is renewed per event)
+        """
+        self.store = store
+        self.secret = secret
+        self.schedule = schedule
+        self.max_attempts = max_attempts
+        self.tolerance = tolerance
+        self.lease_seconds = lease_seconds
+        # Identifies this process's leases
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._active = set()  # customers being processed in this process
+        self._rerun = set()  # customers with new events while they were being processed
+        self._stats = {'received': 0, 'duplicates': 0, 'ignored': 0, 'invalid_signature': 0,
+                       'processed': 0, 'retried': 0, 'failed': 0, 'busy': 0}
+
+    def on(self, *event_types):
+        """Decorator: register a handler(event) for one or more event types"""
+        def register(func):
+            for event_type in event_types:
+                self._handlers[event_type] = func
+            return func
+        return register
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def receive(self, payload, signature_header):
+        """Verify, deduplicate and store one webhook request; returns 'queued', 'duplicate' or 'ignored'
+
+        Raises SignatureError for a bad signature (answer 400); store errors are raised
+        so the endpoint answers 5xx and Stripe redelivers.
+        """
+        try:
+            verify_signature(payload, signature_header, self.secret, self.tolerance)
+        except SignatureError:
+            self._count('invalid_signature')
+            raise
+        event = json.loads(payload)
+        self._count('received')
+        if event.get('type') not in self._handlers:
+            self._count('ignored')
+            return 'ignored'
+        if not self.store.add(event):
+            self._count('duplicates')
+            return 'duplicate'
+        self.schedule(event_customer(event))
+        return 'queued'
+
+    def process_customer(self, customer):
+        """Run the customer's pending events in order; returns how many were processed
+
+        If the customer is already being processed in this process, that run picks
+        up the new events instead. Raises CustomerBusy if another instance holds the
+        customer's lease, and the handler's error if an event failed and will be
+        retried - either way the job is retried.
+        """
+        with self._lock:
+            if customer in self._active:
+                self._rerun.add(customer)
+                return 0
+            self._active.add(customer)
+        processed = 0
+        try:
+            self._take_lease(customer)
+            try:
+                while True:
+                    processed += self._drain(customer)
+                    with self._lock:
+                        if customer not in self._rerun:
+                            break
+                        self._rerun.discard(customer)
+            finally:
+                self.store.release(customer, self.owner)
+            # An event stored while we held the lease was turned away by it - run it now
+            if self.store.pending(customer, limit=1):
+                self.schedule(customer)
+            return processed
+        finally:
+            with self._lock:
+                self._active.discard(customer)
+                self._rerun.discard(customer)
+
+    def _take_lease(self, customer):
+        if not self.store.acquire(customer, self.owner, self.lease_seconds):
+            self._count('busy')
+            raise CustomerBusy(f"Stripe events for {customer} are being processed by another worker")
+
+    def _drain(self, customer):
+        processed = 0
+        while True:
+            events = self.store.pending(customer)
+            if not events:
+                return processed
+            for event, attempts in events:
+                # Renewed per event, so an expired lease stops us before a second worker could run it twice
+                self._take_lease(customer)
+                try:
+                    self._handlers[event['type']](event)
+                except Exception as e:
+                    attempts += 1
+                    if attempts < self.max_attempts:
+                        # Later events for this customer wait until this one goes through
+                        self.store.mark(event['id'], 'pending', attempts, str(e))
+                        self._count('retried')
+                        raise
+                    logger.error(f"Giving up on Stripe event {event['id']} ({event['type']}) "
+                                 f"after {attempts} attempts: {e}")
+                    self.store.mark(event['id'], 'failed', attempts, str(e))
+                    self._count('failed')
+                    continue
+                self.store.mark(event['id'], 'processed', attempts + 1)
+                self._count('processed')
+                processed += 1
+
+    def resume(self, idle_seconds=600):
+        """Schedule customers whose events have waited for `idle_seconds` (their job was lost)"""
+        customers = self.store.stalled_customers(idle_seconds)
+        for customer in customers:
+            self.schedule(customer)
+        return customers
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['processing'] = len(self._active)
+        stats['event_types'] = sorted(self._handlers)
+        return stats
@@ -0,0 +1,195 @@
+"""
+Local mirror of Stripe subscription state, kept on the subscriptions/{session_id} documents.
+
+Subscription pages and renewal reminders need the plan, status and renewal
+date. Asking Stripe on every page view (or per user, per day) is slow and
+burns API quota, so the mirror keeps them next to the tier:
+
+- webhook events write mirror_record() of the subscription they carry
+  (see handle_subscription_changed in app.py)
+- reconcile() lists every subscription from Stripe in pages of 100 and
+  reports the ones whose mirror drifted (a missed or failed event) to a
+  callback that writes them
+- due_renewals() finds subscriptions renewing soon with one indexed query
+  (status, current_period_end), for send_subscription_renewal_reminder
+
+The only per-user Stripe call left is portal_url(), which creates a billing
+portal session; it is cached briefly so a double click doesn't create two.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from firestore_loader import get_document
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# Subscription statuses that keep the paid tier (past_due: Stripe is still retrying the payment)
+PAID_STATUSES = {'active', 'trialing', 'past_due'}
+
+# Mirrored fields that reconcile() compares with Stripe
+MIRROR_FIELDS = ['status', 'plan', 'current_period_end', 'cancel_at_period_end', 'amount', 'currency']
+
+PLAN_INTERVALS = {'month': 'monthly', 'year': 'annual'}
+
+
+def tier_for(subscription):
+    """The tier a Stripe subscription (dict or StripeObject) grants"""
+    if subscription.get('status') not in PAID_STATUSES:
+        return 'free'
+    return (subscription.get('metadata') or {}).get('tier', 'unlimited')
+
+
+def mirror_record(subscription):
+    """The mirrored fields of a Stripe subscription"""
+    items = (subscription.get('items') or {}).get('data') or []
+    price = (items[0].get('price') or {}) if items else {}
+    interval = (price.get('recurring') or {}).get('interval')
+    period_end = subscription.get('current_period_end')
+    return {
+        'status': subscription.get('status'),
+        'plan': PLAN_INTERVALS.get(interval) or (subscription.get('metadata') or {}).get('plan'),
+        'current_period_end': datetime.fromtimestamp(period_end, timezone.utc) if period_end else None,
+        'cancel_at_period_end': bool(subscription.get('cancel_at_period_end')),
+        'amount': price.get('unit_amount'),
+        'currency': price.get('currency'),
+    }
+
+
+class SubscriptionMirror:
+    """Reads, reconciles and queries the mirrored subscription state"""
+
+    def __init__(self, db, stripe, portal_cache_seconds=60):
+        """stripe: the (lazily imported) stripe module"""
+        self.db = db
+        self.stripe = stripe
+        self._portal_urls = BoundedStore(max_entries=10000, ttl_seconds=portal_cache_seconds)
+        self._lock = threading.Lock()
+        self._stats = {'portal_sessions': 0, 'portal_cache_hits': 0, 'reconciled': 0, 'drifted': 0,
+                       'unmatched': 0, 'reminders_due': 0}
+        self._last_reconcile = None
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def get(self, session_id):
+        """The session's subscriptions document as a dict, or None"""
+        snapshot = get_document(self.db.collection('subscriptions').document(session_id))
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def portal_url(self, customer_id, return_url):
+        """URL of a Stripe billing portal session for the customer"""
+        url = self._portal_urls.get(customer_id)
+        if url:
+            self._count('portal_cache_hits')
+            return url
+        portal = self.stripe.billing_portal.Session.create(customer=customer_id, return_url=return_url)
+        self._count('portal_sessions')
+        self._portal_urls[customer_id] = portal.url
+        return portal.url
+
+    def _mirrored(self):
+        """({subscription_id: (session_id, fields)}, {session_id: fields}) for every mirror document"""
+        fields = ['subscription_id', 'tier', 'stripe_event_created'] + MIRROR_FIELDS
+        by_subscription, by_session = {}, {}
+        for doc in self.db.collection('subscriptions').select(fields).stream():
+            data = doc.to_dict() or {}
+            by_session[doc.id] = data
+            if data.get('subscription_id'):
+                by_subscription[data['subscription_id']] = (doc.id, data)
+        return by_subscription, by_session
+
+    def reconcile(self, apply):
+        """Compare every Stripe subscription with the mirror; returns the number that drifted
+
+        Only the subscription a session's mirror tracks is compared. Stripe also
+        lists a user's old, cancelled subscriptions; one the mirror doesn't track
+        is only taken over when it is paid and the tracked one isn't (an activation
+        that was missed), and only the newest such subscription per session.
+
+        apply(session_id, tier, subscription, record, applied_at) is called for each
+        subscription whose tier or mirrored fields differ. applied_at is the
+        subscription's own time (current_period_start or created, never earlier
+        than what the mirror already recorded), so webhook events that follow are
+        still newer. A mirror updated by an event after the listing started is
+        left alone.
+        """
+        listed_at = int(time.time())
+        by_subscription, by_session = self._mirrored()
+        checked = drifted = unmatched = 0
+        tracked = []  # (session_id, mirrored fields, subscription)
+        untracked = {}  # session_id -> the subscription to take over
+        for subscription in self.stripe.Subscription.list(status='all', limit=100).auto_paging_iter():
+            checked += 1
+            session_id, data = by_subscription.get(subscription['id'], (None, None))
+            if session_id is None:
+                session_id = (subscription.get('metadata') or {}).get('user_session_id')
+                if not session_id:
+                    unmatched += 1
+                    continue
+                current = by_session.get(session_id) or {}
+                if subscription.get('status') not in PAID_STATUSES or current.get('status') in PAID_STATUSES:
+                    # An old subscription, or the session is paid through the one it tracks
+                    continue
+                best = untracked.get(session_id)
+                if best is None or (subscription.get('created') or 0) > (best.get('created') or 0):
+                    untracked[session_id] = subscription
+                continue
+            tracked.append((session_id, data, subscription))
+
+        for session_id, data, subscription in tracked:
+            if session_id not in untracked:
+                drifted += self._reconcile_one(apply, session_id, data, subscription, listed_at)
+        for session_id, subscription in untracked.items():
+            drifted += self._reconcile_one(apply, session_id, by_session.get(session_id) or {}, subscription, listed_at)
+        self._count('reconciled', checked)
+        self._count('drifted', drifted)
+        self._count('unmatched', unmatched)
+        self._last_reconcile = datetime.now(timezone.utc).isoformat()
+        logger.info(f"Reconciled {checked} Stripe subscriptions: {drifted} drifted, {unmatched} without a session")
+        return drifted
+
+    def _reconcile_one(self, apply, session_id, data, subscription, listed_at):
+        """Apply the subscription to the session's mirror if it drifted; returns 1 if it did"""
+        recorded = data.get('stripe_event_created') or 0
+        if recorded > listed_at:
+            return 0
+        record = mirror_record(subscription)
+        tier = tier_for(subscription)
+        if data.get('tier') == tier and all(data.get(field) == record[field] for field in MIRROR_FIELDS):
+            return 0
+        applied_at = max(recorded, subscription.get('current_period_start') or subscription.get('created') or 0)
+        apply(session_id, tier, subscription, record, applied_at)
+        return 1
+
+    def due_renewals(self, within_days, plans=None):
+        """(session_id, document) for active subscriptions renewing within `within_days` days"""
+        now = datetime.now(timezone.utc)
+        query = (self.db.collection('subscriptions')
+                 .where('status', '==', 'active')
+                 .where('current_period_end', '>=', now)
+                 .where('current_period_end', '<=', now + timedelta(days=within_days)))
+        due = []
+        for doc in query.stream():
+            data = doc.to_dict() or {}
+            if data.get('cancel_at_period_end') or (plans and data.get('plan') not in plans):
+                continue
+            # One reminder per billing period
+            if data.get('renewal_reminder_for') == data['current_period_end']:
+                continue
+            due.append((doc.id, data))
+        self._count('reminders_due', len(due))
+        return due
+
+    def mark_reminded(self, session_id, period_end):
+        self.db.collection('subscriptions').document(session_id).update({'renewal_reminder_for': period_end})
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['last_reconcile'] = self._last_reconcile
+        return stats
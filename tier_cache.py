@@ -0,0 +1,103 @@
+"""
+Read-through cache for subscription tiers.
+
+A miss loads the single subscription document for that session from the
+state backend - nothing is loaded at startup, so boot time does not grow with
+the number of subscribers. Found tiers are kept for `ttl_seconds`; sessions
+without a subscription (mostly anonymous visitors) are cached as 'free' for
+the shorter `negative_ttl_seconds`. set_user_tier and the Stripe checkout
+paths update or invalidate entries explicitly, so this process never waits
+for a TTL to see its own changes.
+"""
+
+import logging
+import threading
+import time
+
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+
+class TierCache:
+    """Per-process tier cache with TTL, negative caching and concurrent-miss coalescing"""
+
+    def __init__(self, loader, ttl_seconds=300.0, negative_ttl_seconds=30.0, max_entries=100000, default_tier='free'):
+        """
+        loader: callable(session_id) -> tier string, or None if the session has no subscription.
+            Exceptions are treated as a failed lookup and are not cached.
+        """
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.default_tier = default_tier
+        self._entries = BoundedStore(max_entries=max_entries)  # {session_id: (tier, expires_at)}
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'load_errors': 0, 'invalidations': 0}
+
+    def get(self, session_id):
+        entry = self._entries.get(session_id)
+        if entry is not None and entry[1] > time.monotonic():
+            with self._lock:
+                self._stats['hits'] += 1
+                if entry[0] is None:
+                    self._stats['negative_hits'] += 1
+            return entry[0] or self.default_tier
+
+        with self._lock:
+            self._stats['misses'] += 1
+            event = self._loading.get(session_id)
+            leader = event is None
+            if leader:
+                event = self._loading[session_id] = threading.Event()
+        if not leader:
+            # Another request is already loading this session - wait for its result
+            event.wait(5.0)
+            entry = self._entries.peek(session_id)
+            return entry[0] or self.default_tier if entry else self.default_tier
+
+        try:
+            tier = self.loader(session_id)
+        except Exception as e:
+            logger.error(f"Failed to load tier for session {session_id}: {e}")
+            with self._lock:
+                self._stats['load_errors'] += 1
+            # Keep serving a stale entry rather than demoting a paying user on a blip
+            return entry[0] or self.default_tier if entry else self.default_tier
+        else:
+            self._store(session_id, tier)
+            return tier or self.default_tier
+        finally:
+            with self._lock:
+                self._loading.pop(session_id, None)
+            event.set()
+
+    def cached(self, session_id):
+        """True if get() would be answered without calling the loader"""
+        entry = self._entries.peek(session_id)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def set(self, session_id, tier):
+        """Record a tier this process just wrote"""
+        self._store(session_id, tier)
+
+    def invalidate(self, session_id):
+        """Drop a cached tier so the next lookup reads the subscription document"""
+        self._entries.pop(session_id)
+        with self._lock:
+            self._stats['invalidations'] += 1
+
+    def _store(self, session_id, tier):
+        ttl = self.ttl_seconds if tier else self.negative_ttl_seconds
+        self._entries[session_id] = (tier, time.monotonic() + ttl)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        stats['entries'] = len(self._entries)
+        stats['ttl_seconds'] = self.ttl_seconds
+        stats['negative_ttl_seconds'] = self.negative_ttl_seconds
+        return stats
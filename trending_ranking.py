@@ -0,0 +1,333 @@
+"""
+Trending prayers: a time-decayed hot score, kept in an incrementally updated top-K.
+
+Sorting by raw upvotes lets old prayers (the seeded ones start at 12-31)
+stay on top forever, and decaying scores at read time would mean reading
+every public confession. TrendingRanking keeps the scores instead:
+
+- every event adds a weight that halves every `half_life_seconds`: an
+  upvote adds 1 at the time of the vote, a newly shared prayer 1 at its
+  creation. Scores are stored as log2(sum of 2^(t / half_life)), which
+  never needs rescaling and only ever grows, so ordering two prayers by
+  score is ordering them by decayed weight right now
+- because scores only grow, the top `size` prayers are kept in a min-heap:
+  an update is O(log K), and a prayer outside the top only enters it by
+  beating the current minimum
+- events seen by this worker are merged into trending/current every
+  `persist_seconds` (a transaction, so workers don't overwrite each other)
+  and the worker adopts the merged ranking, including what other workers
+  merged (a worker without events of its own just re-reads it). That one
+  document is also how a new worker starts: one read, no scan
+- only without that document are the most recent public confessions
+  scored, each with its stored upvotes counted at its creation time
+
+Reading the trending view is a slice of the cached top-K - O(K), no Firestore.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import math
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+from confession_feed import FEED_FIELDS, feed_item
+
+logger = logging.getLogger(__name__)
+
+
+def _epoch(value):
+    """Epoch seconds of a datetime, ISO string or number"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value) if value is not None else time.time()
+
+
+def _log_add(a, b):
+    """log2(2^a + 2^b) without leaving log space"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class TrendingRanking:
+    """Decayed hot scores for public prayers, with the top `size` kept ordered in memory"""
+
+    def __init__(self, db, size=50, half_life_seconds=24 * 3600, max_candidates=2000, persist_seconds=60.0,
+                 jitter=0.2, bootstrap_size=500):
+        self.db = db
+        self.size = size
+        self.half_life_seconds = half_life_seconds
+        self.max_candidates = max_candidates
+        self.persist_seconds = persist_seconds
+        self.jitter = jitter
+        self.bootstrap_size = bootstrap_size
+        self._lock = threading.Lock()
+        self._persist_lock = threading.Lock()
+        self._scores = {}  # confession id -> log2 score
+        self._deltas = {}  # confession id -> log2 score of events not persisted yet
+        self._items = {}  # confession id -> feed item, for prayers that are (or were) in the top
+        self._top = {}  # confession id -> score, the top `size`
+        self._heap = []  # (score, id) over _top, with stale entries skipped lazily
+        self._ranked = None  # cached (items, etag) of the top, cleared on every change
+        self._loaded = False
+        self._persister = None
+        self._stats = {'upvotes': 0, 'saves': 0, 'top_changes': 0, 'persists': 0, 'persist_errors': 0,
+                       'bootstrapped': 0}
+
+    @property
+    def _document(self):
+        return self.db.collection('trending').document('current')
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    # Scores
+
+    def _weight(self, at, amount=1):
+        """log2 of `amount` events at epoch time `at`"""
+        return at / self.half_life_seconds + math.log2(amount)
+
+    def _add(self, confession_id, weight, item=None):
+        """Add an event's weight (lock held); returns True if the top changed"""
+        score = _log_add(self._scores.get(confession_id), weight)
+        self._scores[confession_id] = score
+        self._deltas[confession_id] = _log_add(self._deltas.get(confession_id), weight)
+        if item is not None:
+            self._items[confession_id] = item
+
+        if confession_id in self._top:
+            self._top[confession_id] = score
+            heapq.heappush(self._heap, (score, confession_id))
+            self._ranked = None
+            return False
+        if len(self._top) < self.size:
+            self._enter(confession_id, score)
+            return True
+        lowest_score, lowest_id = self._lowest()
+        if score <= lowest_score:
+            return False
+        del self._top[lowest_id]
+        self._enter(confession_id, score)
+        return True
+
+    def _enter(self, confession_id, score):
+        self._top[confession_id] = score
+        heapq.heappush(self._heap, (score, confession_id))
+        self._ranked = None
+        self._stats['top_changes'] += 1
+
+    def _lowest(self):
+        # Entries whose score has since grown (or that left the top) are stale
+        while self._heap and self._top.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def _rebuild(self):
+        """Recompute the top from all scores (lock held), after a merge"""
+        self._top = dict(heapq.nlargest(self.size, self._scores.items(), key=lambda entry: entry[1]))
+        self._heap = [(score, confession_id) for confession_id, score in self._top.items()]
+        heapq.heapify(self._heap)
+        self._ranked = None
+
+    # Events
+
+    def record_upvote(self, confession_id, item=None, at=None):
+        """An upvote counted for a public prayer; item: its feed fields, with the live upvote count"""
+        self.ensure_loaded()
+        with self._lock:
+            self._add(confession_id, self._weight(at or time.time()), item)
+            self._stats['upvotes'] += 1
+
+    def record_save(self, confession_id, item):
+        """A prayer was shared publicly"""
+        self.ensure_loaded()
+        with self._lock:
+            self._add(confession_id, self._weight(_epoch(item.get('created_at'))), item)
+            self._stats['saves'] += 1
+
+    # Reading
+
+    def page(self, limit=None):
+        """(items, etag) for the `limit` hottest prayers, hottest first; the etag is unquoted"""
+        self.ensure_loaded()
+        limit = max(1, min(limit or self.size, self.size))
+        with self._lock:
+            if self._ranked is None:
+                ranked = sorted(self._top, key=self._top.get, reverse=True)
+                items = [self._items[confession_id] for confession_id in ranked if confession_id in self._items]
+                digest = hashlib.sha1(json.dumps(items, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+                self._ranked = (items, digest)
+            items, digest = self._ranked
+        return items[:limit], f"trending-{digest}-{limit}"
+
+    # Loading and persisting
+
+    def ensure_loaded(self):
+        """Adopt trending/current, or score recent confessions if there is none (once)"""
+        if self._loaded:
+            return
+        with self._persist_lock:
+            if self._loaded:
+                return
+            try:
+                snapshot = self._document.get()
+                stored = snapshot.to_dict() if snapshot.exists else None
+                if stored:
+                    self._adopt(stored)
+                else:
+                    self._bootstrap()
+            except Exception as e:
+                # Serve what events bring in; the next persist merges with whatever is stored
+                logger.error(f"Failed to load the trending ranking: {e}")
+            self._loaded = True
+        # Keeps this worker's view current even if it never sees an event itself
+        self.start()
+
+    def _bootstrap(self):
+        from google.cloud.firestore import Query
+        docs = (self.db.collection('confessions')
+                .where('is_public', '==', True)
+                .select(FEED_FIELDS)
+                .order_by('created_at', direction=Query.DESCENDING)
+                .limit(self.bootstrap_size)
+                .stream())
+        with self._lock:
+            for doc in docs:
+                item = feed_item(doc)
+                # No vote times are stored, so count the upvotes at creation - the prayer's own weight included
+                self._add(doc.id, self._weight(_epoch(item['created_at']), (item['upvotes'] or 0) + 1), item)
+                self._stats['bootstrapped'] += 1
+        logger.info(f"Scored {self._stats['bootstrapped']} recent confessions for trending")
+
+    def _adopt(self, stored):
+        """Take over a stored ranking, keeping the events not persisted yet"""
+        with self._lock:
+            scores = dict(stored.get('scores') or {})
+            for confession_id, delta in self._deltas.items():
+                scores[confession_id] = _log_add(scores.get(confession_id), delta)
+            self._scores = scores
+            items = {confession_id: item for confession_id, item in self._items.items() if confession_id in scores}
+            for confession_id, item in (stored.get('items') or {}).items():
+                # Upvote counts only grow - keep whichever copy is newer
+                current = items.get(confession_id)
+                if current is None or (item.get('upvotes') or 0) > (current.get('upvotes') or 0):
+                    items[confession_id] = item
+            self._items = items
+            self._rebuild()
+
+    def _merged(self, stored, deltas):
+        """The document to store: stored scores plus our deltas, pruned to max_candidates"""
+        scores = dict((stored or {}).get('scores') or {})
+        for confession_id, delta in deltas.items():
+            scores[confession_id] = _log_add(scores.get(confession_id), delta)
+        scores = dict(heapq.nlargest(self.max_candidates, scores.items(), key=lambda entry: entry[1]))
+        top = heapq.nlargest(self.size, scores, key=scores.get)
+
+        stored_items = (stored or {}).get('items') or {}
+        with self._lock:
+            items = {confession_id: self._items.get(confession_id) or stored_items.get(confession_id)
+                     for confession_id in top}
+        missing = [confession_id for confession_id, item in items.items() if item is None]
+        if missing:
+            refs = [self.db.collection('confessions').document(confession_id) for confession_id in missing]
+            for doc in self.db.get_all(refs):
+                if doc.exists and (doc.to_dict() or {}).get('is_public'):
+                    items[doc.id] = feed_item(doc)
+        return {
+            'scores': scores,
+            'items': {confession_id: item for confession_id, item in items.items() if item is not None},
+            'half_life_seconds': self.half_life_seconds,
+            'updated_at': datetime.now(timezone.utc),
+        }
+
+    def persist(self):
+        """Merge this worker's events into trending/current and adopt the result; returns events merged"""
+        from google.cloud import firestore
+        self.ensure_loaded()
+        with self._persist_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            if not deltas:
+                # Nothing of ours to add - just pick up what other workers stored
+                snapshot = self._document.get()
+                if snapshot.exists:
+                    self._adopt(snapshot.to_dict())
+                return 0
+
+            merged = {}
+
+            @firestore.transactional
+            def merge(transaction):
+                snapshot = self._document.get(transaction=transaction)
+                merged['document'] = self._merged(snapshot.to_dict() if snapshot.exists else None, deltas)
+                transaction.set(self._document, merged['document'])
+
+            try:
+                merge(self.db.transaction())
+            except Exception as e:
+                with self._lock:
+                    for confession_id, delta in deltas.items():
+                        self._deltas[confession_id] = _log_add(self._deltas.get(confession_id), delta)
+                    self._stats['persist_errors'] += 1
+                logger.error(f"Failed to persist the trending ranking ({len(deltas)} prayers kept for the next try): {e}")
+                return 0
+
+            self._count('persists')
+            # Events that arrived during the transaction are in _deltas and stay on top of the merged scores
+            self._adopt(merged['document'])
+            return len(deltas)
+
+    def start(self):
+        """Start the persister thread (idempotent)"""
+        # Started lazily so the thread belongs to the serving (post-fork) worker process
+        if self._persister is not None:
+            return
+        with self._lock:
+            if self._persister is not None:
+                return
+            self._persister = threading.Thread(target=self._run, name='trending-persister', daemon=True)
+            self._persister.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.persist_seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+            try:
+                self.persist()
+            except Exception as e:
+                logger.error(f"Trending persister error: {e}")
+
+    def shutdown(self):
+        """Persist events not stored yet"""
+        with self._lock:
+            pending = bool(self._deltas)
+        if pending:
+            try:
+                self.persist()
+            except Exception as e:
+                logger.error(f"Final trending persist failed: {e}")
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['candidates'] = len(self._scores)
+            stats['top'] = len(self._top)
+            stats['pending'] = len(self._deltas)
+            hottest = heapq.nlargest(3, self._top.items(), key=lambda entry: entry[1])
+        stats['hottest'] = [
+            {'id': confession_id, 'hot': round(2 ** (score - now / self.half_life_seconds), 2)}
+            for confession_id, score in hottest
+        ]
+        return stats
@@ -0,0 +1,239 @@
+"""
+Write-behind upvote counters.
+
+Firestore sustains about one write per second to a single document, and a
+popular prayer is exactly the document everyone upvotes at once. Upvotes
+are counted in memory instead and written behind:
+
+- vote() accepts one upvote per session and confession. Sessions that voted
+  recently are remembered in memory; otherwise the vote record
+  (confession_votes/{confession_id}_{session_id}) and the confession are
+  checked with one get_all
+- a flusher thread writes the accumulated counts every `flush_interval`
+  seconds (with jitter, so workers don't flush in step) as one batch of
+  Increment transforms plus the new vote records - one write per
+  confession per flush, however many votes it got
+- deltas() lets readers add votes that the data they are showing doesn't
+  include yet (pending, or flushed after it was read), so counts look live
+- a failed flush keeps its counts for the next one; at shutdown they are
+  spilled to disk and the next worker writes them (job_queue.append_jsonl)
+
+Two instances can accept the same session's vote if it reaches both within
+one flush interval; the vote records make that the only way to vote twice.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from firestore_loader import current_loader
+from job_queue import append_jsonl, claim_jsonl
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+# Firestore allows 500 writes per batch; each confession takes one, each vote record one
+MAX_BATCH_WRITES = 500
+
+
+class UnknownConfession(LookupError):
+    """The confession doesn't exist or isn't public"""
+
+
+class UpvoteCounter:
+    """Deduplicated upvotes, aggregated in memory and flushed as Increment batches"""
+
+    def __init__(self, db, flush_interval=10.0, jitter=0.2, recent_votes=200000, delta_history_seconds=600,
+                 spill_dir=None):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.jitter = jitter
+        self.delta_history_seconds = delta_history_seconds
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # confession id -> votes not written yet
+        self._pending_votes = []  # (confession id, session id) records not written yet
+        self._flushed = deque()  # (monotonic time of the write, {confession id: votes})
+        self._voted = BoundedStore(max_entries=recent_votes, ttl_seconds=7 * 24 * 3600)
+        self._flusher = None
+        self._stats = {'votes': 0, 'duplicates': 0, 'flushes': 0, 'writes': 0, 'flush_errors': 0}
+
+    @staticmethod
+    def vote_id(confession_id, session_id):
+        return f"{confession_id}_{session_id}"
+
+    def vote(self, confession_id, session_id):
+        """Count an upvote; False if the session already upvoted this confession
+
+        Raises UnknownConfession for confessions that don't exist or aren't public.
+        """
+        key = self.vote_id(confession_id, session_id)
+        if key in self._voted:
+            self._count('duplicates')
+            return False
+
+        refs = [self.db.collection('confessions').document(confession_id),
+                self.db.collection('confession_votes').document(key)]
+        loader = current_loader()
+        confession, vote = loader.get_many(refs) if loader else list(self.db.get_all(refs))
+        if not confession.exists or not (confession.to_dict() or {}).get('is_public'):
+            raise UnknownConfession(confession_id)
+
+        with self._lock:
+            # Checked again under the lock - the same session may be voting twice right now
+            if vote.exists or key in self._voted:
+                self._voted[key] = True
+                self._stats['duplicates'] += 1
+                return False
+            self._voted[key] = True
+            self._pending[confession_id] = self._pending.get(confession_id, 0) + 1
+            self._pending_votes.append((confession_id, session_id))
+            self._stats['votes'] += 1
+        self.start()
+        return True
+
+    def deltas(self, since=None):
+        """Votes per confession not included in data read at monotonic time `since`
+
+        That is every pending vote plus, with `since`, votes flushed after it.
+        """
+        with self._lock:
+            deltas = dict(self._pending)
+            if since is not None:
+                for flushed_at, counts in self._flushed:
+                    if flushed_at > since:
+                        for confession_id, votes in counts.items():
+                            deltas[confession_id] = deltas.get(confession_id, 0) + votes
+        return deltas
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def start(self):
+        """Start the flusher and write counts spilled by earlier processes (idempotent)"""
+        # Started lazily so the thread belongs to the serving (post-fork) worker process
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(target=self._run, name='upvote-flusher', daemon=True)
+            self._flusher.start()
+        self.restore()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Upvote flusher error: {e}")
+
+    def _take_pending(self):
+        with self._lock:
+            pending, votes = self._pending, self._pending_votes
+            self._pending, self._pending_votes = {}, []
+        return pending, votes
+
+    def _put_back(self, pending, votes):
+        with self._lock:
+            for confession_id, count in pending.items():
+                self._pending[confession_id] = self._pending.get(confession_id, 0) + count
+            self._pending_votes.extend(votes)
+
+    def flush(self):
+        """Write the pending counts and vote records; returns the number of votes written"""
+        from google.cloud.firestore import Increment
+        with self._flush_lock:
+            pending, votes = self._take_pending()
+            if not pending and not votes:
+                return 0
+            # Counts first, so they are in the earliest batches
+            writes = [('count', confession_id, count) for confession_id, count in pending.items()]
+            writes += [('vote', confession_id, session_id) for confession_id, session_id in votes]
+            committed = 0
+            try:
+                for offset in range(0, len(writes), MAX_BATCH_WRITES):
+                    chunk = writes[offset:offset + MAX_BATCH_WRITES]
+                    batch = self.db.batch()
+                    for kind, confession_id, value in chunk:
+                        if kind == 'count':
+                            # merge instead of update: a confession deleted meanwhile can't fail the batch
+                            batch.set(self.db.collection('confessions').document(confession_id),
+                                      {'upvotes': Increment(value)}, merge=True)
+                        else:
+                            batch.set(self.db.collection('confession_votes').document(self.vote_id(confession_id, value)),
+                                      {'confession_id': confession_id, 'session_id': value, 'created_at': datetime.now()})
+                    batch.commit()
+                    committed = offset + len(chunk)
+            except Exception as e:
+                leftover = writes[committed:]
+                self._put_back({confession_id: count for kind, confession_id, count in leftover if kind == 'count'},
+                               [(confession_id, session_id) for kind, confession_id, session_id in leftover if kind == 'vote'])
+                self._count('flush_errors')
+                logger.error(f"Failed to flush upvotes ({len(leftover)} writes kept for the next flush): {e}")
+
+            flushed = {confession_id: count for kind, confession_id, count in writes[:committed] if kind == 'count'}
+            now = time.monotonic()
+            with self._lock:
+                if flushed:
+                    self._flushed.append((now, flushed))
+                while self._flushed and self._flushed[0][0] < now - self.delta_history_seconds:
+                    self._flushed.popleft()
+                self._stats['flushes'] += 1
+                self._stats['writes'] += committed
+            if flushed:
+                logger.info(f"Flushed {sum(flushed.values())} upvotes for {len(flushed)} confessions")
+            return sum(flushed.values())
+
+    def restore(self):
+        """Pick up counts spilled by this or earlier processes"""
+        if not self.spill_dir:
+            return 0
+        records = claim_jsonl(self.spill_dir, 'upvotes-*.jsonl')
+        pending, votes = {}, []
+        for record in records:
+            pending[record['confession_id']] = pending.get(record['confession_id'], 0) + record['count']
+            votes.extend((record['confession_id'], session_id) for session_id in record['sessions'])
+        if pending:
+            self._put_back(pending, votes)
+            with self._lock:
+                for confession_id, session_id in votes:
+                    self._voted[self.vote_id(confession_id, session_id)] = True
+            logger.info(f"Restored {sum(pending.values())} spilled upvotes")
+        return sum(pending.values())
+
+    def shutdown(self, timeout=5.0):
+        """Flush what's pending; spill it if that fails"""
+        if timeout > 0 and self._flush_lock.acquire(timeout=timeout):
+            self._flush_lock.release()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Final upvote flush failed: {e}")
+        pending, votes = self._take_pending()
+        if pending and self.spill_dir:
+            sessions = {}
+            for confession_id, session_id in votes:
+                sessions.setdefault(confession_id, []).append(session_id)
+            try:
+                append_jsonl(os.path.join(self.spill_dir, f"upvotes-{os.getpid()}.jsonl"), [
+                    {'confession_id': confession_id, 'count': count, 'sessions': sessions.get(confession_id, [])}
+                    for confession_id, count in pending.items()
+                ])
+            except OSError as e:
+                logger.error(f"Failed to spill {sum(pending.values())} upvotes: {e}")
+        return sum(pending.values())
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_votes'] = sum(self._pending.values())
+            stats['pending_confessions'] = len(self._pending)
+        return stats
@@ -0,0 +1,170 @@
+"""
+Free-tier usage metering in calendar-month windows.
+
+Each (session_id, month) counter is the stored count loaded once from the
+state backend plus increments recorded by this process that have not been
+written yet. Increments only touch an in-memory dict under a lock; a
+background flusher writes the accumulated deltas in batches (one write per
+counter per flush, not one per message). Reads are O(1) after the first
+load, and stored counts are re-read every `refresh_seconds` so increments
+made by other workers and instances show up.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from session_state import BoundedStore
+
+logger = logging.getLogger(__name__)
+
+
+def usage_window(now=None):
+    """Calendar-month window key ('YYYY-MM', UTC) for a timestamp"""
+    now = now or datetime.now(timezone.utc)
+    return f"{now.year:04d}-{now.month:02d}"
+
+
+def window_resets_at(window):
+    """Start of the month after `window`, as an aware UTC datetime"""
+    year, month = (int(part) for part in window.split('-'))
+    if month == 12:
+        return datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    return datetime(year, month + 1, 1, tzinfo=timezone.utc)
+
+
+class _Counter:
+    __slots__ = ('stored', 'loaded_at')
+
+    def __init__(self, stored, loaded_at):
+        self.stored = stored
+        self.loaded_at = loaded_at
+
+
+class UsageMeter:
+    """Per-session monthly counters with batched persistence"""
+
+    def __init__(self, store=None, flush_interval=10.0, max_pending=500, refresh_seconds=60.0, max_entries=100000):
+        """
+        store: object with load_usage(session_id, window) -> int and
+            add_usage({(session_id, window): delta}) (the state backend)
+        flush_interval: seconds between background flushes
+        max_pending: flush early once this many counters have unwritten deltas
+        refresh_seconds: re-read stored counts this often
+        """
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._counters = BoundedStore(max_entries=max_entries)
+        self._pending = {}
+        self._flushing = {}
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._stats = {'increments': 0, 'loads': 0, 'flushes': 0, 'flushed_counters': 0, 'flush_failures': 0}
+
+    def record(self, session_id, amount=1, window=None):
+        """Count usage for a session and return its total for the window"""
+        window = window or usage_window()
+        key = (session_id, window)
+        counter = self._counter(key)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+            self._stats['increments'] += 1
+            total = counter.stored + self._pending[key] + self._flushing.get(key, 0)
+            flush_now = len(self._pending) >= self.max_pending
+        self._ensure_flusher()
+        if flush_now:
+            self._wakeup.set()
+        return total
+
+    def get(self, session_id, window=None):
+        """Usage of a session in the window (the current month by default)"""
+        key = (session_id, window or usage_window())
+        counter = self._counter(key)
+        with self._lock:
+            return counter.stored + self._pending.get(key, 0) + self._flushing.get(key, 0)
+
+    def cached(self, session_id, window=None):
+        """True if the stored count for the window is loaded and fresh"""
+        counter = self._counters.peek((session_id, window or usage_window()))
+        return counter is not None and time.monotonic() - counter.loaded_at < self.refresh_seconds
+
+    def _counter(self, key):
+        counter = self._counters.get(key)
+        now = time.monotonic()
+        if counter is not None and (now - counter.loaded_at < self.refresh_seconds or key in self._flushing):
+            # A re-read while deltas are being written could count them twice
+            return counter
+        stored = 0
+        if self.store:
+            try:
+                stored = self.store.load_usage(*key)
+            except Exception as e:
+                logger.error(f"Failed to load usage for {key[0]}: {e}")
+                if counter is not None:
+                    return counter
+        with self._lock:
+            self._stats['loads'] += 1
+        counter = _Counter(stored, now)
+        self._counters[key] = counter
+        return counter
+
+    def flush(self):
+        """Write pending deltas to the store; returns the number of counters written"""
+        with self._lock:
+            if not self._pending or self._flushing:
+                return 0
+            self._flushing, self._pending = self._pending, {}
+            batch = self._flushing
+        try:
+            if self.store:
+                self.store.add_usage(batch)
+        except Exception as e:
+            logger.error(f"Failed to flush usage for {len(batch)} counters: {e}")
+            with self._lock:
+                # Keep the deltas for the next flush
+                for key, delta in batch.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+                self._flushing = {}
+                self._stats['flush_failures'] += 1
+            return 0
+
+        with self._lock:
+            for key, delta in batch.items():
+                counter = self._counters.peek(key)
+                if counter is not None:
+                    counter.stored += delta
+            self._flushing = {}
+            self._stats['flushes'] += 1
+            self._stats['flushed_counters'] += len(batch)
+        return len(batch)
+
+    def _ensure_flusher(self):
+        # Started lazily so the thread belongs to the serving (post-fork) worker process
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run, name='usage-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Usage flusher error: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_counters'] = len(self._pending)
+        stats['window'] = usage_window()
+        stats['cached_counters'] = len(self._counters)
+        return stats